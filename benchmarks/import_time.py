@@ -0,0 +1,68 @@
+"""
+Import time of the CLI and packages, each measured in a fresh interpreter. Exits
+with an error when a module goes over its budget, to catch heavy imports creeping
+back into start-up.
+
+    python benchmarks/import_time.py [repeats]
+"""
+
+import subprocess
+import sys
+
+# Seconds, with plenty of headroom over a warm start on a laptop.
+BUDGETS = {
+    "cybernomaly.__main__": 0.5,
+    "cybernomaly.packet_inspection": 0.5,
+    "cybernomaly.anomaly_detection": 0.5,
+}
+
+# Must stay out of start-up until the code paths that use them run.
+FORBIDDEN = {
+    "cybernomaly.__main__": ["kamene", "matplotlib", "pandas", "rich", "sklearn"],
+    "cybernomaly.packet_inspection": ["kamene", "pandas", "sklearn"],
+    "cybernomaly.anomaly_detection": ["kamene", "matplotlib", "pandas", "sklearn"],
+}
+
+_PROBE = """
+import sys
+from time import perf_counter
+start = perf_counter()
+import {module}
+print(perf_counter() - start)
+print(" ".join(sorted(sys.modules)))
+"""
+
+
+def measure(module):
+    out = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(module=module)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.splitlines()
+    return float(out[0]), set(out[1].split())
+
+
+def main(repeats=3):
+    failed = False
+    for module, budget in BUDGETS.items():
+        runs = [measure(module) for _ in range(repeats)]
+        best = min(seconds for seconds, _ in runs)
+        loaded = runs[0][1]
+        leaked = [
+            name
+            for name in FORBIDDEN.get(module, [])
+            if name in loaded or any(m.startswith(f"{name}.") for m in loaded)
+        ]
+        ok = best <= budget and not leaked
+        failed |= not ok
+        print(
+            f"{module:32} {best:6.3f}s (budget {budget:.1f}s)"
+            + (f", imports {', '.join(leaked)}" if leaked else "")
+            + ("" if ok else "  FAILED")
+        )
+    return int(failed)
+
+
+if __name__ == "__main__":
+    sys.exit(main(*map(int, sys.argv[1:])))
@@ -0,0 +1,72 @@
+"""
+Throughput of ShardedMIDAS_R against a single-process MIDAS_R, with the CPU time
+spent in the calling process and in the workers. On a single core the workers
+share it, so the wall-clock speedup is only meaningful with several cores.
+
+Measured on a single-CPU machine (400k edges, n_jobs=2; no multi-core result has
+been recorded yet), seconds:
+
+    edges per tick  min_shard_size  serial  sharded
+    1000            500             1.62    3.46
+    5000            2500            1.49    2.72
+    20000           10000           1.40    2.11
+    20000           20000           1.40    1.84  (not sharded)
+
+Since every worker applies every shard's delta, the sharded total CPU time is
+above the serial one, and wall-clock gains need at least as many free cores as
+workers and ticks well above 2 * min_shard_size edges.
+
+    python benchmarks/parallel_midas.py [n_edges] [n_ticks]
+"""
+
+import os
+import resource
+import sys
+from time import perf_counter, process_time
+
+import numpy as np
+
+from cybernomaly.anomaly_detection import MIDAS_R, ShardedMIDAS_R
+
+
+def make_edges(n_edges, n_ticks, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.sort(rng.integers(0, n_ticks, n_edges))
+    src = np.array([f"10.0.{i >> 8}.{i & 255}" for i in rng.zipf(1.5, n_edges) % 4096])
+    dst = np.array([f"10.1.{i >> 8}.{i & 255}" for i in rng.zipf(1.5, n_edges) % 4096])
+    return t, src, dst
+
+
+def main(n_edges=2_000_000, n_ticks=20):
+    t, src, dst = make_edges(n_edges, n_ticks)
+    params = dict(error_rate=2 / 768, false_pos_prob=0.6, decay=0.6, mode="log")
+
+    start = perf_counter()
+    expected = MIDAS_R(**params).update_detect_score_batch(src, dst, t=t)
+    serial = perf_counter() - start
+    print(f"{os.cpu_count()} CPUs")
+    print(
+        f"{'n_jobs':>6} {'seconds':>8} {'edges/s':>12} {'speedup':>8} "
+        f"{'parent s':>9} {'workers s':>10}"
+    )
+    print(f"{'serial':>6} {serial:8.2f} {n_edges / serial:12,.0f} {1:8.2f}")
+
+    for n_jobs in sorted({1, 2, 4, 8, os.cpu_count()}):
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        children = children.ru_utime + children.ru_stime
+        with ShardedMIDAS_R(MIDAS_R(**params), n_jobs=n_jobs) as sharded:
+            start, parent = perf_counter(), process_time()
+            scores = sharded.update_detect_score_batch(src, dst, t=t)
+            elapsed, parent = perf_counter() - start, process_time() - parent
+        # Worker CPU time is only reported once they have exited.
+        workers = resource.getrusage(resource.RUSAGE_CHILDREN)
+        workers = workers.ru_utime + workers.ru_stime - children
+        assert np.allclose(scores, expected, atol=1e-4), "scores differ"
+        print(
+            f"{n_jobs:6d} {elapsed:8.2f} {n_edges / elapsed:12,.0f} "
+            f"{serial / elapsed:8.2f} {parent:9.2f} {workers:10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
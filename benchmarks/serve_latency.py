@@ -0,0 +1,71 @@
+"""
+Throughput and latency of ScoringServer with concurrent local clients.
+
+    python benchmarks/serve_latency.py [n_edges] [n_clients] [framing]
+"""
+
+import asyncio
+import sys
+import threading
+from time import perf_counter
+
+import numpy as np
+
+from cybernomaly.anomaly_detection import MIDAS_R, ScoringClient, ScoringServer
+
+
+def make_edges(n_edges, seed=0):
+    rng = np.random.default_rng(seed)
+    src = (rng.zipf(1.5, n_edges) % 4096).astype(np.uint64)
+    dst = (rng.zipf(1.5, n_edges) % 4096).astype(np.uint64)
+    return src, dst
+
+
+def run_clients(address, framing, src, dst, n_clients, chunksize):
+    kwargs = {"path": address} if isinstance(address, str) else {"port": address[1]}
+    if framing == "line":
+        src, dst = src.astype(str), dst.astype(str)
+
+    def client(part):
+        with ScoringClient(framing=framing, chunksize=chunksize, **kwargs) as conn:
+            scores = conn.score(src[part], dst[part])
+        assert len(scores) == len(src[part])
+
+    threads = [
+        threading.Thread(target=client, args=(part,))
+        for part in np.array_split(np.arange(len(src)), n_clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+async def main(n_edges=200_000, n_clients=4, framing="binary"):
+    src, dst = make_edges(n_edges)
+    print(f"{'chunk':>6} {'edges/s':>12} {'batch':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for chunksize in (1, 16, 256, 4096):
+        n = min(n_edges, 2000 * chunksize)
+        async with ScoringServer(MIDAS_R(), framing=framing) as server:
+            start = perf_counter()
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                run_clients,
+                server.address,
+                framing,
+                src[:n],
+                dst[:n],
+                n_clients,
+                chunksize,
+            )
+            elapsed = perf_counter() - start
+            stats = server.stats()
+        print(
+            f"{chunksize:6d} {n / elapsed:12,.0f} {stats['batch_size']:8.1f} "
+            f"{stats['latency_p50'] * 1e3:8.2f} {stats['latency_p99'] * 1e3:8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    asyncio.run(main(*map(int, args[:2]), *args[2:]))
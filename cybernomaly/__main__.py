@@ -1,31 +1,51 @@
-import csv
+import os
+import stat
+import sys
 import click
-from datetime import datetime
-import matplotlib.pyplot as plt
-import pandas as pd
-from rich.progress import Progress
 
-from cybernomaly.packet_inspection import DeepPacketInspector, PcapPlayer
-from cybernomaly.anomaly_detection import MIDAS_R
+from cybernomaly.packet_inspection import (
+    DecodePipeline,
+    DeepPacketInspector,
+    FlowAggregator,
+    LiveCapture,
+    MultiPcapPlayer,
+    PacketFilter,
+    PcapPlayer,
+    PcapStreamSource,
+    expand_captures,
+    score_live,
+)
 
 _DEFAULT_FMT = "%.time% %-6s,IP.proto% %-15s,IP.src% -> %-15s,IP.dst%"
 
 
-def _make_gen(reader):
-    b = reader(1024 * 1024)
-    while b:
-        yield b
-        b = reader(1024 * 1024)
+class _DefaultGroup(click.Group):
+    """Group running its ``default`` command when not given the name of another."""
+
+    def __init__(self, *args, default=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default = default
+
+    def parse_args(self, ctx, args):
+        if (
+            args
+            and args[0] not in self.commands
+            and args[0] not in ctx.help_option_names
+        ):
+            args = [self.default] + args
+        return super().parse_args(ctx, args)
 
 
-def rowcount(filename):
-    f = open(filename, "rb")
-    f_gen = _make_gen(f.raw.read)
-    return sum(buf.count(b"\n") for buf in f_gen)
+@click.group(cls=_DefaultGroup, default="analyse")
+def cli():
+    """
+    Detect anomalies in packet captures and edge streams. Without a command,
+    runs ``analyse``.
+    """
 
 
-@click.command()
-@click.argument("filename", type=click.Path(exists=True))
+@cli.command("analyse")
+@click.argument("filenames", nargs=-1, required=True)
 @click.option(
     "--num",
     "-n",
@@ -38,6 +58,70 @@ def rowcount(filename):
     type=int,
     help="Number of packets at the beginning to skip.",
 )
+@click.option(
+    "--start-time",
+    type=float,
+    help="Skip packets with earlier (UNIX) timestamps.",
+)
+@click.option(
+    "--end-time",
+    type=float,
+    help="Skip packets with this or later (UNIX) timestamps.",
+)
+@click.option(
+    "--filter",
+    "-F",
+    "bpf",
+    type=str,
+    default=None,
+    help="Only analyse packets matching this BPF-style expression, e.g. "
+    "'tcp[tcpflags] & tcp-syn != 0 and dst net 10.0.0.0/8' or 'udp port 53'.",
+)
+@click.option(
+    "--index/--no-index",
+    default=True,
+    help="Seek with (and save) a sidecar index of the PCAP file.",
+)
+@click.option(
+    "--aggregate",
+    default="none",
+    type=click.Choice(("none",) + FlowAggregator.WEIGHTS),
+    help="Score each edge once per tick, weighted by its number of packets or "
+    "bytes, rather than every packet of a PCAP file as with 'none'.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=None,
+    help="Decode a PCAP file in this many worker processes, without waiting "
+    "between packets. Endpoints are then shown as hashes.",
+)
+@click.option(
+    "--spill",
+    type=str,
+    default=None,
+    help="File (.csv or .parquet) or directory (.npz chunks) to write all scores "
+    "to. Defaults to the --out CSV file.",
+)
+@click.option(
+    "--chunksize",
+    default=100000,
+    type=int,
+    help="Rows of a CSV file read and scored at a time.",
+)
+@click.option(
+    "--queue-size",
+    default=10000,
+    type=int,
+    help="Packets buffered when reading a live pcap stream ('-' or a named pipe).",
+)
+@click.option(
+    "--drop-policy",
+    default="block",
+    type=click.Choice(LiveCapture.POLICIES),
+    help="What to do with live packets when the buffer is full.",
+)
 @click.option(
     "--speed",
     "-s",
@@ -61,52 +145,117 @@ def rowcount(filename):
     default=None,
     help="File to save a plot and table of scores to.",
 )
-def main(filename, num, offset, speed, fmt, out):
-    """Analyse a PCAP file for anomalous packets."""
+def main(
+    filenames,
+    num,
+    offset,
+    start_time,
+    end_time,
+    bpf,
+    index,
+    aggregate,
+    jobs,
+    spill,
+    chunksize,
+    queue_size,
+    drop_policy,
+    speed,
+    fmt,
+    out,
+):
+    """
+    Analyse a PCAP file for anomalous packets. Several captures, or glob
+    patterns of captures, are replayed as one stream merged by timestamp.
+    """
+    from cybernomaly.anomaly_detection import MIDAS_R, ResultSink
+
+    captures = ["-"]
+    if filenames != ("-",):
+        try:
+            captures = expand_captures(filenames)
+        except FileNotFoundError as exc:
+            raise click.BadParameter(str(exc), param_hint="FILENAMES") from None
+    filename = captures[0]
+    if len(captures) > 1 and (
+        jobs
+        or any(
+            name.endswith(".csv") or stat.S_ISFIFO(os.stat(name).st_mode)
+            for name in captures
+        )
+    ):
+        raise click.BadParameter(
+            "several files can only be given to replay PCAP files, without --jobs",
+            param_hint="FILENAMES",
+        )
+
+    packet_filter = None
+    if bpf is not None:
+        if filename.endswith(".csv"):
+            raise click.BadParameter(
+                "only applies to packet captures", param_hint="--filter"
+            )
+        try:
+            packet_filter = PacketFilter(bpf)
+        except ValueError as exc:
+            raise click.BadParameter(str(exc), param_hint="--filter") from None
     dpi = DeepPacketInspector()
 
+    # Heavy dependencies are only imported by the modes that need them, to keep
+    # short runs fast to start.
     if filename.endswith(".csv"):
-        total = rowcount(filename) - 1
-        with open(filename) as fh:
-            reader = csv.reader(fh)
-            next(reader)
-            midasr = MIDAS_R(
-                error_rate=2 / 768,
-                false_pos_prob=0.6,
-                decay=0.6,
-                ticksize=1,
-                mode="log",
+        import pandas as pd
+        from rich.progress import Progress
+
+        size = os.path.getsize(filename)
+        midasr = MIDAS_R(
+            error_rate=2 / 768,
+            false_pos_prob=0.6,
+            decay=0.6,
+            ticksize=1,
+            mode="log",
+        )
+        if spill is None and out:
+            spill = f"{out}.csv"
+        seen = 0
+        with open(filename, "rb") as fh, ResultSink(
+            k=20, ticksize=midasr.ticksize, spill=spill
+        ) as sink, Progress(expand=True) as progress:
+            # Progress is tracked in bytes, and the row count estimated from them.
+            task = progress.add_task("Processing...", total=size)
+            chunks = pd.read_csv(
+                fh,
+                header=0,
+                names=["t", "src", "dst"],
+                dtype={"t": "int64", "src": str, "dst": str},
+                chunksize=chunksize,
+                nrows=num,
             )
-            results = []
-            xlim = [None, None]
-            with Progress(expand=True) as progress:
-                task = progress.add_task("Processing...", total=total)
-                for seen, row in enumerate(reader, 1):
-                    try:
-                        if num is not None and seen > num:
-                            break
-
-                        progress.update(
-                            task, description=f"Processing #{seen}/{total}..."
-                        )
-                        ts, src, dst = row
-                        ts = int(ts)
-                        if xlim[0] is None or ts < xlim[0]:
-                            xlim[0] = ts
-                        if xlim[1] is None or ts > xlim[1]:
-                            xlim[1] = ts
-                        score = midasr.update_detect_score(src, dst, t=ts)
-                        results.append([ts, src, dst, score])
-                        progress.update(task, advance=1)
-                    except KeyboardInterrupt:
-                        break
-
-        results = pd.DataFrame(results, columns=["t", "src", "dst", "score"])
-        print(results.sort_values("score", ascending=False).head(20))
-        print(results.groupby("t")["score"].max().sort_values(ascending=False).head(20))
-        results.to_csv(f"{out}.csv")
+            try:
+                for chunk in chunks:
+                    ts = chunk["t"].to_numpy()
+                    src, dst = chunk["src"].to_numpy(), chunk["dst"].to_numpy()
+                    scores = midasr.update_detect_score_batch(src, dst, t=ts)
+                    sink.add(ts, src, dst, scores)
+
+                    seen += len(chunk)
+                    done = fh.tell()
+                    total = round(seen * size / done) if done else seen
+                    progress.update(
+                        task,
+                        completed=done,
+                        description=f"Processing #{seen}/~{total}...",
+                    )
+            except KeyboardInterrupt:
+                pass
+
+        tick_max = sink.tick_max()
+        print(sink.top())
+        print(tick_max.sort_values(ascending=False).head(20))
         if out:
-            data = results.groupby("t")["score"].max().reset_index()
+            data = tick_max.reset_index()
+            xlim = [tick_max.index.min(), tick_max.index.max()]
+            import matplotlib.pyplot as plt
+
             fig, ax = plt.subplots(figsize=(8, 6))
             data.plot(x="t", y="score", ax=ax)
             ax.hlines(
@@ -119,28 +268,223 @@ def main(filename, num, offset, speed, fmt, out):
             ax.legend()
             fig.savefig(f"{out}.png")
 
+    elif filename == "-" or stat.S_ISFIFO(os.stat(filename).st_mode):
+        import asyncio
+
+        source = PcapStreamSource(None if filename == "-" else filename)
+        capture = LiveCapture(source, maxsize=queue_size, policy=drop_policy)
+        midasr = MIDAS_R()
+        dpi = DeepPacketInspector(filter=packet_filter)
+
+        def show(batch, reports, scores):
+            first = capture.processed - len(batch)
+            for n, (rec, report, score) in enumerate(zip(batch, reports, scores), 1):
+                if report is None:
+                    continue
+                src, dst = report.endpoints()
+                print(f"{first + n}: {rec.time}: [[{score}]] {src} -> {dst}")
+
+        try:
+            asyncio.run(score_live(capture, midasr, dpi, callback=show))
+        except KeyboardInterrupt:
+            pass
+        print(
+            f"Received {capture.received} packets, dropped {capture.dropped}.",
+            file=sys.stderr,
+        )
+
+    elif jobs:
+        midasr = MIDAS_R()
+        pipeline = DecodePipeline(
+            filename,
+            midasr,
+            n_jobs=jobs,
+            weight="packets" if aggregate == "none" else aggregate,
+            filter=packet_filter,
+        )
+        # Records are already weighted, so the aggregator only sums their counts.
+        flows = None
+        if aggregate != "none":
+            flows = FlowAggregator(midasr.ticksize, weight="bytes")
+
+        def score_flows(batch):
+            if not batch:
+                return
+            t, src, dst, count = zip(*batch)
+            scores = pipeline.score(t, src, dst, count)
+            for t, src, dst, count, score in zip(t, src, dst, count, scores):
+                print(
+                    f"{t}: [[{score}]] {src:016x} -> {dst:016x} "
+                    f"({count:g} {aggregate})"
+                )
+
+        batches = pipeline.batches(
+            n_packets=num,
+            offset=offset,
+            start_time=start_time,
+            end_time=end_time,
+            index=index,
+        )
+        for records in batches:
+            number, t = records["number"].tolist(), records["t"].tolist()
+            src, dst = records["src"].tolist(), records["dst"].tolist()
+            count = records["count"].tolist()
+            if flows is not None:
+                score_flows(flows.add_batch(src, dst, t, count))
+                continue
+            scores = pipeline.score(t, src, dst, count)
+            for n, t, src, dst, score in zip(number, t, src, dst, scores):
+                print(f"{n}: {t}: [[{score}]] {src:016x} -> {dst:016x}")
+        if flows is not None:
+            score_flows(flows.flush())
+
     else:
-        player = PcapPlayer(filename)
+        if len(captures) > 1:
+            # Packets are decoded by the threads reading the captures.
+            player = MultiPcapPlayer(captures, inspector=dpi)
+        else:
+            player = PcapPlayer(filename)
         midasr = MIDAS_R()
-        for pkt in player.replay(n_packets=num, offset=offset, speed=speed):
-            report = dpi.process(pkt)
-            rmeta = report.meta
-            ipinfo = rmeta.get("IP", {})
-            srcip, dstip = (
-                ipinfo.get("src"),
-                ipinfo.get("dst"),
-            )
-            portinfo = rmeta.get("UDP", rmeta.get("TCP", {}))
-            srcport, dstport = (
-                portinfo.get("sport"),
-                portinfo.get("dport"),
-            )
-            src, dst = f"{srcip}:{srcport}", f"{dstip}:{dstport}"
+        flows = None
+        if aggregate != "none":
+            flows = FlowAggregator(midasr.ticksize, weight=aggregate)
 
+        def score_flows(batch):
+            if not batch:
+                return
+            t, src, dst, count = zip(*batch)
+            scores = midasr.update_detect_score_batch(src, dst, count=count, t=t)
+            for t, src, dst, count, score in zip(t, src, dst, count, scores):
+                print(f"{t}: [[{score}]] {src} -> {dst} ({count} {aggregate})")
+
+        for pkt in player.replay(
+            n_packets=num,
+            offset=offset,
+            speed=speed,
+            raw=True,
+            start_time=start_time,
+            end_time=end_time,
+            index=index,
+            filter=packet_filter,
+        ):
+            src, dst = dpi.process(pkt).endpoints()
+            if flows is not None:
+                score_flows(flows.add(src, dst, player.t, pkt.wirelen))
+                continue
             score = midasr.update_detect_score(src, dst, t=player.t)
-            # print(f"{player.seen}: [[{score}]] {report.summary()}")
             print(f"{player.seen}: {player.t}: [[{score}]] {src} -> {dst}")
+        if flows is not None:
+            score_flows(flows.flush())
+
+
+@cli.command()
+@click.option(
+    "--socket",
+    "path",
+    type=click.Path(),
+    default=None,
+    help="Unix domain socket to listen on, instead of a TCP port.",
+)
+@click.option("--host", default="127.0.0.1", help="TCP address to listen on.")
+@click.option("--port", "-p", default=7750, type=int, help="TCP port to listen on.")
+@click.option(
+    "--framing",
+    default="line",
+    type=click.Choice(("line", "binary")),
+    help="Request format: 'src dst [t [count]]' text lines, or binary records of "
+    "two uint64 nodes and two float64s (t, count) with float64 scores back.",
+)
+@click.option(
+    "--model",
+    "-m",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory of a saved MIDAS_R model to start from (if it exists), and "
+    "to save the model to on shutdown.",
+)
+@click.option(
+    "--max-batch",
+    default=4096,
+    type=int,
+    help="Largest number of records scored at once.",
+)
+@click.option(
+    "--max-delay",
+    default=0.0,
+    type=float,
+    help="Seconds to wait for more records before scoring a partial batch.",
+)
+@click.option(
+    "--max-line",
+    default=4096,
+    type=int,
+    help="Longest line accepted with line framing, in bytes. Longer lines get a "
+    "nan score.",
+)
+@click.option(
+    "--stats-interval",
+    default=10.0,
+    type=float,
+    help="Seconds between throughput and latency reports on stderr (0 for none).",
+)
+def serve(
+    path, host, port, framing, model, max_batch, max_delay, max_line, stats_interval
+):
+    """Score edges sent over a socket with one shared, long-running model."""
+    import asyncio
+    import signal
+
+    from cybernomaly.anomaly_detection import MIDAS_R, ScoringServer
+
+    if model is not None and os.path.exists(os.path.join(model, "state.pkl")):
+        midasr = MIDAS_R.load(model, mmap_mode=None)
+    else:
+        midasr = MIDAS_R()
+    server = ScoringServer(
+        midasr,
+        path=path,
+        host=host,
+        port=port,
+        framing=framing,
+        max_batch=max_batch,
+        max_delay=max_delay,
+        max_line=max_line,
+    )
+
+    def report():
+        stats = server.stats()
+        print(
+            f"{stats['records']} records in {stats['batches']} batches "
+            f"(mean {stats['batch_size']:.1f}), {stats['throughput']:.0f} records/s, "
+            f"latency p50 {stats['latency_p50'] * 1e3:.2f} ms "
+            f"p99 {stats['latency_p99'] * 1e3:.2f} ms, "
+            f"{stats['connections']} connections",
+            file=sys.stderr,
+        )
+
+    async def run():
+        # Shut down cleanly (and save the model) on SIGINT or SIGTERM.
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, asyncio.current_task().cancel)
+        async with server:
+            print(f"Listening on {server.address} ({framing})", file=sys.stderr)
+            serving = asyncio.ensure_future(server.serve_forever())
+            try:
+                while stats_interval > 0:
+                    await asyncio.sleep(stats_interval)
+                    report()
+                await serving
+            except asyncio.CancelledError:
+                pass
+            finally:
+                serving.cancel()
+
+    asyncio.run(run())
+    report()
+    if model is not None:
+        midasr.save(model)
 
 
 if __name__ == "__main__":
-    main()
+    cli()
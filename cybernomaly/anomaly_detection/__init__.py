@@ -1,3 +1,9 @@
 from cybernomaly.anomaly_detection.base import *
+from cybernomaly.anomaly_detection.hotkeys import *
+from cybernomaly.anomaly_detection.keys import *
 from cybernomaly.anomaly_detection.midas import *
 from cybernomaly.anomaly_detection.mstream import *
+from cybernomaly.anomaly_detection.parallel import *
+from cybernomaly.anomaly_detection.results import *
+from cybernomaly.anomaly_detection.server import *
+from cybernomaly.anomaly_detection.sketch import *
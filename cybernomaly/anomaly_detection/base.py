@@ -1,10 +1,83 @@
+import inspect
+import os
+import pickle
 from abc import ABC, abstractmethod
-from sklearn.base import BaseEstimator
+
+import numpy as np
 
 __all__ = ["Monitor"]
 
 
-class Monitor(ABC, BaseEstimator):
+class Monitor(ABC):
+    """
+    Base class of streaming anomaly detectors.
+
+    Monitors follow the scikit-learn estimator conventions: every constructor
+    argument is stored in an attribute of the same name, and :meth:`get_params`
+    and :meth:`set_params` work as they do for estimators (so that e.g.
+    ``sklearn.base.clone`` applies), without importing scikit-learn.
+    """
+
+    @classmethod
+    def _get_param_names(cls):
+        params = inspect.signature(cls.__init__).parameters.values()
+        return sorted(
+            p.name
+            for p in params
+            if p.name != "self" and p.kind not in (p.VAR_POSITIONAL, p.VAR_KEYWORD)
+        )
+
+    def get_params(self, deep=True):
+        """
+        Get the parameters of the monitor, by name. With ``deep``, the parameters
+        of nested estimators are included as ``<parameter>__<name>``.
+        """
+        params = {}
+        for name in self._get_param_names():
+            value = getattr(self, name)
+            params[name] = value
+            if deep and hasattr(value, "get_params") and not isinstance(value, type):
+                for key, nested in value.get_params().items():
+                    params[f"{name}__{key}"] = nested
+        return params
+
+    def set_params(self, **params):
+        """
+        Set parameters of the monitor, including those of nested estimators with
+        the ``<parameter>__<name>`` syntax of :meth:`get_params`.
+        """
+        valid = self._get_param_names()
+        nested = {}
+        for key, value in params.items():
+            name, _, sub = key.partition("__")
+            if name not in valid:
+                raise ValueError(
+                    f"Invalid parameter '{name}' for {type(self).__name__}. "
+                    f"Valid parameters are {valid}."
+                )
+            if sub:
+                nested.setdefault(name, {})[sub] = value
+            else:
+                setattr(self, name, value)
+        for name, sub_params in nested.items():
+            getattr(self, name).set_params(**sub_params)
+        return self
+
+    def __repr__(self):
+        # Like scikit-learn's, only shows the parameters changed from the defaults.
+        signature = inspect.signature(type(self).__init__).parameters
+        changed = []
+        for name, value in self.get_params(deep=False).items():
+            default = signature[name].default
+            same = value is default or (
+                type(value) is type(default)
+                and isinstance(value, (int, float, str))
+                and value == default
+            )
+            if not same:
+                changed.append(f"{name}={value!r}")
+        return f"{type(self).__name__}({', '.join(changed)})"
+
     @abstractmethod
     def partial_fit(self, *args, **kwargs):
         raise NotImplementedError("abstract method")
@@ -25,6 +98,85 @@ class Monitor(ABC, BaseEstimator):
     def update_detect_score(self, *args, **kwargs):
         raise NotImplementedError("abstract method")
 
+    def save(self, path):
+        """
+        Save the full state of the monitor (hyperparameters, sketches and clock) to
+        the directory ``path``, creating it if necessary.
+
+        Each array is written to its own ``.npy`` file so that :meth:`load` can
+        memory-map it. Files are replaced atomically, so saving over a snapshot
+        that is currently loaded (even memory-mapped) is safe.
+        """
+        arrays, state = self._get_state()
+        os.makedirs(path, exist_ok=True)
+        for name, arr in arrays.items():
+            self._atomic_write(
+                os.path.join(path, f"{name}.npy"), lambda fh: np.save(fh, arr)
+            )
+
+        meta = {
+            "class": type(self),
+            "params": self.get_params(deep=False),
+            "arrays": sorted(arrays),
+            "state": state,
+        }
+        self._atomic_write(
+            os.path.join(path, "state.pkl"),
+            lambda fh: pickle.dump(meta, fh, protocol=pickle.HIGHEST_PROTOCOL),
+        )
+
+    @classmethod
+    def load(cls, path, mmap_mode="c"):
+        """
+        Restore a monitor saved with :meth:`save`.
+
+        Parameters
+        ----------
+        path : str
+            Snapshot directory.
+
+        mmap_mode : {None, "r", "r+", "c"}, default="c"
+            Passed to ``numpy.load``. With the default copy-on-write mapping,
+            restoring is near-instant regardless of state size and updates do not
+            modify the snapshot. Use "r+" to update the snapshot files in place, or
+            None to read the arrays into memory.
+
+        Notes
+        -----
+        Snapshots contain pickled data: only load snapshots from trusted sources.
+        """
+        with open(os.path.join(path, "state.pkl"), "rb") as fh:
+            meta = pickle.load(fh)
+
+        klass = meta["class"]
+        if not issubclass(klass, cls):
+            raise TypeError(
+                f"Snapshot at '{path}' holds a {klass.__name__}, not a {cls.__name__}."
+            )
+
+        monitor = klass(**meta["params"])
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in meta["arrays"]
+        }
+        monitor._set_state(arrays, meta["state"])
+        return monitor
+
+    def _get_state(self):
+        raise NotImplementedError(f"{type(self).__name__} does not support saving.")
+
+    def _set_state(self, arrays, state):
+        raise NotImplementedError(f"{type(self).__name__} does not support loading.")
+
+    @staticmethod
+    def _atomic_write(filename, write):
+        tmp = f"{filename}.tmp"
+        with open(tmp, "wb") as fh:
+            write(fh)
+        os.replace(tmp, filename)
+
     @staticmethod
     def _snap_time(t, interval):
+        if isinstance(t, np.ndarray):
+            return np.round(t / interval) * interval
         return round(t / interval) * interval
@@ -0,0 +1,202 @@
+import numpy as np
+
+from cybernomaly.anomaly_detection.sketch import _running_sums
+
+__all__ = ["HotKeyTier"]
+
+
+class HotKeyTier:
+    """
+    Exact current and total counts for the heaviest keys of a stream, kept out of
+    the count-min sketches that hold all other keys.
+
+    Candidates are found with a space-saving summary [1]_ of ``candidates`` keys,
+    which is merged once per tick with the exact counts of that tick [2]_. A key
+    entering the summary inherits the largest count evicted from it so far, on top
+    of its count in the tick, so that the summary's counts never fall below the
+    true totals and exceed them by at most ``total / candidates``: every key
+    heavier than that is a candidate. At the end of every tick, the top
+    ``capacity`` keys of the summary become hot, and the rest of the hot keys are
+    evicted. As the hot set only changes between ticks, adding edges one at a time
+    or in batches gives the same counts.
+
+    A key admitted to the tier starts from its estimates in the sketches, and is
+    counted exactly from then on. When it is evicted, the counts it gathered while
+    hot are added to the sketches, so that their estimates for it still never
+    fall below its true counts.
+
+    Parameters
+    ----------
+    capacity : int
+        Number of hot keys.
+
+    candidates : int, default=None
+        Number of keys tracked by the summary. Defaults to ``4 * capacity``.
+
+    References
+    ----------
+    .. [1] Efficient Computation of Frequent and Top-k Elements in Data Streams
+           https://doi.org/10.1007/978-3-540-30570-5_27
+
+    .. [2] Mergeable Summaries
+           https://www.cs.utah.edu/~jeffp/papers/merge-summ.pdf
+    """
+
+    def __init__(self, capacity, candidates=None):
+        if capacity < 1:
+            raise ValueError("capacity must be a positive integer.")
+        self.capacity = int(capacity)
+        self.candidates = int(candidates or 4 * capacity)
+        if self.candidates < self.capacity:
+            raise ValueError("candidates must be at least capacity.")
+
+        # Hot keys, sorted, and their counts. The counts at admission (with any
+        # decay since) are kept to know what to add back to the sketches.
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.cur = np.empty(0, dtype=np.float64)
+        self.tot = np.empty(0, dtype=np.float64)
+        self._cur0 = np.empty(0, dtype=np.float64)
+        self._tot0 = np.empty(0, dtype=np.float64)
+        self._slots = {}
+
+        self._summary_keys = np.empty(0, dtype=np.uint64)
+        self._summary_counts = np.empty(0, dtype=np.float64)
+        # Largest count evicted from the summary, an upper bound of the total
+        # count of any key outside it.
+        self._summary_floor = 0.0
+        self._pending = {}
+        self._pending_batches = []
+
+    @property
+    def nbytes(self):
+        """Memory used by the counters and the summary, in bytes."""
+        return (
+            self.keys.nbytes
+            + self.cur.nbytes
+            + self.tot.nbytes
+            + self._cur0.nbytes
+            + self._tot0.nbytes
+            + self._summary_keys.nbytes
+            + self._summary_counts.nbytes
+        )
+
+    def slot(self, key):
+        """Index of a hot key (an int), or -1 if the key is not hot."""
+        return self._slots.get(key, -1)
+
+    def lookup(self, keys):
+        """Indices of an array of keys, with -1 for keys that are not hot."""
+        if not len(self.keys):
+            return np.full(len(keys), -1, dtype=np.intp)
+        idx = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[idx] == keys, idx, -1)
+
+    def record(self, key, count=1):
+        """Count a key (an int) towards the summary at the end of the tick."""
+        self._pending[key] = self._pending.get(key, 0) + count
+
+    def record_batch(self, keys, counts):
+        """Count an array of keys towards the summary at the end of the tick."""
+        self._pending_batches.append(
+            (np.asarray(keys, dtype=np.uint64), np.asarray(counts, dtype=np.float64))
+        )
+
+    def add(self, slot, count=1):
+        """Add ``count`` to a hot key, returning its current and total counts."""
+        self.cur[slot] += count
+        self.tot[slot] += count
+        return self.cur[slot], self.tot[slot]
+
+    def add_cumulative(self, slots, counts):
+        """
+        Add ``counts`` to hot keys in order, returning the current and total counts
+        of each key immediately after its own addition.
+        """
+        order = np.argsort(slots, kind="stable")
+        sorted_slots, counts = slots[order], counts[order]
+        running_cur, first = _running_sums(sorted_slots, counts, self.cur[sorted_slots])
+        running_tot, _ = _running_sums(sorted_slots, counts, self.tot[sorted_slots])
+        last = np.r_[first[1:] - 1, len(sorted_slots) - 1]
+
+        cur = np.empty(len(slots), dtype=np.float64)
+        tot = np.empty(len(slots), dtype=np.float64)
+        cur[order] = running_cur
+        tot[order] = running_tot
+        self.cur[sorted_slots[last]] = running_cur[last]
+        self.tot[sorted_slots[last]] = running_tot[last]
+        return cur, tot
+
+    def decay(self, factor):
+        """Multiply the current counts by ``factor``."""
+        self.cur *= factor
+        self._cur0 *= factor
+
+    def end_tick(self, cur_sketch, tot_sketch):
+        """
+        Fold the counts of the tick into the summary and update the hot set,
+        moving keys between the tier and the sketches.
+        """
+        batches = self._pending_batches
+        if self._pending:
+            keys = np.fromiter(self._pending, dtype=np.uint64, count=len(self._pending))
+            counts = np.fromiter(
+                self._pending.values(), dtype=np.float64, count=len(self._pending)
+            )
+            batches.append((keys, counts))
+        if not batches:
+            return
+        self._pending, self._pending_batches = {}, []
+
+        keys, inverse = np.unique(
+            np.concatenate([self._summary_keys] + [k for k, _ in batches]),
+            return_inverse=True,
+        )
+        counts = np.bincount(
+            inverse,
+            weights=np.concatenate([self._summary_counts] + [c for _, c in batches]),
+        )
+        # Keys new to the summary may have been evicted from it before.
+        new = ~np.isin(keys, self._summary_keys, assume_unique=True)
+        counts[new] += self._summary_floor
+        # Ties are broken by key, so that the summary does not depend on the order
+        # of the updates.
+        top = np.lexsort((keys, -counts))
+        keep = np.sort(top[: self.candidates])
+        if len(top) > self.candidates:
+            evicted = counts[top[self.candidates]]
+            self._summary_floor = max(self._summary_floor, float(evicted))
+        self._summary_keys, self._summary_counts = keys[keep], counts[keep]
+        self._set_hot(np.sort(keys[top[: self.capacity]]), cur_sketch, tot_sketch)
+
+    def _set_hot(self, keys, cur_sketch, tot_sketch):
+        stay = np.isin(self.keys, keys)
+        evicted = ~stay
+        if evicted.any():
+            gone = self.keys[evicted]
+            cur_sketch.add(gone, self.cur[evicted] - self._cur0[evicted])
+            tot_sketch.add(gone, self.tot[evicted] - self._tot0[evicted])
+
+        admitted = keys[~np.isin(keys, self.keys)]
+        cur0 = cur_sketch.query(admitted) if len(admitted) else np.empty(0)
+        tot0 = tot_sketch.query(admitted) if len(admitted) else np.empty(0)
+
+        all_keys = np.concatenate([self.keys[stay], admitted])
+        order = np.argsort(all_keys)
+        self.keys = all_keys[order]
+        self.cur = np.concatenate([self.cur[stay], cur0]).astype(np.float64)[order]
+        self.tot = np.concatenate([self.tot[stay], tot0]).astype(np.float64)[order]
+        self._cur0 = np.concatenate([self._cur0[stay], cur0]).astype(np.float64)[order]
+        self._tot0 = np.concatenate([self._tot0[stay], tot0]).astype(np.float64)[order]
+        self._slots = {key: slot for slot, key in enumerate(self.keys.tolist())}
+
+    def _get_state(self):
+        state = dict(vars(self))
+        del state["_slots"]
+        return state
+
+    @classmethod
+    def _from_state(cls, state):
+        tier = cls.__new__(cls)
+        vars(tier).update(state)
+        tier._slots = {key: slot for slot, key in enumerate(tier.keys.tolist())}
+        return tier
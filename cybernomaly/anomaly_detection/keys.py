@@ -0,0 +1,153 @@
+import hashlib
+import socket
+
+import numpy as np
+
+from cybernomaly.anomaly_detection.sketch import _MASK64, _mix64, _mix64_int
+
+__all__ = [
+    "KeyEncoder",
+    "HashableKeyEncoder",
+    "IntegerKeyEncoder",
+    "IPv4KeyEncoder",
+    "get_key_encoder",
+]
+
+_GOLDEN = 0x9E3779B97F4A7C15
+
+
+def _stable_hash(key):
+    """
+    Hash a string to an unsigned 64-bit integer. Unlike the builtin ``hash``, the
+    result does not depend on the interpreter's hash seed.
+    """
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _as_list(keys):
+    return keys.tolist() if hasattr(keys, "tolist") else list(keys)
+
+
+def _normalise(key):
+    """
+    Convert numpy scalars (also inside tuples) to the equivalent Python objects,
+    so that a key is hashed the same whether it comes from an array or not.
+    """
+    if isinstance(key, np.generic):
+        return key.item()
+    if isinstance(key, tuple):
+        return tuple(map(_normalise, key))
+    return key
+
+
+class KeyEncoder:
+    """
+    Maps node identifiers to unsigned 64-bit integers for indexing the count-min
+    sketches. Subclasses implement :meth:`encode` for a single key; batches are
+    encoded once per distinct key.
+
+    Encoders must be deterministic across processes, so that sketches built by
+    different workers or saved to disk remain comparable.
+    """
+
+    def encode(self, key):
+        raise NotImplementedError("abstract method")
+
+    def encode_batch(self, keys):
+        keys = _as_list(keys)
+        codes = {}
+        inverse = np.fromiter(
+            (codes.setdefault(key, len(codes)) for key in keys),
+            dtype=np.intp,
+            count=len(keys),
+        )
+        uniques = np.fromiter(
+            (self.encode(key) for key in codes), dtype=np.uint64, count=len(codes)
+        )
+        return uniques[inverse]
+
+    @staticmethod
+    def encode_edge(src, dst):
+        """
+        Combine two encoded node keys into an (ordered) edge key. Works on Python
+        ints and on uint64 arrays.
+        """
+        if isinstance(src, np.ndarray):
+            return _mix64(src * np.uint64(_GOLDEN) + dst)
+        return _mix64_int((src * _GOLDEN + dst) & _MASK64)
+
+
+class HashableKeyEncoder(KeyEncoder):
+    """
+    Compatibility encoder for arbitrary hashable keys, hashed via their ``repr``.
+    """
+
+    def encode(self, key):
+        return _stable_hash(repr(_normalise(key)))
+
+
+class IntegerKeyEncoder(KeyEncoder):
+    """
+    Encoder for integer node ids. Batches of integers are encoded without any
+    Python-level iteration.
+    """
+
+    def encode(self, key):
+        return _mix64_int(int(key) & _MASK64)
+
+    def encode_batch(self, keys):
+        return _mix64(np.asarray(keys).astype(np.uint64))
+
+
+class IPv4KeyEncoder(KeyEncoder):
+    """
+    Encoder for IPv4 endpoints, given as ``"a.b.c.d"`` or ``"a.b.c.d:port"``
+    strings, ``(address, port)`` tuples or pre-packed integers.
+
+    The address and port are packed into a single integer (bit 48 flags the
+    presence of a port) before mixing, so no string hashing is involved. Keys that
+    are not IPv4 endpoints fall back to :class:`HashableKeyEncoder`.
+    """
+
+    def encode(self, key):
+        if isinstance(key, (int, np.integer)):
+            return _mix64_int(int(key) & _MASK64)
+
+        if isinstance(key, tuple):
+            addr, port = key
+        else:
+            addr, _, port = str(key).partition(":")
+
+        try:
+            packed = int.from_bytes(socket.inet_aton(addr), "big") << 16
+            if port not in (None, "", "None"):
+                packed |= (1 << 48) | (int(port) & 0xFFFF)
+        except (OSError, TypeError, ValueError):
+            return _stable_hash(repr(_normalise(key)))
+        return _mix64_int(packed)
+
+    def encode_batch(self, keys):
+        if isinstance(keys, np.ndarray) and keys.dtype.kind in "iu":
+            return _mix64(keys.astype(np.uint64))
+        return super().encode_batch(keys)
+
+
+_KEY_ENCODERS = {
+    "hashable": HashableKeyEncoder,
+    "int": IntegerKeyEncoder,
+    "ipv4": IPv4KeyEncoder,
+}
+
+
+def get_key_encoder(key_encoder):
+    """Resolve a key encoder name (or instance) to a :class:`KeyEncoder`."""
+    if isinstance(key_encoder, KeyEncoder):
+        return key_encoder
+    try:
+        return _KEY_ENCODERS[key_encoder]()
+    except (KeyError, TypeError):
+        raise ValueError(
+            f"Invalid key_encoder '{key_encoder}'. Must be a KeyEncoder or one "
+            f"of {sorted(_KEY_ENCODERS)}"
+        )
@@ -1,11 +1,32 @@
-from functools import lru_cache
 from time import time
 
 import numpy as np
-from probables import CountMinSketch
-from scipy.stats import chi2
+from scipy.special import erfc, erfcinv
 
 from cybernomaly.anomaly_detection.base import Monitor
+from cybernomaly.anomaly_detection.hotkeys import HotKeyTier
+from cybernomaly.anomaly_detection.keys import get_key_encoder
+from cybernomaly.anomaly_detection.sketch import CountMinSketch
+
+__all__ = ["MIDAS_R"]
+
+# Element-wise equivalents of the builtin aggregation functions.
+_VECTORISED_AGGS = {max: np.maximum, min: np.minimum}
+
+
+def _chi_squared(cur, tot, t):
+    """
+    Chi-squared statistic comparing the count ``cur`` in the current tick with the
+    mean count per tick ``tot / t``, element-wise. Zero where there is no history.
+    """
+    if t <= 1:
+        return np.zeros_like(tot)
+    # Squared by multiplication rather than ``** 2``, which numpy scalars compute
+    # with ``pow``, so that this agrees to the last bit with ``MIDAS_R._score``.
+    diff = (cur - tot / t) * t
+    with np.errstate(divide="ignore", invalid="ignore"):
+        score = (diff * diff) / (tot * (t - 1))
+    return np.where(tot == 0, 0.0, score)
 
 
 class MIDAS_R(Monitor):
@@ -17,6 +38,46 @@ class MIDAS_R(Monitor):
     To also account for node/edge properties, MStream is the multi-dimensional
     equivalent.
 
+    The six count-min sketches (current and total counts of edges, sources and
+    destinations) dominate its memory use. They can be made several times smaller
+    for the same accuracy with ``conservative=True`` and ``compact=True``, and
+    sized to a fixed ``memory_budget`` instead of an ``error_rate``. See
+    :meth:`memory_report` for the memory and error of each sketch.
+
+    A few very chatty edges and nodes can dominate a stream, inflating the counts
+    of everything that shares their sketch counters. With ``hot_keys``, the
+    heaviest edges, sources and destinations are counted exactly in a
+    :class:`HotKeyTier` instead, outside the sketches.
+
+    Parameters
+    ----------
+    error_rate : float, default=0.1
+        Relative error of the sketches' counts. Ignored with ``memory_budget``.
+
+    false_pos_prob : float, default=0.02
+        Probability of a count exceeding the error rate, which sets the number of
+        rows of the sketches.
+
+    conservative : bool, default=False
+        Whether the sketches use conservative updates, which only raise the
+        counters of an edge or node that are below its new count. This gives much
+        tighter counts for the same size (see :class:`CountMinSketch`).
+
+    compact : bool, default=False
+        Whether to store total counts as 32-bit unsigned integers (which saturate
+        at ``2**32 - 1``) and decayed current counts as 32-bit floats, halving the
+        memory of the sketches. Scores then differ from those of the default
+        float64 sketches by float32 rounding.
+
+    memory_budget : int, default=None
+        Bytes to use for all the sketches together. Their width is then the
+        largest that fits, instead of being set by ``error_rate``.
+
+    hot_keys : int, default=0
+        Number of edges, sources and destinations (each) to count exactly once
+        they are among the heaviest seen so far. The hot set is updated at the end
+        of every tick.
+
     References
     ----------
     .. [1] MIDAS: Microcluster-Based Detector of Anomalies in Edge Streams
@@ -33,6 +94,11 @@ class MIDAS_R(Monitor):
         alpha=0.05,
         mode="raw",
         precision=5,
+        key_encoder="hashable",
+        conservative=False,
+        compact=False,
+        memory_budget=None,
+        hot_keys=0,
     ):
         self.error_rate = error_rate
         self.false_pos_prob = false_pos_prob
@@ -60,7 +126,8 @@ class MIDAS_R(Monitor):
             )
             raise ValueError(f"Invalid mode '{mode}'. Must be one of {modes}")
         self.mode = mode
-        self.thresh_ = self._transform_fn(chi2.ppf(1 - self.alpha, df=1))
+        # Inverse survival function of the chi-squared distribution with df=1.
+        self.thresh_ = self._transform_fn(2 * erfcinv(self.alpha) ** 2)
 
         if precision is not None and (
             not isinstance(precision, (int, np.integer)) or precision < 0
@@ -68,12 +135,34 @@ class MIDAS_R(Monitor):
             raise ValueError("precision must be a non-negative integer.")
         self.precision = precision
 
-        self._edge_tot = self._create_cms()
-        self._src_tot = self._create_cms()
-        self._dst_tot = self._create_cms()
-        self._edge_cur = self._create_cms()
-        self._src_cur = self._create_cms()
-        self._dst_cur = self._create_cms()
+        self._encoder = get_key_encoder(key_encoder)
+        self.key_encoder = key_encoder
+
+        self.conservative = conservative
+        self.compact = compact
+        self.memory_budget = memory_budget
+        tot_dtype = np.uint32 if compact else np.float64
+        cur_dtype = np.float32 if compact else np.float64
+        self._budget_unit = None
+        if memory_budget is not None:
+            # Every sketch gets a share of the budget in proportion to the size of
+            # its counters, so that they all get the same width.
+            itemsize = np.dtype(tot_dtype).itemsize + np.dtype(cur_dtype).itemsize
+            self._budget_unit = memory_budget / (3 * itemsize)
+
+        self._edge_tot = self._create_cms(tot_dtype)
+        self._src_tot = self._create_cms(tot_dtype)
+        self._dst_tot = self._create_cms(tot_dtype)
+        self._edge_cur = self._create_cms(cur_dtype)
+        self._src_cur = self._create_cms(cur_dtype)
+        self._dst_cur = self._create_cms(cur_dtype)
+
+        if hot_keys < 0:
+            raise ValueError("hot_keys must be a non-negative integer.")
+        self.hot_keys = hot_keys
+        self._edge_hot = HotKeyTier(hot_keys) if hot_keys else None
+        self._src_hot = HotKeyTier(hot_keys) if hot_keys else None
+        self._dst_hot = HotKeyTier(hot_keys) if hot_keys else None
 
         self._start = None
         self._last_update = None
@@ -87,6 +176,13 @@ class MIDAS_R(Monitor):
         return self._update(edge, src, dst, count, t)
 
     def _update(self, edge, src, dst, count, t):
+        self._advance(t)
+
+        self._update_edge(edge, count)
+        self._update_src(src, count)
+        self._update_dst(dst, count)
+
+    def _advance(self, t):
         if self._start is None:
             self._start = t - 1
 
@@ -98,37 +194,41 @@ class MIDAS_R(Monitor):
 
         if t > self._last_update:
             if self.decay:
-                for cms in (self._edge_cur, self._src_cur, self._dst_cur):
-                    for i in range(len(cms._bins)):
-                        cms._bins[i] *= self.decay
+                # Decay once per elapsed tick, not once per update.
+                factor = self.decay ** round((t - self._last_update) / self.ticksize)
+                self._edge_cur.decay(factor)
+                self._src_cur.decay(factor)
+                self._dst_cur.decay(factor)
             else:
+                factor = 0.0
                 self._edge_cur.clear()
                 self._src_cur.clear()
                 self._dst_cur.clear()
+            if self.hot_keys:
+                for kind in ("edge", "src", "dst"):
+                    hot = getattr(self, f"_{kind}_hot")
+                    hot.decay(factor)
+                    hot.end_tick(
+                        getattr(self, f"_{kind}_cur"), getattr(self, f"_{kind}_tot")
+                    )
             self._last_update = t
 
-        self._update_edge(edge, count)
-        self._update_src(src, count)
-        self._update_dst(dst, count)
-
     def detect_score(self, src, dst):
         edge, src, dst = self._format_keys(src, dst)
-        t = self._snap_time(t if t is not None else time(), self.ticksize)
         return self._detect_score(edge, src, dst)
 
     def detect(self, src, dst):
         return self.detect_score(src, dst) > self.thresh_
 
     def _detect_score(self, edge, src, dst):
-        edge, src, dst = self._format_keys(src, dst)
         edge_score = self._score(
-            self._edge_cur.check(edge), self._edge_tot.check(edge)
+            *self._query_cms(edge, self._edge_cur, self._edge_tot, self._edge_hot)
         )
         src_score = self._score(
-            self._src_cur.check(src), self._src_tot.check(src)
+            *self._query_cms(src, self._src_cur, self._src_tot, self._src_hot)
         )
         dst_score = self._score(
-            self._dst_cur.check(dst), self._dst_tot.check(dst)
+            *self._query_cms(dst, self._dst_cur, self._dst_tot, self._dst_hot)
         )
 
         score = self.agg(edge_score, src_score, dst_score)
@@ -148,47 +248,284 @@ class MIDAS_R(Monitor):
     def update_detect(self, src, dst, count=1, t=None):
         return self.update_detect_score(src, dst, count, t) > self.thresh_
 
+    def update_detect_score_batch(self, src, dst=None, count=1, t=None):
+        """
+        Equivalent to calling :meth:`update_detect_score` on each edge in turn, but
+        vectorised within each tick.
+
+        Parameters
+        ----------
+        src : array-like or DataFrame
+            Source nodes. Alternatively, a DataFrame with columns ``src``, ``dst``
+            and optionally ``t`` and ``count``, in which case ``dst`` must be None.
+
+        dst : array-like
+            Destination nodes.
+
+        count : int or array-like, default=1
+            Edge multiplicities.
+
+        t : float or array-like, default=None
+            Edge timestamps. Defaults to the current time.
+
+        Returns
+        -------
+        scores : ndarray of shape (n_edges,)
+            The score of each edge immediately after its own update.
+        """
+        if dst is None:
+            frame = src
+            src, dst = np.asarray(frame["src"]), np.asarray(frame["dst"])
+            if "t" in frame:
+                t = np.asarray(frame["t"])
+            if "count" in frame:
+                count = np.asarray(frame["count"])
+
+        edge, src, dst = self._format_keys_batch(src, dst)
+        return self._update_detect_score_keys(edge, src, dst, count, t)
+
+    def _update_detect_score_keys(self, edge, src, dst, count=1, t=None):
+        # Same as update_detect_score_batch, on keys already encoded (e.g. by other
+        # processes).
+        n = len(edge)
+        if n == 0:
+            return np.zeros(0, dtype=np.float64)
+        count = np.broadcast_to(np.asarray(count, dtype=np.float64), (n,))
+        t = np.broadcast_to(
+            np.asarray(t if t is not None else time(), dtype=np.float64), (n,)
+        )
+        t = self._snap_time(t, self.ticksize)
+
+        scores = np.empty(n, dtype=np.float64)
+        bounds = np.r_[0, np.flatnonzero(np.diff(t)) + 1, n]
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            self._advance(t[start])
+            run = slice(start, stop)
+            scores[run] = self._update_detect_score_batch(
+                edge[run], src[run], dst[run], count[run]
+            )
+        return scores
+
+    def _update_detect_score_batch(self, edge, src, dst, count):
+        edge_score = self._score_batch(
+            *self._add_cumulative(
+                edge, count, self._edge_cur, self._edge_tot, self._edge_hot
+            )
+        )
+        src_score = self._score_batch(
+            *self._add_cumulative(
+                src, count, self._src_cur, self._src_tot, self._src_hot
+            )
+        )
+        dst_score = self._score_batch(
+            *self._add_cumulative(
+                dst, count, self._dst_cur, self._dst_tot, self._dst_hot
+            )
+        )
+
+        agg = _VECTORISED_AGGS.get(self.agg)
+        if agg is not None:
+            score = agg(agg(edge_score, src_score), dst_score)
+        else:
+            score = np.frompyfunc(self.agg, 3, 1)(
+                edge_score, src_score, dst_score
+            ).astype(np.float64)
+        if self.precision is not None:
+            score = np.round(score, self.precision)
+
+        return self._transform_fn(score)
+
     def _format_keys(self, src, dst):
-        edge = repr((src, dst))
-        src = repr(src)
-        dst = repr(dst)
+        src = self._encoder.encode(src)
+        dst = self._encoder.encode(dst)
+        edge = self._encoder.encode_edge(src, dst)
+        return edge, src, dst
+
+    def _format_keys_batch(self, src, dst):
+        src = self._encoder.encode_batch(src)
+        dst = self._encoder.encode_batch(dst)
+        edge = self._encoder.encode_edge(src, dst)
         return edge, src, dst
 
-    def _create_cms(self):
-        cms = CountMinSketch(
-            confidence=1 - self.false_pos_prob / 2, error_rate=self.error_rate
+    def _create_cms(self, dtype=np.float64):
+        confidence = 1 - self.false_pos_prob / 2
+        if self._budget_unit is not None:
+            return CountMinSketch.from_memory(
+                self._budget_unit * np.dtype(dtype).itemsize,
+                confidence,
+                dtype=dtype,
+                conservative=self.conservative,
+            )
+        cms = CountMinSketch.from_error_rate(
+            self.error_rate,
+            confidence=confidence,
+            dtype=dtype,
+            conservative=self.conservative,
         )
         return cms
 
-    def _update_cms(self, item, count, cur, tot):
+    @property
+    def nbytes(self):
+        """Total memory used by the count-min sketches and hot keys, in bytes."""
+        names = self._SKETCHES + (self._HOT if self.hot_keys else ())
+        return sum(getattr(self, name).nbytes for name in names)
+
+    def memory_report(self):
+        """
+        Memory use and accuracy of every sketch, side by side, as a DataFrame
+        indexed by sketch.
+
+        Columns are the sketch's ``width``, ``depth``, counter ``dtype`` and
+        ``nbytes``, its relative ``error_rate`` and ``confidence``, the ``total``
+        of the counts it holds and the resulting ``error_bound``: with probability
+        ``confidence``, no count is overestimated by more. Conservative sketches
+        usually do much better than this bound.
+
+        Hot key tiers, if any, are listed with their ``width`` (the number of hot
+        keys) and ``nbytes`` only, as their counts are exact once admitted.
+        """
+        import pandas as pd
+
+        rows = {}
+        for name in self._SKETCHES:
+            cms = getattr(self, name)
+            rows[name.lstrip("_")] = {
+                "width": cms.width,
+                "depth": cms.depth,
+                "dtype": str(cms.table.dtype),
+                "nbytes": cms.nbytes,
+                "error_rate": cms.error_rate,
+                "confidence": cms.confidence,
+                "total": cms.total,
+                "error_bound": cms.error_bound(),
+            }
+        if self.hot_keys:
+            for name in self._HOT:
+                hot = getattr(self, name)
+                rows[name.lstrip("_")] = {
+                    "width": hot.capacity,
+                    "depth": 1,
+                    "dtype": str(hot.cur.dtype),
+                    "nbytes": hot.nbytes,
+                }
+        return pd.DataFrame.from_dict(rows, orient="index")
+
+    _SKETCHES = (
+        "_edge_tot",
+        "_src_tot",
+        "_dst_tot",
+        "_edge_cur",
+        "_src_cur",
+        "_dst_cur",
+    )
+    _HOT = ("_edge_hot", "_src_hot", "_dst_hot")
+
+    def _get_state(self):
+        arrays, sketches = {}, {}
+        for name in self._SKETCHES:
+            cms = getattr(self, name)
+            arrays[name.lstrip("_")] = cms.table
+            sketches[name] = (cms.seed, cms._scale, cms.total)
+
+        state = {
+            "sketches": sketches,
+            "_start": self._start,
+            "_last_update": self._last_update,
+            "now_": getattr(self, "now_", None),
+        }
+        if self.hot_keys:
+            state["hot"] = {
+                name: getattr(self, name)._get_state() for name in self._HOT
+            }
+        return arrays, state
+
+    def _set_state(self, arrays, state):
+        for name, (seed, scale, *total) in state["sketches"].items():
+            cms = CountMinSketch.from_table(
+                arrays[name.lstrip("_")],
+                seed=seed,
+                scale=scale,
+                conservative=self.conservative,
+                total=total[0] if total else None,
+            )
+            setattr(self, name, cms)
+
+        self._start = state["_start"]
+        self._last_update = state["_last_update"]
+        if state["now_"] is not None:
+            self.now_ = state["now_"]
+        for name, hot in state.get("hot", {}).items():
+            setattr(self, name, HotKeyTier._from_state(hot))
+
+    def _update_cms(self, item, count, cur, tot, hot=None):
+        if hot is not None:
+            hot.record(item, count)
+            slot = hot.slot(item)
+            if slot >= 0:
+                hot.add(slot, count)
+                return
         tot.add(item, count)
         cur.add(item, count)
 
-    @lru_cache(maxsize=40960)
+    def _query_cms(self, item, cur, tot, hot=None):
+        if hot is not None:
+            slot = hot.slot(item)
+            if slot >= 0:
+                return hot.cur[slot], hot.tot[slot]
+        return cur.query(item), tot.query(item)
+
+    def _add_cumulative(self, keys, count, cur, tot, hot=None):
+        if hot is None:
+            return cur.add_cumulative(keys, count), tot.add_cumulative(keys, count)
+        hot.record_batch(keys, count)
+        slots = hot.lookup(keys)
+        is_hot = slots >= 0
+        if not is_hot.any():
+            return cur.add_cumulative(keys, count), tot.add_cumulative(keys, count)
+
+        # Hot keys are counted exactly and never reach the sketches.
+        cold = ~is_hot
+        cur_est = np.empty(len(keys), dtype=np.float64)
+        tot_est = np.empty(len(keys), dtype=np.float64)
+        cur_est[cold] = cur.add_cumulative(keys[cold], count[cold])
+        tot_est[cold] = tot.add_cumulative(keys[cold], count[cold])
+        cur_est[is_hot], tot_est[is_hot] = hot.add_cumulative(
+            slots[is_hot], count[is_hot]
+        )
+        return cur_est, tot_est
+
     def _score(self, cur, tot):
         t = self.now_
         if tot == 0 or t <= 1:
             score = 0
         else:
-            score = (((cur - tot / t) * t) ** 2) / (tot * (t - 1))
+            diff = (cur - tot / t) * t
+            score = (diff * diff) / (tot * (t - 1))
         return score
 
+    def _score_batch(self, cur, tot):
+        return _chi_squared(cur, tot, self.now_)
+
     def _score_transform_raw(self, score):
         return score
 
-    @lru_cache(maxsize=40960)
     def _score_transform_log(self, score):
         return np.log1p(score)
 
-    @lru_cache(maxsize=40960)
     def _score_transform_pvalue(self, score):
-        return chi2.sf(score, df=1)
+        """
+        Survival function of the chi-squared distribution with one degree of
+        freedom, in the closed form ``erfc(sqrt(score / 2))``. This agrees with
+        ``scipy.stats.chi2.sf(score, df=1)`` to a relative error below 1e-12 for
+        every score whose p-value does not underflow (``score < ~1400``).
+        """
+        return erfc(np.sqrt(score / 2))
 
     def _update_edge(self, edge, count):
-        self._update_cms(edge, count, self._edge_cur, self._edge_tot)
+        self._update_cms(edge, count, self._edge_cur, self._edge_tot, self._edge_hot)
 
     def _update_src(self, node, count):
-        self._update_cms(node, count, self._src_cur, self._src_tot)
+        self._update_cms(node, count, self._src_cur, self._src_tot, self._src_hot)
 
     def _update_dst(self, node, count):
-        self._update_cms(node, count, self._dst_cur, self._dst_tot)
+        self._update_cms(node, count, self._dst_cur, self._dst_tot, self._dst_hot)
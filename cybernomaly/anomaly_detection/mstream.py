@@ -1,108 +1,349 @@
+from time import time
+
 import numpy as np
-from sklearn.decomposition import PCA, IncrementalPCA
-from sklearn.exceptions import NotFittedError
-from sklearn.utils.validation import FLOAT_DTYPES, check_is_fitted
 
 from cybernomaly.anomaly_detection.base import Monitor
+from cybernomaly.anomaly_detection.keys import KeyEncoder
+from cybernomaly.anomaly_detection.midas import _chi_squared
+from cybernomaly.anomaly_detection.sketch import CountMinSketch
+
+__all__ = ["MStream"]
+
+
+def _check_array(X):
+    # sklearn takes about a second to import, so it is only loaded once needed.
+    from sklearn.utils.validation import FLOAT_DTYPES, check_array
+
+    return check_array(np.atleast_2d(X), dtype=FLOAT_DTYPES)
 
 
 class MStream(Monitor):
-    def __init__(self, dimensionality_reduction=None, thresh=None, batch_size=None):
-        self.dimensionality_reduction = dimensionality_reduction or IncrementalPCA()
-        try:
-            if not callable(self.dimensionality_reduction.fit):
-                raise TypeError("fit attribute must be callable")
-            if not callable(self.dimensionality_reduction.transform):
-                raise TypeError("transform attribute must be callable")
-        except (TypeError, AttributeError):
-            raise ValueError(
-                "dimensionality_reduction parameter must be a valid sklearn "
-                f"transformer. Got '{dimensionality_reduction}' instead."
-            )
+    """
+    Anomaly detector for multi-aspect data streams using the MSTREAM [1]_
+    algorithm. Each record (row) is scored on how unusual each of its fields, and the
+    combination of all its fields, is in the current tick compared with the history
+    of the stream.
+
+    Categorical columns are feature-hashed. Numeric columns are optionally passed
+    through ``dimensionality_reduction``, min-max normalised on the fly and
+    bucketed. The whole record is hashed by combining the categorical values with a
+    random-hyperplane LSH signature of the numeric values. Every one of these hashes
+    is counted in a pair of count-min sketches (current tick, with temporal decay,
+    and all time), and the record score is the sum of ``log(1 + score)`` over them.
+
+    Batches are processed column by column with array operations, and within a
+    batch each record is scored immediately after its own update, exactly as if the
+    records were streamed one by one.
+
+    Parameters
+    ----------
+    dimensionality_reduction : sklearn transformer, default=None
+        Applied to the numeric columns before hashing (e.g. ``IncrementalPCA`` for
+        MSTREAM-PCA). Must be fitted with :meth:`fit` or :meth:`partial_fit` first.
+
+    thresh : float, default=None
+        Score above which a record is anomalous. Required by :meth:`detect` and
+        :meth:`update_detect`, but not to compute scores.
+
+    batch_size : int, default=None
+        Number of records buffered by :meth:`partial_fit` before fitting
+        ``dimensionality_reduction`` (with its ``partial_fit`` if it has one, or
+        else refitting it with ``fit``). The buffer is allocated once. Defaults to
+        five times the number of numeric columns.
+
+    categorical : array-like of int, default=None
+        Indices of the integer-coded categorical columns. All other columns are
+        numeric.
+
+    n_buckets : int, default=1024
+        Width of every count-min sketch, and number of buckets per numeric column.
+
+    depth : int, default=2
+        Depth of every count-min sketch.
+
+    record_bits : int, default=16
+        Number of hyperplanes in the LSH signature of a record's numeric values.
+
+    decay : float, default=0.5
+        Decay factor applied to the current counts at each tick.
+
+    ticksize : float, default=1
+        Tick length, in the units of the timestamps.
+
+    random_state : int, default=None
+        Seed for the LSH hyperplanes.
+
+    References
+    ----------
+    .. [1] MSTREAM: Fast Anomaly Detection in Multi-Aspect Streams
+           https://arxiv.org/abs/2009.08451
+    """
+
+    def __init__(
+        self,
+        dimensionality_reduction=None,
+        thresh=None,
+        batch_size=None,
+        categorical=None,
+        n_buckets=1024,
+        depth=2,
+        record_bits=16,
+        decay=0.5,
+        ticksize=1,
+        random_state=None,
+    ):
+        if dimensionality_reduction is not None:
+            try:
+                if not callable(dimensionality_reduction.fit):
+                    raise TypeError("fit attribute must be callable")
+                if not callable(dimensionality_reduction.transform):
+                    raise TypeError("transform attribute must be callable")
+            except (TypeError, AttributeError):
+                raise ValueError(
+                    "dimensionality_reduction parameter must be a valid sklearn "
+                    f"transformer. Got '{dimensionality_reduction}' instead."
+                )
+        self.dimensionality_reduction = dimensionality_reduction
 
         self.batch_size = batch_size
         self.thresh = thresh
+        self.categorical = categorical
+        self.n_buckets = n_buckets
+        self.depth = depth
 
-    def _check_X_y(self, X, y):
-        X = np.atleast_2d(X)
-        y = np.atleast_1d(y)
-        X, y = self._validate_data(
-            X, y,
-            reset=first_pass,
-            estimator=self,
-            dtype=FLOAT_DTYPES,
-            force_all_finite="allow-nan",
-        )
-        return X, y
-
-    def partial_fit(self, X, y):
-        X, y = self._check_X_y(X, y)
-        first_pass = self._check_partial_fit_first_call()
-        if first_pass:
-            self._init_setup(X, y)
+        if not (0 < record_bits <= 64):
+            raise ValueError("record_bits must be in the range (0, 64]")
+        self.record_bits = record_bits
 
-        self._extend_fit_buffer(X, y)
+        if not (0 <= decay <= 1):
+            raise ValueError(f"Decay factor must be in the range [0, 1]")
+        self.decay = decay
+        self.ticksize = ticksize
+        self.random_state = random_state
 
-        if self._has_partial_fit and self._get_fit_buffer_size() == self.batch_size_:
-            self.dimensionality_reduction.partial_fit(self._X_fit, self._y_fit)
-            self._reset_fit_buffer()
+    def _check_X(self, X):
+        X = _check_array(X)
+        if self._check_partial_fit_first_call():
+            self._init_setup(X)
+        elif X.shape[1] != self.n_features_in_:
+            raise ValueError(
+                f"X has {X.shape[1]} features, but {type(self).__name__} is "
+                f"expecting {self.n_features_in_} features as input."
+            )
+        return X
 
+    def partial_fit(self, X, y=None):
+        X = self._check_X(X)
+        if self.dimensionality_reduction is None:
+            return self
 
+        self._extend_fit_buffer(X[:, self._numeric])
         return self
 
-    def _init_setup(self, X, y):
-        self._reset_fit_buffer()
+    def _init_setup(self, X):
         n_samples, n_features = X.shape
+        self.n_features_in_ = n_features
+
+        categorical = np.zeros(n_features, dtype=bool)
+        if self.categorical is not None:
+            categorical[self.categorical] = True
+        self._categorical = np.flatnonzero(categorical)
+        self._numeric = np.flatnonzero(~categorical)
+
         self.thresh_ = self.thresh
-        self.batch_size_ = self.batch_size if self.batch_size is not None else 5 * n_features
+        self.batch_size_ = (
+            self.batch_size if self.batch_size is not None else 5 * len(self._numeric)
+        )
         self._has_partial_fit = hasattr(self.dimensionality_reduction, "partial_fit")
+        self._X_fit = None
+        if self.dimensionality_reduction is not None:
+            self._X_fit = np.empty(
+                (max(self.batch_size_, 1), len(self._numeric)), dtype=np.float64
+            )
         self._reset_fit_buffer()
 
+        # Sketches are sized once the number of (reduced) numeric features is known.
+        self._cur = None
+        self._tot = None
+        self._start = None
+        self._last_update = None
+
     def _reset_fit_buffer(self):
-        self._X_fit = None
-        self._y_fit = None
+        self._n_fit = 0
 
     def _get_fit_buffer_size(self):
-        return len(self._X_fit)
+        return self._n_fit
 
-    def _extend_fit_buffer(self, X, y):
-        self._X_fit = np.vstack((self._X_fit, X)) if self._X_fit else np.copy(X)
-        self._y_fit = np.vstack((self._y_fit, y)) if self._X_fit else np.copy(X)
+    def _extend_fit_buffer(self, X):
+        """
+        Append ``X`` to the preallocated fit buffer, fitting
+        ``dimensionality_reduction`` on each full batch. Whole batches are fitted
+        directly from slices of ``X`` when the buffer is empty, so only the
+        remainders are ever copied.
+        """
+        capacity = len(self._X_fit)
+        start, n_samples = 0, len(X)
+        while start < n_samples:
+            if self._n_fit == 0 and n_samples - start >= capacity:
+                self._fit_batch(X[start : start + capacity])
+                start += capacity
+                continue
 
-    def fit(self, X, y):
-        X, y = self._check_X_y(X, y)
-        self._init_setup(X, y)
-        self.dimensionality_reduction.fit(X, y)
+            n_copy = min(capacity - self._n_fit, n_samples - start)
+            self._X_fit[self._n_fit : self._n_fit + n_copy] = X[start : start + n_copy]
+            self._n_fit += n_copy
+            start += n_copy
+            if self._n_fit == capacity:
+                self._fit_batch(self._X_fit)
+                self._reset_fit_buffer()
+
+    def _fit_batch(self, X):
+        if self._has_partial_fit:
+            self.dimensionality_reduction.partial_fit(X)
+        else:
+            self.dimensionality_reduction.fit(X)
+
+    def fit(self, X, y=None):
+        X = _check_array(X)
+        self._init_setup(X)
+        if self.dimensionality_reduction is not None:
+            self.dimensionality_reduction.fit(X[:, self._numeric], y)
         return self
 
-    def detect_score(self, X):
+    def _flush_fit_buffer(self):
         if self._get_fit_buffer_size() > 0:
-            if self._has_partial_fit:
-                self.dimensionality_reduction.partial_fit(self._X_fit, self._y_fit)
-            else:
-                self.dimensionality_reduction.fit(self._X_fit, self._y_fit)
+            self._fit_batch(self._X_fit[: self._n_fit])
             self._reset_fit_buffer()
 
-        Xtr = self.dimensionality_reduction.transform(X)
-        score = self._mstream(Xtr)
-        return score
+    def _init_sketches(self, n_numeric):
+        n_sketches = n_numeric + len(self._categorical) + 1
+        self._cur = [
+            CountMinSketch(self.n_buckets, self.depth) for _ in range(n_sketches)
+        ]
+        self._tot = [
+            CountMinSketch(self.n_buckets, self.depth) for _ in range(n_sketches)
+        ]
+        self._min = np.full(n_numeric, np.inf)
+        self._max = np.full(n_numeric, -np.inf)
+        rng = np.random.RandomState(self.random_state)
+        self._hyperplanes = rng.standard_normal((n_numeric, self.record_bits))
+
+    def _hash_records(self, X, update):
+        """
+        Hash each column, and each record as a whole, of the batch ``X``. Returns a
+        list of uint64 key arrays, one per sketch.
+        """
+        numeric = X[:, self._numeric]
+        if self.dimensionality_reduction is not None:
+            self._flush_fit_buffer()
+            numeric = self.dimensionality_reduction.transform(numeric)
+        if self._cur is None:
+            self._init_sketches(numeric.shape[1])
+
+        # Streaming min-max normalisation: each record is normalised with the
+        # range of the stream up to and including itself.
+        if update:
+            lo = np.minimum.accumulate(np.vstack((self._min, numeric)), axis=0)[1:]
+            hi = np.maximum.accumulate(np.vstack((self._max, numeric)), axis=0)[1:]
+            self._min, self._max = lo[-1], hi[-1]
+        else:
+            lo, hi = self._min, self._max
+        span = hi - lo
+        with np.errstate(divide="ignore", invalid="ignore"):
+            norm = np.where(span > 0, (numeric - lo) / span, 0.0)
+        norm = np.clip(norm, 0, 1)
+
+        buckets = np.minimum(norm * self.n_buckets, self.n_buckets - 1)
+        keys = list(buckets.astype(np.uint64).T)
+
+        record = np.zeros(len(X), dtype=np.uint64)
+        for col in self._categorical:
+            value = X[:, col].astype(np.int64).view(np.uint64)
+            keys.append(value)
+            record = KeyEncoder.encode_edge(record, value)
 
-    def _mstream(self, X):
-        pass
+        bits = ((norm - 0.5) @ self._hyperplanes) > 0
+        weights = np.uint64(1) << np.arange(self.record_bits, dtype=np.uint64)
+        signature = (bits.astype(np.uint64) * weights).sum(axis=1, dtype=np.uint64)
+        keys.append(KeyEncoder.encode_edge(record, signature))
+        return keys
+
+    def _advance(self, t):
+        if self._start is None:
+            self._start = t - 1
+
+        t -= self._start
+        self.now_ = t
+
+        if self._last_update is None:
+            self._last_update = t
+
+        if t > self._last_update:
+            for cms in self._cur:
+                if self.decay:
+                    cms.decay(
+                        self.decay ** round((t - self._last_update) / self.ticksize)
+                    )
+                else:
+                    cms.clear()
+            self._last_update = t
+
+    def _mstream(self, X, t=None, update=True):
+        keys = self._hash_records(X, update)
+        n = len(X)
+        scores = np.zeros(n, dtype=np.float64)
+        if not update:
+            for key, cur, tot in zip(keys, self._cur, self._tot):
+                scores += np.log1p(
+                    _chi_squared(
+                        cur.query(key), tot.query(key), getattr(self, "now_", 0)
+                    )
+                )
+            return scores
+
+        t = np.broadcast_to(
+            np.asarray(t if t is not None else time(), dtype=np.float64), (n,)
+        )
+        t = self._snap_time(t, self.ticksize)
+        bounds = np.r_[0, np.flatnonzero(np.diff(t)) + 1, n]
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            self._advance(t[start])
+            run = slice(start, stop)
+            for key, cur, tot in zip(keys, self._cur, self._tot):
+                scores[run] += np.log1p(
+                    _chi_squared(
+                        cur.add_cumulative(key[run]),
+                        tot.add_cumulative(key[run]),
+                        self.now_,
+                    )
+                )
+        return scores
+
+    def detect_score(self, X):
+        X = self._check_X(X)
+        return self._mstream(X, update=False)
+
+    def _threshold(self, scores):
+        if self.thresh_ is None:
+            raise ValueError(
+                "thresh must be set to detect anomalies; use detect_score or "
+                "update_detect_score to get scores without a threshold."
+            )
+        return scores > self.thresh_
 
     def detect(self, X):
-        return self.detect_score(X) > self.thresh_
+        return self._threshold(self.detect_score(X))
 
-    def update(self, X):
-        pass
+    def update(self, X, t=None):
+        self.update_detect_score(X, t)
+        return self
 
-    def update_detect(self, X):
-        self.update(X)
-        return self.detect(X)
+    def update_detect(self, X, t=None):
+        return self._threshold(self.update_detect_score(X, t))
 
-    def update_detect_score(self, X):
-        self.update(X)
-        return self.detect_score(X)
+    def update_detect_score(self, X, t=None):
+        X = self._check_X(X)
+        return self._mstream(X, t)
 
     def _check_partial_fit_first_call(self):
-        return hasattr(self, "_X_fit")
+        return not hasattr(self, "n_features_in_")
@@ -0,0 +1,286 @@
+import multiprocessing
+import os
+import pickle
+from time import time
+
+import numpy as np
+
+__all__ = ["ShardedMIDAS_R"]
+
+_KINDS = ("edge", "src", "dst")
+
+
+class _Replica:
+    """
+    A worker's copy of the model. Every replica applies the same additions in the
+    same order, so all of them hold identical sketches at the end of every tick.
+    """
+
+    def __init__(self, cls, params, arrays, state):
+        self.model = model = cls(**params)
+        model._set_state(arrays, state)
+        self.sketches = [
+            (getattr(model, f"_{kind}_cur"), getattr(model, f"_{kind}_tot"))
+            for kind in _KINDS
+        ]
+        self._pending = None
+
+    def delta(self, keys, count):
+        # The current and total sketches of a kind share their shape and seed,
+        # and so the counters an edge touches.
+        return [tot._delta(key, count) for key, (_, tot) in zip(keys, self.sketches)]
+
+    def apply(self, deltas):
+        for (cur, tot), delta in zip(self.sketches, deltas):
+            cur._add_delta(*delta)
+            tot._add_delta(*delta)
+
+    def score(self, keys, count, deltas):
+        """
+        Score a shard against the current state, then leave the sketches as if
+        ``deltas`` (the shard's own) had been applied like any other shard's.
+        """
+        saved = [
+            [(cms.table.reshape(-1)[cells], cms._total) for cms in sketches]
+            for sketches, (cells, _, _) in zip(self.sketches, deltas)
+        ]
+        scores = self.model._update_detect_score_batch(*keys, count)
+        for sketches, kind_saved, (cells, _, _) in zip(self.sketches, saved, deltas):
+            for cms, (values, total) in zip(sketches, kind_saved):
+                cms.table.reshape(-1)[cells] = values
+                cms._total = total
+        self.apply(deltas)
+        return scores
+
+    def run(self, ticks):
+        """Score whole ticks, returning the scores and the deltas of every tick."""
+        scores, deltas = [], []
+        for t, src, dst, count in ticks:
+            self.model._advance(t)
+            keys = self.model._format_keys_batch(src, dst)
+            delta = self.delta(keys, count)
+            scores.append(self.score(keys, count, delta))
+            deltas.append((t, delta))
+        return np.concatenate(scores), pickle.dumps(deltas, pickle.HIGHEST_PROTOCOL)
+
+    def replay(self, blob):
+        """Apply the ticks scored by another replica with :meth:`run`."""
+        for t, delta in pickle.loads(blob):
+            self.model._advance(t)
+            self.apply(delta)
+
+    def shard(self, t, src, dst, count):
+        """Start a sharded tick, returning the delta of this shard."""
+        self.model._advance(t)
+        keys = self.model._format_keys_batch(src, dst)
+        delta = self.delta(keys, count)
+        self._pending = keys, count, delta
+        return pickle.dumps(delta, pickle.HIGHEST_PROTOCOL)
+
+    def merge(self, t, index, blobs):
+        """
+        Finish a sharded tick: apply the deltas of the shards before this one,
+        score this one (if any) and apply the deltas of the shards after it.
+        """
+        self.model._advance(t)
+        scores = None
+        for i, blob in enumerate(blobs):
+            if i == index:
+                keys, count, delta = self._pending
+                scores = self.score(keys, count, delta)
+            else:
+                self.apply(pickle.loads(blob))
+        self._pending = None
+        return scores
+
+
+def _worker(conn, cls, params, arrays, state):
+    replica = _Replica(cls, params, arrays, state)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        cmd, args = msg
+        if cmd == "run":
+            conn.send(replica.run(args))
+        elif cmd == "replay":
+            replica.replay(args)
+        elif cmd == "shard":
+            conn.send_bytes(replica.shard(*args))
+        elif cmd == "merge":
+            scores = replica.merge(*args)
+            if scores is not None:
+                conn.send(scores)
+        elif cmd == "state":
+            conn.send(replica.model._get_state())
+    conn.close()
+
+
+class ShardedMIDAS_R:
+    """
+    Process-parallel driver for :class:`MIDAS_R`, producing the same scores as a
+    single-process :meth:`MIDAS_R.update_detect_score_batch` call.
+
+    Every one of ``n_jobs`` worker processes keeps its own replica of the model's
+    sketches, which share their hash family. Each tick with enough edges to give
+    at least two workers ``min_shard_size`` edges each is cut into contiguous
+    shards, one per worker, which encode their shard's keys and send back a
+    sparse delta of the counters it adds to (at most the size of the sketches).
+    Every worker then sums the deltas of the earlier shards into its sketches,
+    which is exactly the state a single process would have seen, scores its own
+    shard, and sums in the deltas of the later shards, leaving all replicas equal
+    at the tick boundary.
+
+    Runs of smaller ticks are scored whole by one worker, while the others apply
+    their deltas. The calling process only cuts the stream into shards and relays
+    deltas, without touching any sketch.
+
+    The deltas sum the counts of a shard before they are added to a counter,
+    whereas a single process adds them one at a time. Both give the same result
+    as long as the counters hold their sums exactly, as with the default float64
+    sketches, integer counts and a ``decay`` of 0.5 (or 0 or 1). With ``compact``
+    sketches or other decay factors, scores can differ by rounding.
+
+    Scaling is limited by the replication: every worker applies the deltas of all
+    the other shards, so the merge cost of a tick grows with ``n_jobs``. Ticks
+    with fewer than ``2 * min_shard_size`` edges are scored by one worker alone,
+    and cost more than in a single process, as the others must replay them.
+    Speedups therefore need ticks of many times ``min_shard_size`` edges, and
+    several cores: on a single core the workers only add work (see
+    ``benchmarks/parallel_midas.py``).
+
+    Parameters
+    ----------
+    model : MIDAS_R
+        Detector to start from. Its state is updated from the workers when the
+        driver is closed (or by :meth:`sync`), after which it can be used directly
+        again.
+
+    n_jobs : int, default=None
+        Number of worker processes. Defaults to the number of CPUs.
+
+    min_shard_size : int, default=5000
+        Smallest number of edges per worker for a tick to be sharded. Lower values
+        shard more ticks, at the cost of a round of messages per tick.
+    """
+
+    def __init__(self, model, n_jobs=None, min_shard_size=5000):
+        if model.conservative:
+            # Conservative updates depend on the state left by every earlier edge,
+            # so shards cannot be added independently.
+            raise ValueError("ShardedMIDAS_R does not support conservative sketches.")
+        if model.hot_keys:
+            # The hot set changes with the counts of the whole tick, which no
+            # single shard sees.
+            raise ValueError("ShardedMIDAS_R does not support hot_keys.")
+        self.model = model
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.min_shard_size = min_shard_size
+        self._conns = []
+        self._procs = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        if self._procs:
+            return
+        cls, params = type(self.model), self.model.get_params(deep=False)
+        arrays, state = self.model._get_state()
+        for _ in range(self.n_jobs):
+            parent, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(
+                target=_worker,
+                args=(child, cls, params, arrays, state),
+                daemon=True,
+            )
+            proc.start()
+            child.close()
+            self._conns.append(parent)
+            self._procs.append(proc)
+
+    def sync(self):
+        """Copy the state of the workers into :attr:`model`."""
+        if not self._conns:
+            return
+        self._conns[0].send(("state", None))
+        self.model._set_state(*self._conns[0].recv())
+
+    def close(self):
+        if not self._procs:
+            return
+        self.sync()
+        for conn in self._conns:
+            conn.send(None)
+            conn.close()
+        for proc in self._procs:
+            proc.join()
+        self._conns, self._procs = [], []
+
+    def update_detect_score_batch(self, src, dst=None, count=1, t=None):
+        """
+        Same as :meth:`MIDAS_R.update_detect_score_batch`, but parallelised across
+        the worker processes.
+        """
+        self.start()
+        if dst is None:
+            frame = src
+            src, dst = np.asarray(frame["src"]), np.asarray(frame["dst"])
+            if "t" in frame:
+                t = np.asarray(frame["t"])
+            if "count" in frame:
+                count = np.asarray(frame["count"])
+
+        src, dst = np.asarray(src), np.asarray(dst)
+        n = len(src)
+        if n == 0:
+            return np.zeros(0, dtype=np.float64)
+        model = self.model
+        count = np.broadcast_to(np.asarray(count, dtype=np.float64), (n,))
+        t = np.broadcast_to(
+            np.asarray(t if t is not None else time(), dtype=np.float64), (n,)
+        )
+        t = model._snap_time(t, model.ticksize)
+
+        scores = np.empty(n, dtype=np.float64)
+        bounds = np.r_[0, np.flatnonzero(np.diff(t)) + 1, n]
+        run = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            n_shards = min(self.n_jobs, (stop - start) // self.min_shard_size)
+            if n_shards < 2:
+                run.append((start, stop))
+                continue
+            self._score_run(run, t, src, dst, count, scores)
+            run = []
+            self._score_sharded(start, stop, n_shards, t, src, dst, count, scores)
+        self._score_run(run, t, src, dst, count, scores)
+        return scores
+
+    def _score_run(self, run, t, src, dst, count, scores):
+        if not run:
+            return
+        first, others = self._conns[0], self._conns[1:]
+        ticks = [(t[a], src[a:b], dst[a:b], count[a:b]) for a, b in run]
+        first.send(("run", ticks))
+        run_scores, blob = first.recv()
+        for conn in others:
+            conn.send(("replay", blob))
+        scores[run[0][0] : run[-1][1]] = run_scores
+
+    def _score_sharded(self, start, stop, n_shards, t, src, dst, count, scores):
+        tick = t[start]
+        shards = np.array_split(np.arange(start, stop), n_shards)
+        conns = self._conns[:n_shards]
+        for conn, shard in zip(conns, shards):
+            s = slice(shard[0], shard[-1] + 1)
+            conn.send(("shard", (tick, src[s], dst[s], count[s])))
+        # The deltas are relayed as they were pickled by the workers.
+        blobs = [conn.recv_bytes() for conn in conns]
+        for i, conn in enumerate(self._conns):
+            conn.send(("merge", (tick, i if i < n_shards else None, blobs)))
+        for conn, shard in zip(conns, shards):
+            scores[shard[0] : shard[-1] + 1] = conn.recv()
@@ -0,0 +1,169 @@
+import heapq
+import os
+
+import numpy as np
+
+__all__ = ["ResultSink"]
+
+_COLUMNS = ["t", "src", "dst", "score"]
+
+
+class ResultSink:
+    """
+    Memory-bounded collector of scored edges.
+
+    Rather than keeping every result, the sink keeps the ``k`` highest scoring
+    edges in a heap and the highest score of every tick with results. Optionally,
+    all results are also spilled to disk as they arrive, so the full set never has
+    to fit in memory.
+
+    Parameters
+    ----------
+    k : int, default=20
+        Number of top scoring edges to keep.
+
+    ticksize : float, default=1
+        Tick length for the per-tick maximum, in the units of the timestamps.
+        Timestamps are rounded to a multiple of it, as detectors do.
+
+    spill : str, default=None
+        Where to write every result. Paths ending in ``.parquet`` get a Parquet
+        file with one row group per batch (requires ``pyarrow``), and paths ending
+        in ``.csv`` are appended to batch by batch. Any other path is used as a
+        directory of ``part-NNNNNN.npz`` files, one per batch, with one array per
+        column.
+    """
+
+    def __init__(self, k=20, ticksize=1, spill=None):
+        self.k = k
+        self.ticksize = ticksize
+        self.spill = spill
+        self.n_results = 0
+
+        self._heap = []
+        self._tick_max = {}
+        self._writer = None
+        self._n_parts = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, t, src, dst, score):
+        """Record a batch of results, given as equal-length arrays."""
+        t = np.asarray(t)
+        score = np.asarray(score, dtype=np.float64)
+        if not len(score):
+            return
+        self._add_top(t, src, dst, score)
+        self._add_ticks(t, score)
+        if self.spill is not None:
+            self._write(t, src, dst, score)
+        self.n_results += len(score)
+
+    def _add_top(self, t, src, dst, score):
+        # Only the batch's own top k can enter the heap. Items are keyed by score
+        # and then by (negated) result number, so ties go to the earliest result.
+        if len(score) > self.k:
+            candidates = np.argpartition(score, -self.k)[-self.k :]
+        else:
+            candidates = np.arange(len(score))
+        heap, push = self._heap, heapq.heappush
+        for i in candidates[np.argsort(-score[candidates], kind="stable")]:
+            item = (score[i], -(self.n_results + i), t[i], src[i], dst[i])
+            if len(heap) < self.k:
+                push(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+    def _add_ticks(self, t, score):
+        # Only the ticks present are stored, so sparse or outlying timestamps cost
+        # no more than dense ones.
+        ticks = np.round(t / self.ticksize).astype(np.int64)
+        order = np.argsort(ticks, kind="stable")
+        unique, first = np.unique(ticks[order], return_index=True)
+        maxima = np.maximum.reduceat(score[order], first)
+
+        tick_max = self._tick_max
+        for tick, best in zip(unique.tolist(), maxima.tolist()):
+            if best > tick_max.get(tick, -np.inf):
+                tick_max[tick] = best
+
+    def _write(self, t, src, dst, score):
+        import pandas as pd
+
+        frame = pd.DataFrame(
+            {"t": t, "src": src, "dst": dst, "score": score},
+            index=pd.RangeIndex(self.n_results, self.n_results + len(score)),
+        )
+        if self.spill.endswith(".parquet"):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.spill, table.schema)
+            self._writer.write_table(table)
+        elif self.spill.endswith(".csv"):
+            first = self._n_parts == 0
+            frame.to_csv(self.spill, mode="w" if first else "a", header=first)
+        else:
+            os.makedirs(self.spill, exist_ok=True)
+            np.savez(
+                os.path.join(self.spill, f"part-{self._n_parts:06d}.npz"),
+                t=np.asarray(t),
+                src=np.asarray(src, dtype=str),
+                dst=np.asarray(dst, dtype=str),
+                score=score,
+            )
+        self._n_parts += 1
+
+    def close(self):
+        """Finish writing the spill file."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def top(self):
+        """Return the top scoring edges, highest first, as a DataFrame."""
+        import pandas as pd
+
+        rows = sorted(self._heap, reverse=True)
+        return pd.DataFrame(
+            [(t, src, dst, score) for score, _, t, src, dst in rows],
+            index=[-row for _, row, _, _, _ in rows],
+            columns=_COLUMNS,
+        )
+
+    def tick_max(self):
+        """
+        Return the highest score of every tick with results, as a Series indexed by
+        the time of the tick.
+        """
+        import pandas as pd
+
+        ticks = sorted(self._tick_max)
+        return pd.Series(
+            [self._tick_max[tick] for tick in ticks],
+            index=pd.Index(np.array(ticks, dtype=np.int64) * self.ticksize, name="t"),
+            name="score",
+            dtype=np.float64,
+        )
+
+    @staticmethod
+    def read_spill(path):
+        """Load results spilled to ``path`` as a DataFrame."""
+        import pandas as pd
+
+        if path.endswith(".parquet"):
+            return pd.read_parquet(path)
+        if path.endswith(".csv"):
+            return pd.read_csv(path, index_col=0)
+        parts = []
+        for name in sorted(os.listdir(path)):
+            if name.startswith("part-") and name.endswith(".npz"):
+                with np.load(os.path.join(path, name)) as part:
+                    parts.append(pd.DataFrame({col: part[col] for col in _COLUMNS}))
+        return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
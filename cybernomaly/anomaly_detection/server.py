@@ -0,0 +1,509 @@
+import asyncio
+import os
+import socket
+import stat
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time
+
+import numpy as np
+
+__all__ = ["RECORD_DTYPE", "ScoringClient", "ScoringServer"]
+
+# Binary framing: fixed-size little-endian records in, one float64 score out per
+# record. A NaN time stands for the time the record was received.
+RECORD_DTYPE = np.dtype(
+    [("src", "<u8"), ("dst", "<u8"), ("t", "<f8"), ("count", "<f8")]
+)
+SCORE_DTYPE = np.dtype("<f8")
+
+FRAMINGS = ("line", "binary")
+
+
+class _Request:
+    """Records read from a connection in one go, scored together."""
+
+    __slots__ = ("src", "dst", "t", "count", "valid", "received", "future")
+
+    def __init__(self, src, dst, t, count, valid=None):
+        self.src = src
+        self.dst = dst
+        self.t = t
+        self.count = count
+        self.valid = valid
+        self.received = perf_counter()
+        self.future = None
+
+    def __len__(self):
+        return len(self.t)
+
+
+def _parse_lines(lines, now):
+    src, dst = [], []
+    t = np.full(len(lines), now)
+    count = np.ones(len(lines))
+    valid = np.zeros(len(lines), dtype=bool)
+    for i, line in enumerate(lines):
+        fields = line.split()
+        if not 2 <= len(fields) <= 4:
+            continue
+        try:
+            # UnicodeDecodeError is a ValueError too.
+            s, d = fields[0].decode(), fields[1].decode()
+            if len(fields) > 2 and fields[2] != b"-":
+                t[i] = float(fields[2])
+            if len(fields) > 3:
+                count[i] = float(fields[3])
+        except ValueError:
+            continue
+        valid[i] = True
+        src.append(s)
+        dst.append(d)
+    src, dst = np.array(src, dtype=object), np.array(dst, dtype=object)
+    return _Request(src, dst, t[valid], count[valid], valid)
+
+
+def _parse_records(data, now):
+    records = np.frombuffer(data, dtype=RECORD_DTYPE)
+    t = records["t"].copy()
+    t[np.isnan(t)] = now
+    return _Request(records["src"].copy(), records["dst"].copy(), t, records["count"])
+
+
+class ScoringServer:
+    """
+    Long-running server scoring edges with a shared detector, for collectors in
+    other processes.
+
+    Clients connect to a Unix domain socket or a TCP port and send edge records,
+    either as text lines or as binary records (see ``framing``). Each connection
+    gets one score per record, in order, and can keep sending while earlier
+    records are being scored.
+
+    Records from all connections are gathered into micro-batches of up to
+    ``max_batch`` records, scored with the detector's
+    ``update_detect_score_batch`` in a worker thread. While one batch is scored,
+    the next one fills up with whatever arrives, so batches grow with the load
+    without delaying records when the server is idle. ``max_delay`` additionally
+    holds a batch back to wait for more records.
+
+    Parameters
+    ----------
+    detector : Monitor
+        Detector with an ``update_detect_score_batch(src, dst, count=..., t=...)``
+        method, e.g. :class:`MIDAS_R`.
+
+    path : str, default=None
+        Unix domain socket to listen on. A stale socket file at this path is
+        replaced. If None, listen on ``host`` and ``port`` instead.
+
+    host : str, default="127.0.0.1"
+        TCP address to listen on.
+
+    port : int, default=0
+        TCP port to listen on. With 0, a free port is picked (see ``address``).
+
+    framing : {"line", "binary"}, default="line"
+        With ``"line"``, every request is a line ``src dst [t [count]]`` of
+        whitespace-separated fields, where nodes are strings and a ``t`` of ``-``
+        (or none) stands for the time of arrival. Each gets a line with its
+        score, or ``nan`` for a malformed line. With ``"binary"``, requests are
+        records of :data:`RECORD_DTYPE` (integer nodes, with a NaN ``t`` for the
+        time of arrival), and each gets a little-endian float64 score.
+
+    max_batch : int, default=4096
+        Largest number of records scored at once.
+
+    max_delay : float, default=0.0
+        Seconds to wait for more records before scoring a batch that is not
+        full.
+
+    max_line : int, default=4096
+        Longest line, in bytes, accepted with ``"line"`` framing. Longer lines are
+        discarded as they arrive, rather than buffered, and get a ``nan`` score.
+
+    Attributes
+    ----------
+    address : str or tuple
+        Address the server listens on, once started.
+
+    records : int
+        Number of records scored.
+
+    batches : int
+        Number of batches scored.
+    """
+
+    def __init__(
+        self,
+        detector,
+        path=None,
+        host="127.0.0.1",
+        port=0,
+        framing="line",
+        max_batch=4096,
+        max_delay=0.0,
+        max_line=4096,
+        bufsize=65536,
+        max_pending=64,
+        max_latencies=100000,
+    ):
+        if framing not in FRAMINGS:
+            raise ValueError(
+                f"Unsupported framing '{framing}'. Must be one of {FRAMINGS}"
+            )
+        self.detector = detector
+        self.path = path
+        self.host = host
+        self.port = port
+        self.framing = framing
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_line = max_line
+        self.bufsize = bufsize
+        self.max_pending = max_pending
+
+        self.address = None
+        self.connections = 0
+        self.records = 0
+        self.batches = 0
+        self._latencies = deque(maxlen=max_latencies)
+        self._started = None
+        self._server = None
+        self._queue = None
+        self._batcher = None
+        self._executor = None
+        self._clients = {}
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def start(self):
+        """Start listening and scoring."""
+        if self._server is not None:
+            return
+        if self.path is not None:
+            if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+                os.unlink(self.path)
+            self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+            self.address = self.path
+        else:
+            self._server = await asyncio.start_server(
+                self._handle, host=self.host, port=self.port
+            )
+            self.address = self._server.sockets[0].getsockname()[:2]
+
+        # The detector is only ever used by one thread at a time.
+        self._executor = ThreadPoolExecutor(1)
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.ensure_future(self._batch_loop())
+        self._started = perf_counter()
+
+    async def serve_forever(self):
+        """Start if needed, and serve until cancelled."""
+        await self.start()
+        await self._server.serve_forever()
+
+    async def close(self, timeout=5.0):
+        """
+        Stop listening, and finish scoring the records already received.
+
+        Connected clients are sent the scores of the records already received,
+        and disconnected. Those that do not take their scores within ``timeout``
+        seconds are dropped.
+        """
+        if self._server is None:
+            return
+        self._server.close()
+        # Stop reading from the clients, as if they had all hung up, so that their
+        # handlers reply and close the connections. Since Python 3.12, wait_closed
+        # waits for every connection to be closed.
+        for reader, writer in self._clients.values():
+            writer.transport.pause_reading()
+            reader.feed_eof()
+        if self._clients:
+            _, stuck = await asyncio.wait(list(self._clients), timeout=timeout)
+            for task in stuck:
+                self._clients[task][1].transport.abort()
+                task.cancel()
+            await asyncio.gather(*stuck, return_exceptions=True)
+        await self._server.wait_closed()
+        await self._queue.put(None)
+        await self._batcher
+        self._executor.shutdown()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = None
+
+    def stats(self):
+        """
+        Counters of the server: open ``connections``, ``records`` and ``batches``
+        scored, the mean ``batch_size``, ``throughput`` in records per second since
+        the start, and the median and 99th percentile ``latency_p50`` and
+        ``latency_p99`` of recent requests, in seconds from receipt to reply.
+        """
+        elapsed = perf_counter() - self._started if self._started else 0.0
+        if self._latencies:
+            p50, p99 = np.percentile(self._latencies, [50, 99])
+        else:
+            p50 = p99 = np.nan
+        return {
+            "connections": self.connections,
+            "records": self.records,
+            "batches": self.batches,
+            "batch_size": self.records / self.batches if self.batches else 0.0,
+            "throughput": self.records / elapsed if elapsed else 0.0,
+            "latency_p50": p50,
+            "latency_p99": p99,
+        }
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self._clients[asyncio.current_task()] = reader, writer
+        pending = asyncio.Queue(self.max_pending)
+        sender = asyncio.ensure_future(self._send(writer, pending))
+        buf = b""
+        # Whether the rest of an overlong line is being discarded.
+        discarding = False
+        try:
+            while True:
+                data = await reader.read(self.bufsize)
+                if not data:
+                    # A last line may be missing its newline.
+                    if self.framing == "line" and (buf.strip() or discarding):
+                        await self._submit(pending, _parse_lines([buf], time()))
+                    break
+                buf += data
+                if self.framing == "line":
+                    lines = buf.split(b"\n")
+                    buf = lines.pop()
+                    if discarding and lines:
+                        # The end of the overlong line, scored as malformed.
+                        lines[0], discarding = b"", False
+                    if discarding or len(buf) > self.max_line:
+                        buf, discarding = b"", True
+                    if any(len(line) > self.max_line for line in lines):
+                        lines = [b"" if len(ln) > self.max_line else ln for ln in lines]
+                    if lines:
+                        await self._submit(pending, _parse_lines(lines, time()))
+                else:
+                    end = len(buf) - len(buf) % RECORD_DTYPE.itemsize
+                    if end:
+                        await self._submit(pending, _parse_records(buf[:end], time()))
+                        buf = buf[end:]
+        except ConnectionError:
+            pass
+        finally:
+            await pending.put(None)
+            try:
+                await sender
+            except ConnectionError:
+                pass
+            finally:
+                self.connections -= 1
+                del self._clients[asyncio.current_task()]
+                writer.close()
+
+    async def _submit(self, pending, request):
+        request.future = asyncio.get_running_loop().create_future()
+        await pending.put(request)
+        await self._queue.put(request)
+
+    async def _send(self, writer, pending):
+        error = None
+        while True:
+            request = await pending.get()
+            if request is None:
+                break
+            if error is not None:
+                continue
+            try:
+                scores = await request.future
+                if self.framing == "line":
+                    writer.write(
+                        "".join(f"{score!r}\n" for score in scores.tolist()).encode()
+                    )
+                else:
+                    writer.write(scores.astype(SCORE_DTYPE).tobytes())
+                await writer.drain()
+            except Exception as exc:
+                # Drop the connection, but keep taking requests so that the reader
+                # never blocks on a full queue.
+                error = exc
+                writer.close()
+                continue
+            self._latencies.append(perf_counter() - request.received)
+        if error is not None:
+            raise error
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            request = await self._queue.get()
+            if request is None:
+                break
+            batch, size = [request], len(request)
+            deadline = loop.time() + self.max_delay
+            while size < self.max_batch:
+                if not self._queue.empty():
+                    request = self._queue.get_nowait()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if request is None:
+                    closing = True
+                    break
+                batch.append(request)
+                size += len(request)
+
+            try:
+                scores = await loop.run_in_executor(self._executor, self._score, batch)
+            except Exception as exc:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(exc)
+                continue
+            # The futures of dropped connections may have been cancelled.
+            for request, score in zip(batch, scores):
+                if not request.future.done():
+                    request.future.set_result(score)
+
+    def _score(self, batch):
+        # Runs in the worker thread.
+        src = np.concatenate([r.src for r in batch])
+        dst = np.concatenate([r.dst for r in batch])
+        t = np.concatenate([r.t for r in batch])
+        count = np.concatenate([r.count for r in batch])
+        if len(t):
+            scores = self.detector.update_detect_score_batch(src, dst, count=count, t=t)
+        else:
+            scores = np.zeros(0)
+        self.records += len(t)
+        self.batches += 1
+
+        results, start = [], 0
+        for r in batch:
+            score = scores[start : start + len(r)]
+            start += len(r)
+            if r.valid is not None:
+                full = np.full(len(r.valid), np.nan)
+                full[r.valid] = score
+                score = full
+            results.append(score)
+        return results
+
+
+class ScoringClient:
+    """
+    Blocking client of a :class:`ScoringServer`.
+
+    Parameters
+    ----------
+    path : str, default=None
+        Unix domain socket of the server. If None, connect to ``host`` and
+        ``port`` instead.
+
+    host : str, default="127.0.0.1"
+        TCP address of the server.
+
+    port : int, default=None
+        TCP port of the server.
+
+    framing : {"line", "binary"}, default="line"
+        Must match the server's.
+
+    chunksize : int, default=4096
+        Records sent before waiting for their scores.
+    """
+
+    def __init__(
+        self, path=None, host="127.0.0.1", port=None, framing="line", chunksize=4096
+    ):
+        if framing not in FRAMINGS:
+            raise ValueError(
+                f"Unsupported framing '{framing}'. Must be one of {FRAMINGS}"
+            )
+        if path is not None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(path)
+        else:
+            self._sock = socket.create_connection((host, port))
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.framing = framing
+        self.chunksize = chunksize
+        self._buf = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._sock.close()
+
+    def score(self, src, dst, t=None, count=None):
+        """
+        Score edges, returning the score of each edge immediately after its own
+        update. ``t`` defaults to the time of arrival at the server, and ``count``
+        to 1.
+        """
+        n = len(src)
+        t = np.broadcast_to(np.nan if t is None else np.asarray(t, float), (n,))
+        count = np.broadcast_to(
+            1.0 if count is None else np.asarray(count, float), (n,)
+        )
+        scores = []
+        for start in range(0, n, self.chunksize):
+            chunk = slice(start, start + self.chunksize)
+            if self.framing == "line":
+                self._sock.sendall(
+                    "".join(
+                        f"{s} {d} {'-' if np.isnan(ts) else repr(ts)} {c!r}\n"
+                        for s, d, ts, c in zip(
+                            src[chunk],
+                            dst[chunk],
+                            t[chunk].tolist(),
+                            count[chunk].tolist(),
+                        )
+                    ).encode()
+                )
+            else:
+                records = np.empty(len(t[chunk]), dtype=RECORD_DTYPE)
+                records["src"] = src[chunk]
+                records["dst"] = dst[chunk]
+                records["t"] = t[chunk]
+                records["count"] = count[chunk]
+                self._sock.sendall(records.tobytes())
+            scores.append(self._receive(len(t[chunk])))
+        return np.concatenate(scores) if scores else np.zeros(0)
+
+    def _receive(self, n):
+        if self.framing == "line":
+            lines = []
+            while len(lines) < n:
+                self._fill()
+                *done, self._buf = self._buf.split(b"\n")
+                lines.extend(done)
+            return np.array([float(line) for line in lines])
+        size = n * SCORE_DTYPE.itemsize
+        while len(self._buf) < size:
+            self._fill()
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return np.frombuffer(data, dtype=SCORE_DTYPE).copy()
+
+    def _fill(self):
+        data = self._sock.recv(65536)
+        if not data:
+            raise ConnectionError("Connection closed by the server.")
+        self._buf += data
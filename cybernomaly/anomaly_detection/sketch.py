@@ -0,0 +1,457 @@
+import math
+
+import numpy as np
+
+__all__ = ["CountMinSketch"]
+
+_MASK32 = np.uint64(0xFFFFFFFF)
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(x):
+    """
+    SplitMix64 finaliser, applied element-wise to an array of unsigned 64-bit
+    integers. Arithmetic wraps modulo 2**64.
+    """
+    x = np.array(x, dtype=np.uint64, ndmin=1)
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return x
+
+
+def _running_sums(groups, values, initial):
+    """
+    Running sums of ``values`` within each run of equal ``groups`` (which must be
+    sorted), each run starting from the entry of ``initial`` (an array aligned with
+    ``groups``) at its first element. Also returns the index of the first element
+    of every run.
+
+    Every sum is taken in order, so the results are exactly those of adding the
+    values one at a time. Runs of similar lengths are accumulated together as the
+    rows of a zero-padded matrix, so padding at most doubles the work.
+    """
+    n = len(groups)
+    starts = np.empty(n, dtype=bool)
+    starts[:1] = True
+    np.not_equal(groups[1:], groups[:-1], out=starts[1:])
+    first = np.flatnonzero(starts)
+    lengths = np.diff(np.r_[first, n])
+    running = np.empty(n, dtype=np.result_type(initial, values))
+    # Runs of lengths in (2**(k - 1), 2**k] share a matrix. Single elements,
+    # usually most of them, need no matrix at all.
+    _, classes = np.frexp(lengths - 1)
+    single = first[classes == 0]
+    running[single] = initial[single] + values[single]
+    for k in np.unique(classes[classes > 0]):
+        runs = np.flatnonzero(classes == k)
+        width = int(lengths[runs].max())
+        cols = np.arange(width)
+        mask = cols < lengths[runs][:, None]
+        idx = (first[runs][:, None] + cols)[mask]
+        matrix = np.zeros((len(runs), width + 1), dtype=running.dtype)
+        matrix[:, 0] = initial[first[runs]]
+        matrix[:, 1:][mask] = values[idx]
+        running[idx] = np.cumsum(matrix, axis=1)[:, 1:][mask]
+    return running, first
+
+
+def _mix64_int(x):
+    """Scalar equivalent of ``_mix64`` on a Python int."""
+    x ^= x >> 30
+    x = (x * 0xBF58476D1CE4E5B9) & _MASK64
+    x ^= x >> 27
+    x = (x * 0x94D049BB133111EB) & _MASK64
+    x ^= x >> 31
+    return x
+
+
+class CountMinSketch:
+    """
+    Count-min sketch [1]_ stored as a single contiguous ``(depth, width)`` NumPy
+    array.
+
+    Keys are unsigned 64-bit integers. Each key is mixed once and the ``depth`` row
+    indices are derived from the two halves of the mixed value [2]_, so hashing,
+    adding and querying are all vectorised over arrays of keys. Single ``int`` keys
+    take a scalar path that avoids array overhead.
+
+    Decay is lazy: counters are stored divided by a global scale factor, so
+    :meth:`decay` only updates the scale and costs O(1). The table is renormalised
+    (the scale folded back into the counters) when the scale becomes small enough to
+    risk underflow, which for a decay factor ``d`` happens roughly once every
+    ``log(sqrt(tiny)) / log(d)`` calls, e.g. every ~510 calls for ``d = 0.5``.
+
+    With ``conservative=True``, an addition only raises the counters of a key that
+    are below its new estimate (conservative update [3]_), rather than all of them.
+    Estimates are still never below the true counts, but are much tighter, so a
+    smaller sketch reaches the same accuracy. Additions in a batch are applied in
+    order, exactly as one at a time. Conservative sketches can still be decayed,
+    but merging them only gives an upper bound of the conservative sketch of the
+    combined stream.
+
+    Integer counter types are stored as is (they cannot be decayed), and saturate
+    at their largest value rather than wrapping around.
+
+    Parameters
+    ----------
+    width : int
+        Number of counters per row.
+
+    depth : int
+        Number of rows (independent hash functions).
+
+    dtype : numpy dtype, default=np.float64
+        Counter type.
+
+    seed : int, default=0
+        Selects the hash family. Sketches must share a seed (and shape) to be
+        comparable.
+
+    conservative : bool, default=False
+        Whether to use conservative updates.
+
+    References
+    ----------
+    .. [1] An Improved Data Stream Summary: The Count-Min Sketch and its
+           Applications
+           http://dimacs.rutgers.edu/~graham/pubs/papers/cm-full.pdf
+
+    .. [2] Less Hashing, Same Performance: Building a Better Bloom Filter
+           https://www.eecs.harvard.edu/~michaelm/postscripts/rsa2008.pdf
+
+    .. [3] New Directions in Traffic Measurement and Accounting
+           https://dl.acm.org/doi/10.1145/964725.633056
+    """
+
+    def __init__(self, width, depth, dtype=np.float64, seed=0, conservative=False):
+        if width < 1 or depth < 1:
+            raise ValueError("width and depth must be positive integers.")
+        table = np.zeros((int(depth), int(width)), dtype=dtype)
+        self._init(table, seed, conservative)
+
+    @classmethod
+    def from_table(cls, table, seed=0, scale=1.0, conservative=False, total=None):
+        """
+        Wrap an existing ``(depth, width)`` counter array, such as a memory map,
+        without copying it. ``scale`` is the pending lazy decay of the counters,
+        and ``total`` the sum of all counts added (by default, the sum of a row,
+        which is exact unless the sketch is conservative).
+        """
+        if np.ndim(table) != 2 or not table.flags.c_contiguous:
+            raise ValueError("table must be a C-contiguous 2-d array.")
+        sketch = cls.__new__(cls)
+        sketch._init(table, seed, conservative)
+        sketch._scale = float(scale)
+        if total is None:
+            sketch._total = float(table[0].sum(dtype=np.float64))
+        else:
+            sketch._total = float(total) / sketch._scale
+        return sketch
+
+    def _init(self, table, seed, conservative=False):
+        self.depth, self.width = table.shape
+        self.seed = int(seed)
+        self.conservative = bool(conservative)
+        self.table = table
+        self._scale = 1.0
+        # Sum of all counts added, in the units of the table.
+        self._total = 0.0
+        self._integer = np.issubdtype(table.dtype, np.integer)
+        if self._integer:
+            self._min_scale, self._max = None, np.iinfo(table.dtype).max
+        else:
+            self._min_scale, self._max = np.sqrt(np.finfo(table.dtype).tiny), None
+
+        self._salt = _mix64(self.seed)[0]
+        self._salt_int = int(self._salt)
+        self._rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        self._offsets = np.arange(self.depth, dtype=np.intp)[:, None] * self.width
+
+    @classmethod
+    def from_error_rate(cls, error_rate, confidence, **kwargs):
+        """
+        Size a sketch so that estimates exceed the true count by at most
+        ``error_rate`` times the total count, with probability ``confidence``.
+        """
+        if not (0 < error_rate < 1):
+            raise ValueError("error_rate must be in the range (0, 1)")
+        if not (0 < confidence < 1):
+            raise ValueError("confidence must be in the range (0, 1)")
+        width = math.ceil(2 / error_rate)
+        return cls(width, cls._depth_for(confidence), **kwargs)
+
+    @classmethod
+    def from_memory(cls, nbytes, confidence, dtype=np.float64, **kwargs):
+        """
+        Size a sketch to the ``confidence`` (as in :meth:`from_error_rate`) and as
+        wide as fits in ``nbytes`` bytes of counters, which sets its
+        :attr:`error_rate`.
+        """
+        if not (0 < confidence < 1):
+            raise ValueError("confidence must be in the range (0, 1)")
+        depth = cls._depth_for(confidence)
+        width = int(nbytes // (depth * np.dtype(dtype).itemsize))
+        if width < 1:
+            raise ValueError(
+                f"{nbytes} bytes cannot hold {depth} rows of {np.dtype(dtype)}."
+            )
+        return cls(width, depth, dtype=dtype, **kwargs)
+
+    @staticmethod
+    def _depth_for(confidence):
+        return math.ceil(-math.log2(1 - confidence))
+
+    @property
+    def nbytes(self):
+        """Memory used by the counters, in bytes."""
+        return self.table.nbytes
+
+    @property
+    def error_rate(self):
+        """
+        Relative error of the estimates: with probability :attr:`confidence`, an
+        estimate exceeds the true count by at most ``error_rate`` times
+        :attr:`total`.
+        """
+        return 2 / self.width
+
+    @property
+    def confidence(self):
+        return 1 - 2.0**-self.depth
+
+    @property
+    def total(self):
+        """Sum of all counts added, with any decay applied."""
+        return self._total * self._scale
+
+    def error_bound(self):
+        """
+        Largest overestimate of a count, with probability :attr:`confidence`, at
+        the current :attr:`total`.
+        """
+        return self.error_rate * self.total
+
+    def _scaled(self, counts):
+        """Counts in the units of the table (which has any decay pending)."""
+        if self._integer:
+            return np.asarray(counts, dtype=np.float64)
+        return np.asarray(counts, dtype=self.table.dtype) / self._scale
+
+    def _store(self, cells, values):
+        """Write counter values, saturating integer counters."""
+        if self._integer:
+            values = np.minimum(np.rint(values), self._max)
+        self.table.reshape(-1)[cells] = values
+
+    def _index(self, keys):
+        h = _mix64(keys ^ self._salt)
+        lo = h & _MASK32
+        hi = (h >> np.uint64(32)) | np.uint64(1)
+        return ((lo + self._rows * hi) % np.uint64(self.width)).astype(np.intp)
+
+    def _index_int(self, key):
+        h = _mix64_int(key ^ self._salt_int)
+        lo, hi = h & 0xFFFFFFFF, (h >> 32) | 1
+        width = self.width
+        return tuple((lo + row * hi) % width for row in range(self.depth))
+
+    def add(self, keys, counts=1):
+        """Add ``counts`` to each of ``keys``. Repeated keys are all counted."""
+        if isinstance(keys, int):
+            cells = (range(self.depth), self._index_int(keys))
+            if self._integer or self.conservative:
+                counts = self._scaled(counts)
+                values = self.table[cells]
+                if self.conservative:
+                    new = np.maximum(values, values.min() + counts)
+                else:
+                    new = values + counts
+                if self._integer:
+                    new = np.minimum(np.rint(new), self._max)
+                self.table[cells] = new
+            else:
+                counts = counts / self._scale
+                self.table[cells] += counts
+            self._total += float(counts)
+            return
+        if self.conservative:
+            self.add_cumulative(keys, counts)
+            return
+        keys = np.array(keys, dtype=np.uint64, ndmin=1)
+        flat = (self._index(keys) + self._offsets).ravel()
+        counts = np.broadcast_to(self._scaled(counts), (self.depth, len(keys)))
+        self._total += float(counts[0].sum())
+        if self._integer:
+            cells, inverse = np.unique(flat, return_inverse=True)
+            sums = np.bincount(inverse, weights=counts.ravel())
+            self._store(cells, self.table.reshape(-1)[cells] + sums)
+        else:
+            np.add.at(self.table.reshape(-1), flat, counts.ravel())
+
+    def add_cumulative(self, keys, counts=1):
+        """
+        Add ``counts`` to each of ``keys`` in order, returning the estimate for each
+        key immediately after its own addition.
+
+        The result matches calling :meth:`add` then :meth:`query` once per key.
+        """
+        keys = np.array(keys, dtype=np.uint64, ndmin=1)
+        n = len(keys)
+        if n == 0:
+            return np.zeros(0, dtype=self.table.dtype)
+        if self.conservative:
+            counts = np.broadcast_to(self._scaled(counts), (n,))
+            self._total += float(counts.sum())
+            return self._add_conservative(keys, counts) * self._scale
+
+        flat = (self._index(keys) + self._offsets).ravel()
+        counts = np.broadcast_to(self._scaled(counts), (self.depth, n))
+        self._total += float(counts[0].sum())
+        counts = counts.ravel()
+
+        # Group the (row, bin) updates by counter, keeping arrival order within
+        # each group, and take a running sum per group.
+        order = np.argsort(flat, kind="stable")
+        bins = flat[order]
+        values, first = _running_sums(bins, counts[order], self.table.reshape(-1)[bins])
+        last = np.r_[first[1:] - 1, len(bins) - 1]
+        self._store(bins[last], values[last])
+
+        est = np.empty_like(values)
+        est[order] = values
+        return est.reshape(self.depth, n).min(axis=0) * self._scale
+
+    def _add_conservative(self, keys, counts):
+        """
+        Conservatively add ``counts`` (in table units) to each of ``keys`` in order,
+        returning the estimate (in table units) for each key after its addition.
+        """
+        keys, inverse = np.unique(keys, return_inverse=True)
+        cells = self._index(keys) + self._offsets
+
+        # Keys sharing a counter with another key of the batch interact, so they
+        # are added one at a time. The others only touch their own counters.
+        flat = cells.ravel()
+        order = np.argsort(flat, kind="stable")
+        owners = np.tile(np.arange(len(keys)), self.depth)[order]
+        clash = flat[order][1:] == flat[order][:-1]
+        shared = np.zeros(len(keys), dtype=bool)
+        shared[owners[1:][clash]] = True
+        shared[owners[:-1][clash]] = True
+
+        table = self.table.reshape(-1)
+        current = table[cells]
+        est = np.empty(len(inverse), dtype=np.result_type(current, counts))
+
+        # Successive additions to a key raise its minimum counter by their running
+        # sum, and its other counters to at least that minimum.
+        alone = np.flatnonzero(~shared[inverse])
+        if len(alone):
+            key = inverse[alone]
+            order = np.argsort(key, kind="stable")
+            low = current.min(axis=0)
+            running, first = _running_sums(
+                key[order], counts[alone][order], low[key[order]]
+            )
+            est[alone[order]] = running
+
+            last = np.r_[first[1:] - 1, len(running) - 1]
+            low[key[order][last]] = running[last]
+            own = ~shared
+            raised = np.maximum(current[:, own], low[own])
+            self._store(cells[:, own], raised)
+
+        # The others are added in order, on a list of just the counters they use.
+        clashing = np.flatnonzero(shared[inverse])
+        if len(clashing):
+            used, local = np.unique(cells[:, inverse[clashing]], return_inverse=True)
+            local = local.reshape(self.depth, -1).T.tolist()
+            values = table[used].tolist()
+            estimates = []
+            for key_cells, count in zip(local, counts[clashing].tolist()):
+                value = min([values[j] for j in key_cells]) + count
+                for j in key_cells:
+                    if values[j] < value:
+                        values[j] = value
+                estimates.append(value)
+            est[clashing] = estimates
+            self._store(used, values)
+        return est
+
+    def query(self, keys):
+        """Estimated counts for ``keys``. Returns a scalar for a scalar key."""
+        if isinstance(keys, int):
+            idx = self._index_int(keys)
+            return self.table[range(self.depth), idx].min() * self._scale
+        scalar = np.ndim(keys) == 0
+        keys = np.array(keys, dtype=np.uint64, ndmin=1)
+        est = self.table.reshape(-1)[self._index(keys) + self._offsets].min(axis=0)
+        est = est * self._scale
+        return est[0] if scalar else est
+
+    def merge(self, other):
+        """
+        Add the counts of ``other`` into this sketch, element-wise. Both sketches
+        must share a shape and hash family (seed).
+        """
+        if self.table.shape != other.table.shape or self.seed != other.seed:
+            raise ValueError(
+                "Can only merge sketches with the same width, depth and seed."
+            )
+        ratio = other._scale / self._scale
+        if self._integer:
+            self._store(
+                slice(None), self.table.reshape(-1) + other.table.ravel() * ratio
+            )
+        else:
+            self.table += other.table * ratio
+        self._total += other._total * ratio
+        return self
+
+    def _delta(self, keys, counts=1):
+        """
+        Sparse record of adding ``counts`` to ``keys``: the flat indices of the
+        counters touched, the sum of the counts added to each and the total count.
+        :meth:`_add_delta` replays it on any sketch of the same shape and seed.
+        """
+        keys = np.array(keys, dtype=np.uint64, ndmin=1)
+        counts = np.broadcast_to(np.asarray(counts, dtype=np.float64), (len(keys),))
+        flat = (self._index(keys) + self._offsets).ravel()
+        cells, inverse = np.unique(flat, return_inverse=True)
+        sums = np.bincount(inverse, weights=np.tile(counts, self.depth))
+        return cells, sums, float(counts.sum())
+
+    def _add_delta(self, cells, sums, total):
+        """Add a record made by :meth:`_delta`."""
+        self._store(cells, self.table.reshape(-1)[cells] + self._scaled(sums))
+        self._total += float(self._scaled(total))
+
+    def counts(self):
+        """A copy of the counter table, with any pending decay applied."""
+        return self.table * self._scale
+
+    def decay(self, factor):
+        """Multiply every counter by ``factor``, lazily."""
+        if factor == 0:
+            self.clear()
+            return
+        if self._integer:
+            raise TypeError("Sketches with integer counters cannot be decayed.")
+        self._scale *= factor
+        if self._scale < self._min_scale:
+            self.renormalise()
+
+    def renormalise(self):
+        """Fold the pending decay into the counters."""
+        self.table *= self._scale
+        self._total *= self._scale
+        self._scale = 1.0
+
+    def clear(self):
+        """Reset every counter to zero."""
+        self.table.fill(0)
+        self._scale = 1.0
+        self._total = 0.0
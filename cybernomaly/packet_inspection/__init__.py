@@ -1,2 +1,13 @@
+from cybernomaly.packet_inspection.filters import PacketFilter
+from cybernomaly.packet_inspection.flows import FlowAggregator
 from cybernomaly.packet_inspection.inspector import DeepPacketInspector
-from cybernomaly.packet_inspection.pcap import PcapPlayer
+from cybernomaly.packet_inspection.merge import MultiPcapPlayer, expand_captures
+from cybernomaly.packet_inspection.pcap import PcapFile, PcapPlayer, PcapRecord
+from cybernomaly.packet_inspection.live import (
+    LiveCapture,
+    PacketSocketSource,
+    PcapStreamSource,
+    UDPSource,
+    score_live,
+)
+from cybernomaly.packet_inspection.pipeline import DecodePipeline, EdgeRing
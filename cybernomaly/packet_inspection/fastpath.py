@@ -0,0 +1,363 @@
+"""
+Dissection of Ethernet/VLAN, IPv4/IPv6 and TCP/UDP headers straight from raw frame
+bytes, for the common case where kamene's full dissection is not needed.
+
+Frames are only handled here if the result is guaranteed to match what the kamene
+based state machine in :class:`DeepPacketInspector` would report. Anything else
+(other link types or protocols, truncated headers, ports that kamene decodes an
+application layer for, ...) is flagged as unsupported so the caller can fall back.
+"""
+
+import socket
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+__all__ = ["Headers", "parse_headers", "dissect", "dissect_batch", "batch_layers"]
+
+LINKTYPE_ETHERNET = 1
+
+ETH_IPV4 = 0x0800
+ETH_IPV6 = 0x86DD
+ETH_VLAN = 0x8100
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+# Frames to this address are decoded as EAPOL by kamene, whatever their type.
+_EAPOL_DST = b"\x01\x80\xc2\x00\x00\x03"
+
+# Ports that kamene binds an application-layer dissector to.
+_UDP_BOUND_PORTS = frozenset(
+    (53, 67, 68, 69, 123, 137, 138, 161, 162, 434, 500, 520, 546, 547)
+    + (1101, 1701, 1985, 2727, 5355)
+)
+_TCP_BOUND_PORTS = frozenset((53, 139, 2000))
+
+_MAX_VLAN_TAGS = 2
+
+# Enough bytes for two VLAN tags, an IPv4 header with options and a TCP header.
+SNAPLEN = 128
+
+_U16 = struct.Struct("!H")
+_IPV4 = struct.Struct("!BBHHHBBH4s4s")
+_PORTS = struct.Struct("!HH")
+
+
+class Headers(
+    namedtuple(
+        "Headers",
+        "supported vlans ethertype version proto src dst sport dport flags fragment",
+    )
+):
+    """
+    Header fields of a frame. ``src`` and ``dst`` are packed addresses (4 or 16
+    bytes), ``version`` is 0 for non-IP frames, and ports and TCP flags are None
+    when absent. ``supported`` is False when the frame must be dissected by kamene
+    to reproduce the inspector's report.
+    """
+
+    __slots__ = ()
+
+
+_UNSUPPORTED = Headers(False, 0, None, 0, None, None, None, None, None, None, False)
+
+
+def parse_headers(frame, linktype=LINKTYPE_ETHERNET):
+    """Parse the headers of one raw frame (bytes or memoryview)."""
+    if linktype != LINKTYPE_ETHERNET or len(frame) < 14:
+        return _UNSUPPORTED
+
+    supported = frame[:6] != _EAPOL_DST
+    (ethertype,) = _U16.unpack_from(frame, 12)
+    offset, vlans = 14, 0
+    while ethertype == ETH_VLAN and vlans < _MAX_VLAN_TAGS:
+        if len(frame) < offset + 4:
+            break
+        (ethertype,) = _U16.unpack_from(frame, offset + 2)
+        offset += 4
+        vlans += 1
+
+    # Frames with a truncated or malformed IP header are reported as non-IP.
+    non_ip = Headers(
+        False, vlans, ethertype, 0, None, None, None, None, None, None, False
+    )
+    fragment = False
+    if ethertype == ETH_IPV4:
+        if len(frame) < offset + 20:
+            return non_ip
+        vihl, _, length, _, frag, _, proto, _, src, dst = _IPV4.unpack_from(
+            frame, offset
+        )
+        ihl = (vihl & 0x0F) * 4
+        if vihl >> 4 != 4 or ihl < 20:
+            return non_ip
+        version, fragment = 4, (frag & 0x1FFF) != 0
+        end = offset + length
+        offset += ihl
+    elif ethertype == ETH_IPV6:
+        if len(frame) < offset + 40 or frame[offset] >> 4 != 6:
+            return non_ip
+        (length,) = _U16.unpack_from(frame, offset + 4)
+        version, proto = 6, frame[offset + 6]
+        src = bytes(frame[offset + 8 : offset + 24])
+        dst = bytes(frame[offset + 24 : offset + 40])
+        offset += 40
+        end = offset + length
+    else:
+        return non_ip
+
+    if fragment:
+        # Non-first fragments carry no transport header; kamene stops at IP.
+        return Headers(
+            supported,
+            vlans,
+            ethertype,
+            version,
+            proto,
+            src,
+            dst,
+            None,
+            None,
+            None,
+            True,
+        )
+
+    # kamene trims the transport layer to the IP length, so both the capture and
+    # the IP length must cover the transport header.
+    available = min(len(frame), end) - offset
+    if proto == PROTO_TCP and available >= 20:
+        sport, dport = _PORTS.unpack_from(frame, offset)
+        flags = frame[offset + 13]
+        bound = _TCP_BOUND_PORTS
+    elif proto == PROTO_UDP and available >= 8:
+        sport, dport = _PORTS.unpack_from(frame, offset)
+        flags = None
+        bound = _UDP_BOUND_PORTS
+    else:
+        return Headers(
+            False, vlans, ethertype, version, proto, src, dst, None, None, None, False
+        )
+
+    supported = supported and sport not in bound and dport not in bound
+    return Headers(
+        supported,
+        vlans,
+        ethertype,
+        version,
+        proto,
+        src,
+        dst,
+        sport,
+        dport,
+        flags,
+        False,
+    )
+
+
+def _ntop(addr):
+    if len(addr) == 4:
+        return socket.inet_ntoa(addr)
+    return socket.inet_ntop(socket.AF_INET6, addr)
+
+
+_ETHERNET = ("Ethernet", (), ())
+_VLAN = ("802.1Q", (), ())
+_ADDRESS_FIELDS = ("src", "dst")
+_PORT_FIELDS = ("sport", "dport")
+
+
+def _layers(hdr):
+    layers = [_ETHERNET] + [_VLAN] * hdr.vlans
+    layers.append(
+        (
+            "IP" if hdr.version == 4 else "IPv6",
+            _ADDRESS_FIELDS,
+            (_ntop(hdr.src), _ntop(hdr.dst)),
+        )
+    )
+    if hdr.sport is not None:
+        layers.append(
+            (
+                "TCP" if hdr.proto == PROTO_TCP else "UDP",
+                _PORT_FIELDS,
+                (hdr.sport, hdr.dport),
+            )
+        )
+    return tuple(layers)
+
+
+def dissect(frame, linktype=LINKTYPE_ETHERNET):
+    """
+    Report layers of one raw frame, as ``(name, fields, values)`` tuples in the
+    :class:`PacketReport` layout, or None if the frame needs the kamene dissector.
+    """
+    hdr = parse_headers(frame, linktype)
+    if not hdr.supported:
+        return None
+    return _layers(hdr)
+
+
+def _gather(buffer, offsets, caplens, width):
+    """
+    Copy the first ``width`` bytes of each frame into a zero-padded 2-d array.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if not len(data):
+        # Every frame is empty, and there is no byte to point the padding at.
+        return np.zeros((len(offsets), width), dtype=np.uint8)
+    cols = np.arange(width)
+    idx = offsets[:, None] + cols
+    valid = cols < caplens[:, None]
+    return np.where(valid, data[np.where(valid, idx, 0)], 0).astype(np.uint8)
+
+
+def _u16(h, rows, offset):
+    return (h[rows, offset].astype(np.uint16) << 8) | h[rows, offset + 1]
+
+
+def dissect_batch(
+    frames=None, linktype=LINKTYPE_ETHERNET, buffer=None, offsets=None, caplens=None
+):
+    """
+    Vectorised :func:`parse_headers` over a batch of frames.
+
+    ``linktype`` may be given per frame. Frames are given either as a sequence of bytes-like objects, or as a single
+    ``buffer`` (e.g. a memory-mapped capture) with the ``offsets`` and ``caplens``
+    of each frame in it, as returned by :meth:`PcapFile.index`. In the second form
+    no per-frame Python code runs at all.
+
+    Returns
+    -------
+    headers : dict of ndarray
+        ``supported``, ``vlans``, ``ethertype``, ``version``, ``proto``,
+        ``has_ports``, ``sport``, ``dport``, ``flags`` and ``fragment``, one entry
+        per frame, and
+        ``src``/``dst`` as ``(n_frames, 16)`` byte arrays (IPv4 addresses in the
+        first four bytes).
+    """
+    if frames is not None:
+        frames = [bytes(frame[:SNAPLEN]) for frame in frames]
+        caplens = np.fromiter(
+            (len(f) for f in frames), dtype=np.int64, count=len(frames)
+        )
+        offsets = np.cumsum(caplens) - caplens
+        buffer = b"".join(frames)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    caplens = np.asarray(caplens, dtype=np.int64)
+
+    n = len(offsets)
+    rows = np.arange(n)
+    h = _gather(buffer, offsets, np.minimum(caplens, SNAPLEN), SNAPLEN)
+
+    linktype = np.broadcast_to(np.asarray(linktype), (n,))
+    ethernet = (linktype == LINKTYPE_ETHERNET) & (caplens >= 14)
+    supported = ethernet & ~(h[:, :6] == np.frombuffer(_EAPOL_DST, dtype=np.uint8)).all(
+        axis=1
+    )
+
+    ethertype = np.where(ethernet, _u16(h, rows, 12), 0)
+    offset = np.full(n, 14, dtype=np.int64)
+    vlans = np.zeros(n, dtype=np.int64)
+    for _ in range(_MAX_VLAN_TAGS):
+        tagged = (ethertype == ETH_VLAN) & (caplens >= offset + 4)
+        ethertype = np.where(tagged, _u16(h, rows, offset + 2), ethertype)
+        offset += 4 * tagged
+        vlans += tagged
+
+    # As in parse_headers, frames with a truncated IP header have no IP fields.
+    is4 = ethertype == ETH_IPV4
+    is6 = ethertype == ETH_IPV6
+    ihl = (h[rows, offset] & 0x0F).astype(np.int64) * 4
+    is4 &= (h[rows, offset] >> 4 == 4) & (ihl >= 20) & (caplens >= offset + 20)
+    is6 &= (h[rows, offset] >> 4 == 6) & (caplens >= offset + 40)
+    version = np.where(is4, 4, np.where(is6, 6, 0))
+    supported &= is4 | is6
+
+    proto = np.where(is4, h[rows, offset + 9], np.where(is6, h[rows, offset + 6], 0))
+    fragment = is4 & ((_u16(h, rows, offset + 6) & 0x1FFF) != 0)
+
+    addr = offset[:, None] + np.where(is4, 12, 8)[:, None] + np.arange(16)
+    addr_len = np.where(is4, 4, 16)[:, None]
+    keep = np.arange(16) < addr_len
+    src = np.where(keep, h[rows[:, None], np.where(keep, addr, 0)], 0).astype(np.uint8)
+    dst_addr = addr + np.where(is4, 4, 16)[:, None]
+    dst = np.where(keep, h[rows[:, None], np.where(keep, dst_addr, 0)], 0).astype(
+        np.uint8
+    )
+
+    length = _u16(h, rows, offset + np.where(is4, 2, 4)).astype(np.int64)
+    end = offset + np.where(is4, 0, 40) + length
+    l4 = offset + np.where(is4, ihl, 40)
+    available = np.minimum(caplens, end) - l4
+    # IPv4 headers with options can run past the gathered bytes.
+    supported &= l4 + 20 <= SNAPLEN
+    l4 = np.minimum(l4, SNAPLEN - 20)
+
+    tcp = (proto == PROTO_TCP) & ~fragment
+    udp = (proto == PROTO_UDP) & ~fragment
+    has_ports = (tcp & (available >= 20)) | (udp & (available >= 8))
+    sport = np.where(has_ports, _u16(h, rows, l4), 0)
+    dport = np.where(has_ports, _u16(h, rows, l4 + 2), 0)
+    flags = np.where(tcp & has_ports, h[rows, l4 + 13], 0)
+
+    supported &= has_ports | fragment
+    bound = np.where(
+        tcp,
+        np.isin(sport, list(_TCP_BOUND_PORTS)) | np.isin(dport, list(_TCP_BOUND_PORTS)),
+        np.isin(sport, list(_UDP_BOUND_PORTS)) | np.isin(dport, list(_UDP_BOUND_PORTS)),
+    )
+    supported &= ~(has_ports & bound)
+
+    return {
+        "supported": supported,
+        "vlans": vlans,
+        "ethertype": ethertype,
+        "version": version,
+        "proto": proto,
+        "src": src,
+        "dst": dst,
+        "sport": sport,
+        "dport": dport,
+        "has_ports": has_ports,
+        "flags": flags,
+        "fragment": fragment,
+    }
+
+
+def batch_layers(headers):
+    """
+    Report layers of every frame of a :func:`dissect_batch` result, with None
+    for the frames that need the kamene dissector.
+    """
+    columns = [
+        headers[name].tolist()
+        for name in ("supported", "vlans", "version", "proto", "has_ports")
+        + ("sport", "dport")
+    ]
+    src, dst = headers["src"], headers["dst"]
+    layers = []
+    for i, (supported, vlans, version, proto, has_ports, sport, dport) in enumerate(
+        zip(*columns)
+    ):
+        if not supported:
+            layers.append(None)
+            continue
+        size = 4 if version == 4 else 16
+        if not has_ports:
+            sport = dport = None
+        hdr = Headers(
+            True,
+            vlans,
+            None,
+            version,
+            proto,
+            src[i, :size].tobytes(),
+            dst[i, :size].tobytes(),
+            sport,
+            dport,
+            None,
+            False,
+        )
+        layers.append(_layers(hdr))
+    return layers
@@ -0,0 +1,415 @@
+"""
+Packet filters with a subset of the BPF (``tcpdump``) syntax, evaluated on raw frame
+bytes before any kamene dissection.
+
+An expression is parsed once into a tree of primitives, which is compiled into two
+predicates: one over the :class:`~cybernomaly.packet_inspection.fastpath.Headers`
+of a single frame, and one over the column arrays of a whole batch of frames, as
+returned by :func:`~cybernomaly.packet_inspection.fastpath.dissect_batch`.
+
+Supported primitives:
+
+- ``ip``, ``ip6``, ``arp``, ``vlan``, ``tcp``, ``udp``, ``icmp``, ``icmp6``
+- ``[ip|ip6] proto <name|number>``
+- ``[src|dst|src or dst|src and dst] host <address>``
+- ``[src|dst|...] net <address>/<prefix length>``
+- ``[tcp|udp] [src|dst|...] port <number>`` and ``portrange <low>-<high>``
+- ``tcp[tcpflags] [& <flags>] (=|==|!=) <flags>``, where flags are numbers or
+  ``tcp-fin``, ``tcp-syn``, ``tcp-rst``, ``tcp-push``, ``tcp-ack``, ``tcp-urg``,
+  ``tcp-ece`` and ``tcp-cwr``, combined with ``|``.
+
+Primitives are combined with ``not``/``!``, ``and``/``&&``, ``or``/``||`` and
+parentheses. As in BPF, negation binds tightest, and ``and`` and ``or`` have the
+same precedence and associate to the left.
+"""
+
+import ipaddress
+import operator
+import re
+
+import numpy as np
+
+from cybernomaly.packet_inspection import fastpath
+
+__all__ = ["PacketFilter"]
+
+_PROTOS = {"icmp": 1, "tcp": 6, "udp": 17, "icmp6": 58}
+_VERSIONS = {"ip": 4, "ip6": 6}
+_ETH_ARP = 0x0806
+_TCP_FLAGS = {
+    "tcp-fin": 0x01,
+    "tcp-syn": 0x02,
+    "tcp-rst": 0x04,
+    "tcp-push": 0x08,
+    "tcp-ack": 0x10,
+    "tcp-urg": 0x20,
+    "tcp-ece": 0x40,
+    "tcp-cwr": 0x80,
+}
+_RELATIONS = {"=": operator.eq, "==": operator.eq, "!=": operator.ne}
+
+_TOKEN = re.compile(r"\s*(&&|\|\||==|!=|[()!&|=]|tcp\[(?:tcpflags|13)\]|[\w.:/-]+)")
+
+
+def _tokenize(expression):
+    tokens, pos = [], 0
+    expression = expression.strip()
+    while pos < len(expression):
+        match = _TOKEN.match(expression, pos)
+        if match is None:
+            raise ValueError(f"Invalid filter syntax at '{expression[pos:]}'")
+        tokens.append(match.group(1))
+        pos = match.end()
+    return tokens
+
+
+class _Parser:
+    """Recursive descent parser producing a tree of tuples."""
+
+    def __init__(self, expression):
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+
+    def peek(self, ahead=0):
+        pos = self.pos + ahead
+        return self.tokens[pos] if pos < len(self.tokens) else None
+
+    def take(self, *expected):
+        token = self.peek()
+        if token is None or (expected and token not in expected):
+            wanted = " or ".join(f"'{e}'" for e in expected) or "more input"
+            raise ValueError(f"Invalid filter: expected {wanted}, got '{token}'")
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            return ("true",)
+        node = self.expression()
+        if self.peek() is not None:
+            raise ValueError(f"Invalid filter: unexpected '{self.peek()}'")
+        return node
+
+    def expression(self):
+        node = self.term()
+        while self.peek() in ("and", "&&", "or", "||"):
+            op = "and" if self.take() in ("and", "&&") else "or"
+            node = (op, node, self.term())
+        return node
+
+    def term(self):
+        token = self.peek()
+        if token in ("not", "!"):
+            self.take()
+            return ("not", self.term())
+        if token == "(":
+            self.take()
+            node = self.expression()
+            self.take(")")
+            return node
+        return self.primitive()
+
+    def direction(self):
+        if self.peek() not in ("src", "dst"):
+            return "either"
+        first = self.take()
+        other = "dst" if first == "src" else "src"
+        if self.peek() in ("or", "and") and self.peek(1) == other:
+            combined = "either" if self.take() == "or" else "both"
+            self.take()
+            return combined
+        return first
+
+    def primitive(self):
+        token = self.peek()
+        if token is not None and token.startswith("tcp["):
+            return self.tcp_flags()
+
+        qualifier = None
+        if token in _VERSIONS or token in ("tcp", "udp"):
+            if self.peek(1) in ("src", "dst", "host", "net", "port", "portrange"):
+                qualifier = self.take()
+            elif token in _VERSIONS and self.peek(1) == "proto":
+                qualifier = self.take()
+            else:
+                self.take()
+                if token in _VERSIONS:
+                    return ("version", _VERSIONS[token])
+                return ("proto", _PROTOS[token], None)
+        elif token in _PROTOS:
+            self.take()
+            version = 6 if token == "icmp6" else 4 if token == "icmp" else None
+            return ("proto", _PROTOS[token], version)
+        elif token == "arp":
+            self.take()
+            return ("ethertype", _ETH_ARP)
+        elif token == "vlan":
+            self.take()
+            return ("vlan",)
+
+        if self.peek() == "proto":
+            self.take()
+            value = self.take()
+            proto = _PROTOS[value] if value in _PROTOS else self.number(value)
+            return ("proto", proto, _VERSIONS.get(qualifier))
+
+        direction = self.direction()
+        kind = self.take("host", "net", "port", "portrange")
+        value = self.take()
+        if kind in ("host", "net"):
+            if qualifier in ("tcp", "udp"):
+                raise ValueError(f"Invalid filter: '{qualifier} {kind}'")
+            return self.address(kind, direction, value, _VERSIONS.get(qualifier))
+
+        if qualifier in _VERSIONS:
+            raise ValueError(f"Invalid filter: '{qualifier} {kind}'")
+        if kind == "port":
+            low = high = self.number(value)
+        else:
+            low, _, high = value.partition("-")
+            low, high = self.number(low), self.number(high)
+        return ("port", direction, low, high, _PROTOS.get(qualifier))
+
+    def address(self, kind, direction, value, version):
+        try:
+            if kind == "host":
+                network = ipaddress.ip_network(value)
+                if network.num_addresses != 1:
+                    raise ValueError(value)
+            else:
+                network = ipaddress.ip_network(value, strict=False)
+        except ValueError:
+            raise ValueError(f"Invalid filter: bad {kind} '{value}'") from None
+        if version is not None and network.version != version:
+            raise ValueError(f"Invalid filter: '{value}' is not an IPv{version} {kind}")
+        return (
+            "net",
+            direction,
+            network.version,
+            network.network_address.packed,
+            network.netmask.packed,
+        )
+
+    def tcp_flags(self):
+        self.take()
+        mask = 0xFF
+        if self.peek() == "&":
+            self.take()
+            mask = self.flags()
+        relation = self.take(*_RELATIONS)
+        return ("flags", mask, relation, self.flags())
+
+    def flags(self):
+        if self.peek() == "(":
+            self.take()
+            value = self.flags()
+            self.take(")")
+            return value
+        value = self.flag(self.take())
+        while self.peek() == "|":
+            self.take()
+            value |= self.flag(self.take())
+        return value
+
+    def flag(self, token):
+        if token in _TCP_FLAGS:
+            return _TCP_FLAGS[token]
+        return self.number(token)
+
+    @staticmethod
+    def number(token):
+        try:
+            return int(token, 0)
+        except ValueError:
+            raise ValueError(
+                f"Invalid filter: expected a number, got '{token}'"
+            ) from None
+
+
+def _directions(direction, test):
+    if direction == "src":
+        return lambda h: test(h.src, h.sport)
+    if direction == "dst":
+        return lambda h: test(h.dst, h.dport)
+    if direction == "both":
+        return lambda h: test(h.src, h.sport) and test(h.dst, h.dport)
+    return lambda h: test(h.src, h.sport) or test(h.dst, h.dport)
+
+
+def _compile(node):
+    """Compile a tree into a predicate over the :class:`Headers` of a frame."""
+    kind = node[0]
+    if kind == "true":
+        return lambda h: True
+    if kind == "and":
+        left, right = _compile(node[1]), _compile(node[2])
+        return lambda h: left(h) and right(h)
+    if kind == "or":
+        left, right = _compile(node[1]), _compile(node[2])
+        return lambda h: left(h) or right(h)
+    if kind == "not":
+        inner = _compile(node[1])
+        return lambda h: not inner(h)
+    if kind == "version":
+        version = node[1]
+        return lambda h: h.version == version
+    if kind == "ethertype":
+        ethertype = node[1]
+        return lambda h: h.ethertype == ethertype
+    if kind == "vlan":
+        return lambda h: h.vlans > 0
+    if kind == "proto":
+        _, proto, version = node
+        if version is None:
+            return lambda h: h.version != 0 and h.proto == proto
+        return lambda h: h.version == version and h.proto == proto
+    if kind == "net":
+        _, direction, version, address, netmask = node
+        address = int.from_bytes(address, "big")
+        netmask = int.from_bytes(netmask, "big")
+        size = 4 if version == 4 else 16
+
+        def test(addr, port):
+            return (
+                addr is not None
+                and len(addr) == size
+                and int.from_bytes(addr, "big") & netmask == address
+            )
+
+        return _directions(direction, test)
+    if kind == "port":
+        _, direction, low, high, proto = node
+
+        def test(addr, port):
+            return port is not None and low <= port <= high
+
+        match = _directions(direction, test)
+        if proto is None:
+            return match
+        return lambda h: h.proto == proto and match(h)
+    if kind == "flags":
+        _, mask, relation, value = node
+        compare = _RELATIONS[relation]
+        return lambda h: h.flags is not None and compare(h.flags & mask, value)
+    raise ValueError(f"Unknown filter primitive '{kind}'")
+
+
+def _compile_batch(node):
+    """
+    Compile a tree into a predicate over the columns of :func:`dissect_batch`,
+    returning a boolean array.
+    """
+    kind = node[0]
+    if kind == "true":
+        return lambda h: np.ones(len(h["version"]), dtype=bool)
+    if kind in ("and", "or"):
+        left, right = _compile_batch(node[1]), _compile_batch(node[2])
+        if kind == "and":
+            return lambda h: left(h) & right(h)
+        return lambda h: left(h) | right(h)
+    if kind == "not":
+        inner = _compile_batch(node[1])
+        return lambda h: ~inner(h)
+    if kind == "version":
+        version = node[1]
+        return lambda h: h["version"] == version
+    if kind == "ethertype":
+        ethertype = node[1]
+        return lambda h: h["ethertype"] == ethertype
+    if kind == "vlan":
+        return lambda h: h["vlans"] > 0
+    if kind == "proto":
+        _, proto, version = node
+        if version is None:
+            return lambda h: (h["version"] != 0) & (h["proto"] == proto)
+        return lambda h: (h["version"] == version) & (h["proto"] == proto)
+    if kind == "net":
+        _, direction, version, address, netmask = node
+        size = len(address)
+        address = np.frombuffer(address, dtype=np.uint8)
+        netmask = np.frombuffer(netmask, dtype=np.uint8)
+
+        def test(h, end):
+            addr = h[end][:, :size]
+            return (h["version"] == version) & ((addr & netmask) == address).all(1)
+
+    elif kind == "port":
+        _, direction, low, high, proto = node
+
+        def test(h, end):
+            port = h["sport" if end == "src" else "dport"]
+            match = h["has_ports"] & (port >= low) & (port <= high)
+            if proto is not None:
+                match &= h["proto"] == proto
+            return match
+
+    elif kind == "flags":
+        _, mask, relation, value = node
+        compare = _RELATIONS[relation]
+        return lambda h: (
+            h["has_ports"] & (h["proto"] == fastpath.PROTO_TCP) & ~h["fragment"]
+        ) & compare(h["flags"] & mask, value)
+    else:
+        raise ValueError(f"Unknown filter primitive '{kind}'")
+
+    if direction in ("src", "dst"):
+        return lambda h: test(h, direction)
+    if direction == "both":
+        return lambda h: test(h, "src") & test(h, "dst")
+    return lambda h: test(h, "src") | test(h, "dst")
+
+
+class PacketFilter:
+    """
+    Filter compiled from a BPF-style expression (see the module documentation),
+    e.g. ``"tcp[tcpflags] & (tcp-syn|tcp-ack) == tcp-syn and dst net 10.0.0.0/8"``
+    or ``"udp port 53"``.
+
+    Frames are matched on their Ethernet, VLAN, IP and TCP/UDP headers, as parsed
+    by :mod:`~cybernomaly.packet_inspection.fastpath`. Frames of other link types,
+    or too short for a header, have no such header and never match a primitive
+    that needs it.
+
+    Parameters
+    ----------
+    expression : str
+        Filter expression. An empty expression matches every frame.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        tree = _Parser(expression).parse()
+        self._match = _compile(tree)
+        self._match_batch = _compile_batch(tree)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.expression!r})"
+
+    def __call__(self, frame, linktype=fastpath.LINKTYPE_ETHERNET):
+        """
+        Whether a frame (bytes-like, or a :class:`PcapRecord` whose own link type
+        is then used) matches.
+        """
+        if hasattr(frame, "linktype"):
+            frame, linktype = frame.data, frame.linktype
+        return self._match(fastpath.parse_headers(frame, linktype))
+
+    def match_headers(self, headers):
+        """Boolean mask of the frames of a :func:`dissect_batch` result that match."""
+        return self._match_batch(headers)
+
+    def match_batch(
+        self,
+        frames=None,
+        linktype=fastpath.LINKTYPE_ETHERNET,
+        buffer=None,
+        offsets=None,
+        caplens=None,
+    ):
+        """
+        Boolean mask of the matching frames of a batch, given as for
+        :func:`dissect_batch` (e.g. a whole memory-mapped capture with the offsets
+        and lengths from :meth:`PcapFile.index`).
+        """
+        headers = fastpath.dissect_batch(frames, linktype, buffer, offsets, caplens)
+        return self.match_headers(headers)
@@ -1,40 +1,27 @@
-import importlib
-import inspect
-import pkgutil
-from time import sleep
-
-from cybernomaly.packet_inspection import protos
-from cybernomaly.packet_inspection.protos.base import Protocol
-
-
-def _find_subclasses(package, base_class):
-    if isinstance(package, str):
-        package = importlib.import_module(package)
-
-    results = {
-        name: obj
-        for name, obj in inspect.getmembers(
-            package,
-            lambda m: inspect.isclass(m)
-            and m is not base_class
-            and issubclass(m, base_class),
-        )
-    }
+from cybernomaly.packet_inspection import fastpath, protos
+from cybernomaly.packet_inspection.filters import PacketFilter
+from cybernomaly.packet_inspection.pcap import PcapRecord
 
-    if hasattr(package, "__path__"):
-        for loader, name, is_pkg in pkgutil.walk_packages(package.__path__):
-            full_name = package.__name__ + "." + name
-            results.update(_find_subclasses(full_name, base_class))
-    return results
+_RAW_TYPES = (bytes, bytearray, memoryview)
+_ADDRESS_LAYERS = ("IP", "IPv6")
+_PORT_LAYERS = ("TCP", "UDP")
 
 
 class PacketReport:
-    def __init__(self, meta):
-        self._meta = meta
+    """
+    Metadata of a packet, held as a tuple of ``(layer name, fields, values)``
+    records. Dictionaries are only built when :attr:`meta` is read.
+    """
+
+    __slots__ = ("layers", "_meta")
+
+    def __init__(self, layers):
+        self.layers = layers
+        self._meta = None
 
     def summary(self, delim=" | "):
         out = []
-        for layer, meta in self._meta.items():
+        for layer, meta in self.meta.items():
             layer = layer.replace(" ", "")
             detail = []
             for key, val in sorted(meta.items(), key=lambda x: x[0]):
@@ -45,17 +32,70 @@ class PacketReport:
                 out.append(layer)
         return delim.join(out)
 
+    def endpoints(self):
+        """
+        Return the source and destination endpoints of the packet, as
+        ``"address:port"`` strings from its outermost IP and TCP/UDP layers. Missing
+        values are formatted as ``None``.
+        """
+        addresses = ports = None
+        for name, _, values in self.layers:
+            if addresses is None and name in _ADDRESS_LAYERS:
+                addresses = values
+            elif ports is None and name in _PORT_LAYERS:
+                ports = values
+        src, dst = addresses if addresses is not None else (None, None)
+        sport, dport = ports if ports is not None else (None, None)
+        return f"{src}:{sport}", f"{dst}:{dport}"
+
     @property
     def meta(self):
+        if self._meta is None:
+            meta = {}
+            for name, fields, values in self.layers:
+                meta[name] = dict(zip(fields, values))
+            self._meta = meta
         return self._meta
 
 
 class DeepPacketInspector:
-    _STATES = _find_subclasses(protos, Protocol)
-
-    def __init__(self, start=None, default="skip"):
+    """
+    Extracts per-layer metadata from packets.
+
+    Every layer of a kamene packet, from ``start`` on, is dispatched to the
+    :class:`Protocol` registered under its name (see
+    :func:`~cybernomaly.packet_inspection.protos.register_protocol`). The dispatch only depends on the stack of
+    layer types, so it is compiled once per distinct stack (e.g.
+    ``Ether/IP/TCP/Raw``) into a plan of extractors, and later packets with the
+    same stack just run the plan.
+
+    Raw frames (``bytes`` or :class:`PcapRecord`) of the common Ethernet/VLAN,
+    IPv4/IPv6 and TCP/UDP kind are instead dissected directly from their bytes by
+    :mod:`~cybernomaly.packet_inspection.fastpath`, which produces the same report
+    without building a kamene packet. All other raw frames fall back to kamene.
+
+    Parameters
+    ----------
+    start : str, default=None
+        Name of the layer to start from. Defaults to the outermost layer.
+
+    default : {"skip", "stop"}, default="skip"
+        What to do on layers without a :class:`Protocol`.
+
+    fast_path : bool, default=True
+        Whether to dissect raw frames from their bytes where possible. Only used
+        with the default ``start`` and ``default``, and while the built-in IP,
+        IPv6, TCP and UDP protocols are registered.
+
+    filter : str or PacketFilter, default=None
+        BPF-style expression (see :class:`PacketFilter`) that raw frames must
+        match. Other raw frames are discarded before any dissection, and reported
+        as None. kamene packets are not filtered.
+    """
+
+    def __init__(self, start=None, default="skip", fast_path=True, filter=None):
         self.states = {}
-        for name, proto in self._STATES.items():
+        for name, proto in protos.PROTOCOLS.items():
             self.states[name] = proto(self)
         self._start = start
         if default == "stop":
@@ -64,32 +104,118 @@ class DeepPacketInspector:
             self._default = self.states["_SKIP_STATE"]
         else:
             raise ValueError(f"Unsupported default action '{default}'")
-
-        self._metadata = None
-        self._reset()
-
-    def _reset(self):
-        self._current = self._start
-        self._stopped = False
-        self._metadata = {}
-
-    def set_state(self, state):
-        self._current = state
+        # The fast path reports what the built-in protocols would.
+        builtin = all(
+            type(self.states.get(proto.__name__)) is proto
+            for proto in (protos.IP, protos.IPv6, protos.TCP, protos.UDP)
+        )
+        self.fast_path = fast_path and builtin and start is None and default == "skip"
+        if isinstance(filter, str):
+            filter = PacketFilter(filter)
+        self.filter = filter
+        self._plans = {}
 
     def process(self, packet):
-        payload = packet
-        if self._current is None and payload is not None:
-            self._current = payload.getlayer(0).name
-
-        while self._current is not None and payload is not None:
-            payload = payload.getlayer(self._current)
-            next_state = self.states.get(self._current, self._default)
-            if next_state is not None:
-                next_state.process(payload)
-
-        meta = self._metadata
-        self._reset()
-        return PacketReport(meta)
-
-    def add_meta(self, key, meta):
-        self._metadata[key] = meta
+        if getattr(packet, "inspector", None) is self:
+            # Already decoded by this inspector, e.g. by MultiPcapPlayer.
+            return packet.report
+        if isinstance(packet, _RAW_TYPES + (PcapRecord,)):
+            record = self._as_record(packet)
+            if self.filter is not None and not self.filter(record):
+                return None
+            if self.fast_path:
+                layers = fastpath.dissect(record.data, record.linktype)
+                if layers is not None:
+                    return PacketReport(layers)
+            packet = record.to_packet()
+        return self._process_packet(packet)
+
+    def _process_packet(self, packet):
+        stack = []
+        layer = packet
+        while layer:
+            stack.append(layer)
+            layer = layer.payload
+
+        signature = tuple(map(type, stack))
+        try:
+            plan = self._plans[signature]
+        except KeyError:
+            plan = self._plans[signature] = self._compile(stack)
+
+        layers = []
+        for depth, name, fields, extract in plan:
+            values = extract(stack[depth])
+            if values is not None:
+                if fields is None:
+                    # A dict from the get_meta of an old-style Protocol.
+                    fields, values = tuple(values), tuple(values.values())
+                layers.append((name, fields, values))
+        return PacketReport(tuple(layers))
+
+    def _compile(self, stack):
+        """
+        Return the ``(depth, name, fields, extract)`` steps that process a stack of
+        layers.
+        """
+        names = [layer.name for layer in stack]
+        first = 0
+        if self._start is not None:
+            first = names.index(self._start) if self._start in names else len(names)
+
+        plan = []
+        for depth in range(first, len(names)):
+            proto = self.states.get(names[depth], self._default)
+            if proto is None:
+                break
+            if proto._legacy:
+                plan.append((depth, names[depth], None, proto.get_meta))
+            else:
+                plan.append((depth, names[depth], proto.fields, proto.extract))
+        return plan
+
+    def process_batch(self, packets):
+        """
+        Process a sequence of raw frames or kamene packets, dissecting all raw
+        frames supported by the fast path (and applying the filter) in a single
+        vectorised pass.
+        """
+        packets = list(packets)
+        raw = [
+            i
+            for i, packet in enumerate(packets)
+            if isinstance(packet, _RAW_TYPES + (PcapRecord,))
+        ]
+        reports = [None] * len(packets)
+        todo = [True] * len(packets)
+        if raw and (self.fast_path or self.filter is not None):
+            records = [self._as_record(packets[i]) for i in raw]
+            headers = fastpath.dissect_batch(
+                [rec.data for rec in records],
+                linktype=[rec.linktype for rec in records],
+            )
+            if self.filter is not None:
+                keep = self.filter.match_headers(headers).tolist()
+                for i, match in zip(raw, keep):
+                    todo[i] = match
+            if self.fast_path:
+                for i, layers in zip(raw, fastpath.batch_layers(headers)):
+                    if layers is not None and todo[i]:
+                        reports[i] = PacketReport(layers)
+                        todo[i] = False
+
+        for i in range(len(packets)):
+            if todo[i]:
+                packet = packets[i]
+                if isinstance(packet, _RAW_TYPES + (PcapRecord,)):
+                    packet = self._as_record(packet).to_packet()
+                reports[i] = self._process_packet(packet)
+        return reports
+
+    @staticmethod
+    def _as_record(packet):
+        if isinstance(packet, PcapRecord):
+            return packet
+        return PcapRecord(
+            None, len(packet), len(packet), packet, fastpath.LINKTYPE_ETHERNET
+        )
@@ -0,0 +1,331 @@
+import asyncio
+import socket
+import struct
+import sys
+from time import time
+
+import numpy as np
+
+from cybernomaly.packet_inspection.inspector import DeepPacketInspector
+from cybernomaly.packet_inspection.pcap import _PCAP_MAGIC, PcapRecord
+
+__all__ = [
+    "LiveCapture",
+    "PacketSocketSource",
+    "PcapStreamSource",
+    "UDPSource",
+    "score_live",
+]
+
+LINKTYPE_ETHERNET = 1
+ETH_P_ALL = 0x0003
+
+_END = object()
+
+
+class _SocketSource:
+    """Frames received on a non-blocking socket, one per ``recv``."""
+
+    linktype = LINKTYPE_ETHERNET
+
+    def __init__(self, bufsize=65535):
+        self.bufsize = bufsize
+
+    def _open(self):
+        raise NotImplementedError("abstract method")
+
+    async def frames(self):
+        loop = asyncio.get_running_loop()
+        sock = self._open()
+        sock.setblocking(False)
+        try:
+            while True:
+                data = await loop.sock_recv(sock, self.bufsize)
+                yield PcapRecord(time(), len(data), len(data), data, self.linktype)
+        finally:
+            sock.close()
+
+
+class PacketSocketSource(_SocketSource):
+    """
+    Frames captured from a Linux ``AF_PACKET`` socket, which needs the
+    ``CAP_NET_RAW`` capability.
+
+    Parameters
+    ----------
+    interface : str, default=None
+        Interface to capture on. Defaults to all interfaces.
+
+    bufsize : int, default=65535
+        Largest frame size. Longer frames are truncated.
+    """
+
+    def __init__(self, interface=None, bufsize=65535):
+        super().__init__(bufsize)
+        self.interface = interface
+
+    def _open(self):
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        if self.interface is not None:
+            sock.bind((self.interface, 0))
+        return sock
+
+
+class UDPSource(_SocketSource):
+    """
+    Raw Ethernet frames sent as the payloads of UDP datagrams to a local port. A
+    stand-in for a capture interface, e.g. for tests.
+
+    Parameters
+    ----------
+    host : str, default="127.0.0.1"
+        Address to listen on.
+
+    port : int, default=0
+        Port to listen on. With the default, a free port is picked when the source
+        is opened and stored in :attr:`port`.
+
+    bufsize : int, default=65535
+        Largest frame size. Longer frames are truncated.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, bufsize=65535):
+        super().__init__(bufsize)
+        self.host = host
+        self.port = port
+        self._sock = None
+
+    def bind(self):
+        """Open the socket now, e.g. to learn the port before capturing."""
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sock.bind((self.host, self.port))
+            self.port = self._sock.getsockname()[1]
+        return self._sock
+
+    def _open(self):
+        sock, self._sock = self.bind(), None
+        return sock
+
+
+class PcapStreamSource:
+    """
+    Frames read from a classic pcap stream, such as ``tcpdump -w -`` output on
+    standard input or a named pipe.
+
+    Parameters
+    ----------
+    stream : str or binary file, default=None
+        Path or file object to read. Defaults to standard input.
+
+    chunksize : int, default=65536
+        Number of bytes read at a time.
+    """
+
+    def __init__(self, stream=None, chunksize=65536):
+        self.stream = stream
+        self.chunksize = chunksize
+
+    async def frames(self):
+        loop = asyncio.get_running_loop()
+        stream = self.stream if self.stream is not None else sys.stdin.buffer
+        fh = open(stream, "rb") if isinstance(stream, str) else stream
+        read = getattr(fh, "read1", fh.read)
+        buf, pos = bytearray(), 0
+        record = linktype = tsres = None
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, read, self.chunksize)
+                if not chunk:
+                    return
+                del buf[:pos]
+                buf += chunk
+                pos = 0
+
+                if record is None:
+                    if len(buf) < 24:
+                        continue
+                    magic = bytes(buf[:4])
+                    if magic not in _PCAP_MAGIC:
+                        raise ValueError("Stream is not in the pcap format.")
+                    endian, tsres = _PCAP_MAGIC[magic]
+                    record = struct.Struct(f"{endian}IIII")
+                    (linktype,) = struct.unpack_from(f"{endian}I", buf, 20)
+                    pos = 24
+
+                while pos + 16 <= len(buf):
+                    sec, frac, caplen, wirelen = record.unpack_from(buf, pos)
+                    end = pos + 16 + caplen
+                    if end > len(buf):
+                        break
+                    data = bytes(buf[pos + 16 : end])
+                    yield PcapRecord(
+                        sec + frac * tsres, caplen, wirelen, data, linktype
+                    )
+                    pos = end
+        finally:
+            if fh is not stream:
+                fh.close()
+
+
+class LiveCapture:
+    """
+    Bounded queue between a live packet source and its consumer.
+
+    Frames are read from ``source`` by a producer task and consumed in batches
+    with :meth:`batches`. When the consumer falls behind and the queue is full,
+    ``policy`` decides what happens, so memory use stays bounded however slow
+    the consumer is.
+
+    Parameters
+    ----------
+    source : PacketSocketSource, UDPSource, PcapStreamSource
+        Any object with an async ``frames()`` generator of :class:`PcapRecord`.
+
+    maxsize : int, default=10000
+        Capacity of the queue, in frames.
+
+    policy : {"block", "drop_new", "drop_old"}, default="block"
+        With ``"block"``, the producer waits for room in the queue (leaving the
+        backlog to the kernel or the writer of the stream). With ``"drop_new"``
+        incoming frames are dropped, and with ``"drop_old"`` the oldest queued
+        frames are.
+
+    Attributes
+    ----------
+    received : int
+        Number of frames read from the source.
+
+    dropped : int
+        Number of frames dropped by the policy.
+
+    processed : int
+        Number of frames handed to the consumer.
+    """
+
+    POLICIES = ("block", "drop_new", "drop_old")
+
+    def __init__(self, source, maxsize=10000, policy="block"):
+        if policy not in self.POLICIES:
+            raise ValueError(
+                f"Unsupported policy '{policy}'. Must be one of {self.POLICIES}"
+            )
+        self.source = source
+        self.maxsize = maxsize
+        self.policy = policy
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self._queue = None
+
+    async def _produce(self):
+        queue, error = self._queue, None
+        try:
+            async for rec in self.source.frames():
+                self.received += 1
+                if self.policy == "block":
+                    await queue.put(rec)
+                elif not queue.full():
+                    queue.put_nowait(rec)
+                elif self.policy == "drop_new":
+                    self.dropped += 1
+                else:
+                    queue.get_nowait()
+                    queue.put_nowait(rec)
+                    self.dropped += 1
+                # Neither receiving a frame the kernel already holds nor queueing
+                # it yields to the event loop, so during a burst the consumer
+                # would never run (and, with the drop policies, nearly every
+                # frame would be dropped) unless the producer steps aside.
+                await asyncio.sleep(0)
+        except Exception as exc:
+            error = exc
+        # Wake up the consumer, even when the source failed.
+        await queue.put(_END)
+        if error is not None:
+            raise error
+
+    async def batches(self, max_batch=1024):
+        """
+        Start capturing and yield lists of up to ``max_batch`` queued frames, as
+        soon as any are available, until the source is exhausted.
+        """
+        self._queue = asyncio.Queue(self.maxsize)
+        producer = asyncio.ensure_future(self._produce())
+        try:
+            while True:
+                item = await self._queue.get()
+                batch = []
+                while item is not _END:
+                    batch.append(item)
+                    if len(batch) >= max_batch or self._queue.empty():
+                        break
+                    item = self._queue.get_nowait()
+                if batch:
+                    self.processed += len(batch)
+                    yield batch
+                if item is _END:
+                    break
+            # Raise any error of the source.
+            await producer
+        finally:
+            producer.cancel()
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "dropped": self.dropped,
+            "processed": self.processed,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
+
+
+def _score_batch(inspector, detector, batch):
+    reports = inspector.process_batch(batch)
+    # Frames discarded by the inspector's filter are not scored.
+    kept = [i for i, report in enumerate(reports) if report is not None]
+    scores = np.full(len(batch), np.nan)
+    if kept:
+        src, dst = zip(*(reports[i].endpoints() for i in kept))
+        t = np.fromiter((batch[i].time for i in kept), dtype=np.float64)
+        scores[kept] = detector.update_detect_score_batch(list(src), list(dst), t=t)
+    return reports, scores
+
+
+async def score_live(capture, detector, inspector=None, max_batch=1024, callback=None):
+    """
+    Continuously score the frames of a :class:`LiveCapture`.
+
+    Each batch is dissected with :meth:`DeepPacketInspector.process_batch` and
+    scored by ``detector`` (e.g. :class:`MIDAS_R`) on the endpoints of every
+    packet. This runs in a worker thread, so the capture keeps filling its queue
+    (and applying its policy) while a batch is scored.
+
+    Parameters
+    ----------
+    capture : LiveCapture
+        Capture to consume.
+
+    detector : Monitor
+        Detector with an ``update_detect_score_batch(src, dst, t=...)`` method.
+
+    inspector : DeepPacketInspector, default=None
+        Defaults to a new inspector.
+
+    max_batch : int, default=1024
+        Largest number of frames scored at once.
+
+    callback : callable, default=None
+        Called with the frames, the :class:`PacketReport` objects and the scores
+        of every batch. Frames discarded by the inspector's filter have a None
+        report and a NaN score.
+    """
+    loop = asyncio.get_running_loop()
+    if inspector is None:
+        inspector = DeepPacketInspector()
+    async for batch in capture.batches(max_batch):
+        reports, scores = await loop.run_in_executor(
+            None, _score_batch, inspector, detector, batch
+        )
+        if callback is not None:
+            callback(batch, reports, scores)
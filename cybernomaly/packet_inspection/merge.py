@@ -0,0 +1,239 @@
+import glob
+import heapq
+import os
+import queue
+import threading
+from collections import deque
+
+from cybernomaly.packet_inspection.pcap import (
+    PcapFile,
+    PcapPlayer,
+    PcapRecord,
+    _locate,
+    _select,
+)
+
+__all__ = ["MultiPcapPlayer", "expand_captures"]
+
+_END = object()
+
+
+def expand_captures(patterns):
+    """
+    Expand a path, glob pattern or list of them into a list of capture files.
+    Matches of each pattern are sorted, and files are listed once, in order of
+    first appearance.
+
+    Raises
+    ------
+    FileNotFoundError
+        If a path does not exist, or a pattern matches no files.
+    """
+    if isinstance(patterns, (str, os.PathLike)):
+        patterns = [patterns]
+    filenames = {}
+    for pattern in map(os.fspath, patterns):
+        if os.path.exists(pattern) or not glob.has_magic(pattern):
+            matches = [pattern]
+        else:
+            matches = sorted(glob.glob(pattern))
+        if not matches or not os.path.exists(matches[0]):
+            raise FileNotFoundError(f"No capture files match '{pattern}'.")
+        filenames.update(dict.fromkeys(matches))
+    return list(filenames)
+
+
+class _InspectedRecord(PcapRecord):
+    """
+    A record with the report made of it by ``inspector`` in a reading thread,
+    which :meth:`DeepPacketInspector.process` returns rather than decoding again.
+    """
+
+
+class _ReadAhead:
+    """
+    Records of one capture within ``[start_time, end_time)``, read by a thread at
+    most ``maxsize`` records ahead of the consumer, each with whether it matches
+    ``match``. With an ``inspector``, the thread also decodes the matching
+    records, a chunk at a time.
+    """
+
+    def __init__(
+        self,
+        filename,
+        maxsize,
+        chunksize,
+        start_time,
+        end_time,
+        index,
+        match,
+        inspector=None,
+    ):
+        self.filename = filename
+        self._inspector = inspector
+        self._chunksize = max(1, min(chunksize, maxsize))
+        self._queue = queue.Queue(max(1, maxsize // self._chunksize))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(start_time, end_time, index, match),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _run(self, start_time, end_time, index, match):
+        try:
+            with PcapFile(self.filename) as pcap:
+                location = _locate(pcap, 0, start_time, end_time, index)
+                chunk = []
+                for _, rec in _select(pcap, location, None, 0, start_time, end_time):
+                    chunk.append((rec, match is None or match(rec)))
+                    if len(chunk) == self._chunksize:
+                        if not self._put(self._inspect(chunk)):
+                            return
+                        chunk = []
+                if chunk:
+                    self._put(self._inspect(chunk))
+        except Exception as exc:
+            self._put(exc)
+        self._put(_END)
+
+    def _inspect(self, chunk):
+        inspector = self._inspector
+        if inspector is None:
+            return chunk
+        matched = [i for i, (_, match) in enumerate(chunk) if match]
+        reports = inspector.process_batch([chunk[i][0] for i in matched])
+        for i, report in zip(matched, reports):
+            rec = _InspectedRecord(*chunk[i][0])
+            rec.inspector, rec.report = inspector, report
+            chunk[i] = rec, True
+        return chunk
+
+    def _put(self, item):
+        # Give up once the consumer has stopped, rather than blocking forever.
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield from item
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class MultiPcapPlayer(PcapPlayer):
+    """
+    Replays several captures (e.g. rotated files from several taps) as one stream,
+    merged by packet timestamp.
+
+    Each capture is read by its own thread, which seeks with the capture's index
+    and applies the time range and ``filter`` of the replay, staying at most
+    ``readahead`` packets ahead of the merge. A k-way heap merge then yields the
+    packets in global timestamp order, as long as every capture is itself in
+    timestamp order.
+
+    A capture is only opened once the merge reaches the timestamp of its first
+    packet, so that rotated captures, which follow each other in time, are read
+    a few at a time however many there are.
+
+    Takes the same replay arguments as :class:`PcapPlayer`. Packets are numbered
+    by their position in the merged stream, counting those within ``start_time``
+    and ``end_time``, and ``offset`` skips packets of the merged stream.
+
+    Parameters
+    ----------
+    filenames : str or list of str
+        Capture files or glob patterns (see :func:`expand_captures`).
+
+    readahead : int, default=4096
+        Largest number of packets read ahead from each capture.
+
+    chunksize : int, default=256
+        Number of packets handed over from a reading thread at once.
+
+    inspector : DeepPacketInspector, default=None
+        If given, the reading threads also decode the packets they read with
+        ``inspector.process_batch``, a chunk at a time, and
+        ``inspector.process`` returns those reports for the records replayed
+        (with ``raw=True``) rather than decoding them again. The threads share
+        the interpreter lock, so this mostly overlaps decoding with the waits of
+        the consumer (e.g. replay pacing) and the vectorised fast path.
+    """
+
+    def __init__(self, filenames, readahead=4096, chunksize=256, inspector=None):
+        self.filenames = expand_captures(filenames)
+        super().__init__(self.filenames[0])
+        self.readahead = readahead
+        self.chunksize = chunksize
+        self.inspector = inspector
+
+    def _first_times(self):
+        """Timestamps of the first packet of every non-empty capture, in order."""
+        starts = []
+        for i, filename in enumerate(self.filenames):
+            with PcapFile(filename) as pcap:
+                rec = next(pcap.records(), None)
+            if rec is not None:
+                starts.append((rec.time, i, filename))
+        return deque(sorted(starts))
+
+    def _records(self, n_packets, offset, start_time, end_time, index, match=None):
+        pending = self._first_times()
+        readers, heap = [], []
+
+        def activate():
+            _, i, filename = pending.popleft()
+            reader = _ReadAhead(
+                filename,
+                self.readahead,
+                self.chunksize,
+                start_time,
+                end_time,
+                index,
+                match,
+                self.inspector,
+            )
+            readers.append(reader)
+            records = iter(reader)
+            first = next(records, None)
+            if first is not None:
+                heap.append((first[0].time, i, first, records))
+                heapq.heapify(heap)
+
+        number = emitted = 0
+        try:
+            while emitted != n_packets and (heap or pending):
+                # Open every capture that may hold the next packet.
+                while pending and (not heap or pending[0][0] <= heap[0][0]):
+                    activate()
+                if not heap:
+                    continue
+
+                _, i, (rec, matched), records = heap[0]
+                following = next(records, None)
+                if following is None:
+                    heapq.heappop(heap)
+                else:
+                    heapq.heapreplace(heap, (following[0].time, i, following, records))
+
+                number += 1
+                if number <= offset or not matched:
+                    continue
+                emitted += 1
+                yield number, rec
+        finally:
+            for reader in readers:
+                reader.close()
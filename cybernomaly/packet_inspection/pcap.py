@@ -1,8 +1,449 @@
-from time import sleep
+import math
+import mmap
+import os
+import struct
+from collections import namedtuple
+from itertools import islice
+from operator import attrgetter
+from time import perf_counter, sleep
 
-from kamene.all import PcapReader
+import numpy as np
 
-from cybernomaly.packet_inspection import protos
+from cybernomaly.packet_inspection.filters import PacketFilter
+
+__all__ = ["PcapFile", "PcapPlayer", "PcapRecord", "ReplayScheduler"]
+
+# Magic number -> (byte order, timestamp resolution) for classic pcap files.
+_PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+_PCAPNG_MAGIC = b"\x0a\x0d\x0d\x0a"
+
+# pcapng block types.
+_SHB = 0x0A0D0D0A
+_IDB = 0x00000001
+_PB = 0x00000002
+_SPB = 0x00000003
+_EPB = 0x00000006
+
+INDEX_DTYPE = np.dtype([("time", "f8"), ("offset", "i8"), ("caplen", "u4")])
+CHECKPOINT_DTYPE = np.dtype(
+    [("number", "i8"), ("offset", "i8"), ("tmin", "f8"), ("tmax", "f8")]
+)
+_CHECKPOINT_VERSION = 1
+# Number of checkpoint blocks summarised per array chunk when building an index.
+_CHECKPOINT_CHUNK = 1024
+
+
+class PcapRecord(namedtuple("PcapRecord", "time caplen wirelen data linktype")):
+    """
+    A captured frame. ``data`` is a zero-copy ``memoryview`` into the memory-mapped
+    capture, valid until the :class:`PcapFile` is closed.
+    """
+
+    __slots__ = ()
+
+    def to_packet(self):
+        """Dissect the frame into a kamene packet."""
+        import kamene.all  # noqa: F401 (registers the link layers)
+        from kamene.config import conf
+
+        try:
+            pkt = conf.l2types[self.linktype](bytes(self.data))
+        except KeyError:
+            pkt = conf.raw_layer(bytes(self.data))
+        if self.time is not None:
+            pkt.time = self.time
+        pkt.wirelen = self.wirelen
+        return pkt
+
+
+class _Interface(namedtuple("_Interface", "linktype snaplen tsres")):
+    __slots__ = ()
+
+
+class PcapFile:
+    """
+    Memory-mapped reader for pcap and pcapng capture files.
+
+    Headers are parsed with ``struct`` directly from the mapping and frames are
+    returned as :class:`PcapRecord` objects whose ``data`` is a view into the
+    mapping, so reading a capture copies no packet bytes. kamene packets are only
+    built on request, with :meth:`PcapRecord.to_packet`.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the capture.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fh = open(filename, "rb")
+        try:
+            self._mmap = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._fh.close()
+            raise ValueError(f"'{filename}' is empty.")
+        self._view = memoryview(self._mmap)
+        self._parse_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self.records()
+
+    def close(self):
+        """
+        Release the mapping. Records still referencing it keep it alive until they
+        are garbage collected.
+        """
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+        self._fh.close()
+
+    def _parse_header(self):
+        magic = bytes(self._view[:4])
+        if magic in _PCAP_MAGIC:
+            self.format = "pcap"
+            endian, self._tsres = _PCAP_MAGIC[magic]
+            self._record = struct.Struct(f"{endian}IIII")
+            (self.linktype,) = struct.unpack_from(f"{endian}I", self._view, 20)
+            self.start = 24
+        elif magic == _PCAPNG_MAGIC:
+            self.format = "pcapng"
+            self._interfaces = []
+            self.start = 0
+            # Read the section header and any interface descriptions up front, so
+            # that reading can start from the middle of the file.
+            for offset, block_type, _, _ in self._blocks(0):
+                if block_type not in (_SHB, _IDB):
+                    break
+            self._header_interfaces = list(self._interfaces)
+            self.linktype = self._interfaces[0].linktype if self._interfaces else None
+        else:
+            raise ValueError(f"'{self.filename}' is not a pcap or pcapng file.")
+
+    def _blocks(self, offset):
+        """Walk pcapng blocks from ``offset``, tracking section and interfaces."""
+        view, size = self._view, len(self._view)
+        while offset + 12 <= size:
+            if bytes(view[offset : offset + 4]) == _PCAPNG_MAGIC:
+                bom = bytes(view[offset + 8 : offset + 12])
+                self._endian = "<" if bom == b"\x4d\x3c\x2b\x1a" else ">"
+                self._interfaces = []
+            endian = self._endian
+            block_type, length = struct.unpack_from(f"{endian}II", view, offset)
+            if length < 12 or offset + length > size:
+                return
+            if block_type == _IDB:
+                self._interfaces.append(self._parse_idb(offset, length))
+            yield offset, block_type, length, endian
+            offset += length
+
+    def _parse_idb(self, offset, length):
+        endian = self._endian
+        linktype, _, snaplen = struct.unpack_from(
+            f"{endian}HHI", self._view, offset + 8
+        )
+        tsres = 1e-6
+        pos, end = offset + 16, offset + length - 4
+        while pos + 4 <= end:
+            code, size = struct.unpack_from(f"{endian}HH", self._view, pos)
+            if code == 0:
+                break
+            if code == 9 and size >= 1:
+                value = self._view[pos + 4]
+                tsres = 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0**-value
+            pos += 4 + ((size + 3) & ~3)
+        return _Interface(linktype, snaplen, tsres)
+
+    def records(self, offset=None, stop=None):
+        """
+        Iterate over the frames in the capture, optionally starting from the
+        record (pcap) or block (pcapng) at byte ``offset`` and ending before the one
+        at byte ``stop``.
+        """
+        view = self._view
+        for time, caplen, wirelen, data, linktype, _ in self._scan(offset, stop):
+            yield PcapRecord(
+                time, caplen, wirelen, view[data : data + caplen], linktype
+            )
+
+    def index(self):
+        """
+        Read only the record headers and return a structured array with the
+        timestamp, data offset and captured length of every frame.
+        """
+        return np.fromiter(
+            ((time, data, caplen) for time, caplen, _, data, _, _ in self._scan()),
+            dtype=INDEX_DTYPE,
+        )
+
+    def checkpoints(self, every=1000, sidecar=True):
+        """
+        Index every ``every``-th frame of the capture.
+
+        The index is built in one pass over the record headers. With
+        ``sidecar=True`` it is saved next to the capture, as ``<filename>.idx``,
+        and reused for as long as the size and modification time of the capture
+        are unchanged.
+
+        Returns
+        -------
+        checkpoints : ndarray of CHECKPOINT_DTYPE
+            Number and byte offset (as accepted by :meth:`records`) of every
+            ``every``-th frame, with the lowest and highest timestamps among the
+            ``every`` frames from it.
+
+        n_frames : int
+            Total number of frames in the capture.
+        """
+        stat = os.stat(self.filename)
+        meta = np.array(
+            [_CHECKPOINT_VERSION, stat.st_size, stat.st_mtime_ns, every], dtype=np.int64
+        )
+        path = f"{self.filename}.idx"
+        if sidecar:
+            try:
+                with np.load(path) as saved:
+                    if np.array_equal(saved["meta"], meta):
+                        return saved["checkpoints"], int(saved["n_frames"])
+            except (OSError, ValueError, KeyError):
+                pass
+
+        checkpoints, n_frames = self._build_checkpoints(every)
+        if sidecar:
+            tmp = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, "wb") as fh:
+                    np.savez(fh, meta=meta, checkpoints=checkpoints, n_frames=n_frames)
+                os.replace(tmp, path)
+            except OSError:
+                # Read-only location: the index is just not kept.
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        return checkpoints, n_frames
+
+    def _build_checkpoints(self, every):
+        dtype = np.dtype([("time", "f8"), ("offset", "i8")])
+        scan = ((time, start) for time, _, _, _, _, start in self._scan())
+        parts, n_frames = [], 0
+        while True:
+            chunk = np.fromiter(islice(scan, every * _CHECKPOINT_CHUNK), dtype=dtype)
+            if not len(chunk):
+                break
+            starts = np.arange(0, len(chunk), every)
+            part = np.empty(len(starts), dtype=CHECKPOINT_DTYPE)
+            part["number"] = n_frames + starts
+            part["offset"] = chunk["offset"][starts]
+            part["tmin"] = np.minimum.reduceat(chunk["time"], starts)
+            part["tmax"] = np.maximum.reduceat(chunk["time"], starts)
+            parts.append(part)
+            n_frames += len(chunk)
+        if not parts:
+            return np.empty(0, dtype=CHECKPOINT_DTYPE), 0
+        return np.concatenate(parts), n_frames
+
+    def locate(self, skip=0, start_time=None, end_time=None, every=1000, sidecar=True):
+        """
+        Find where to read from to get the frames after the first ``skip``, with
+        timestamps in ``[start_time, end_time)``, using :meth:`checkpoints`.
+
+        Timestamps need not be in order. Whole checkpoint blocks are skipped only
+        when no frame in them, or after them, can match.
+
+        Returns
+        -------
+        offset : int
+            Byte offset to start :meth:`records` from.
+
+        number : int
+            Number of frames before ``offset``.
+
+        stop : int or None
+            Byte offset at which to stop :meth:`records`.
+        """
+        checkpoints, n_frames = self.checkpoints(every, sidecar)
+        n_blocks = len(checkpoints)
+        block = max(np.searchsorted(checkpoints["number"], skip, side="right") - 1, 0)
+        if start_time is not None:
+            later = np.flatnonzero(checkpoints["tmax"] >= start_time)
+            block = max(block, later[0] if len(later) else n_blocks)
+
+        stop = None
+        if end_time is not None:
+            lowest = np.minimum.accumulate(checkpoints["tmin"][::-1])[::-1]
+            done = np.flatnonzero(lowest >= end_time)
+            if len(done):
+                stop = int(checkpoints["offset"][done[0]])
+
+        if block >= n_blocks:
+            return len(self._view), n_frames, stop
+        return (
+            int(checkpoints["offset"][block]),
+            int(checkpoints["number"][block]),
+            stop,
+        )
+
+    def _scan(self, offset=None, stop=None):
+        """
+        Yield ``(time, caplen, wirelen, data_offset, linktype, record_offset)`` for
+        each frame, without touching the frame data.
+        """
+        if stop is None:
+            stop = len(self._view)
+        if self.format == "pcap":
+            return self._scan_pcap(self.start if offset is None else offset, stop)
+        return self._scan_pcapng(offset, stop)
+
+    def _scan_pcap(self, offset, stop):
+        view, size = self._view, len(self._view)
+        unpack, header = self._record.unpack_from, self._record.size
+        tsres, linktype = self._tsres, self.linktype
+        while offset + header <= size and offset < stop:
+            sec, frac, caplen, wirelen = unpack(view, offset)
+            data = offset + header
+            if data + caplen > size:
+                return
+            yield sec + frac * tsres, caplen, wirelen, data, linktype, offset
+            offset = data + caplen
+
+    def _scan_pcapng(self, offset, stop):
+        if offset is None:
+            offset = self.start
+        else:
+            self._interfaces = list(self._header_interfaces)
+
+        view = self._view
+        for start, block_type, length, endian in self._blocks(offset):
+            if start >= stop:
+                return
+            if block_type == _EPB:
+                iface, high, low, caplen, wirelen = struct.unpack_from(
+                    f"{endian}IIIII", view, start + 8
+                )
+                data = start + 28
+            elif block_type == _PB:
+                iface, _, high, low, caplen, wirelen = struct.unpack_from(
+                    f"{endian}HHIIII", view, start + 8
+                )
+                data = start + 28
+            elif block_type == _SPB:
+                (wirelen,) = struct.unpack_from(f"{endian}I", view, start + 8)
+                iface, high, low = 0, 0, 0
+                caplen = min(wirelen, length - 16)
+                data = start + 12
+            else:
+                continue
+
+            interface = self._interfaces[iface]
+            time = ((high << 32) | low) * interface.tsres
+            yield time, caplen, wirelen, data, interface.linktype, start
+
+
+class ReplayScheduler:
+    """
+    Paces the replay of timestamped records in real time (or scaled by ``speed``).
+
+    Every record is due at an absolute wall-clock deadline, fixed by its timestamp
+    relative to the first record, so sleep overshoot and the time spent by the
+    consumer never accumulate into drift. Records are released in micro-batches of
+    everything that is due, and a late consumer catches up by receiving larger
+    batches instead of falling further behind.
+
+    Parameters
+    ----------
+    speed : float, default=1
+        Replay speed relative to the timestamps. ``None`` or ``inf`` releases
+        records as fast as possible, without any clock or sleep calls.
+
+    max_batch : int, default=1024
+        Largest number of records released at once.
+
+    resolution : float, default=1e-3
+        Records due within this many seconds of a release go out with it, rather
+        than costing a sleep of their own.
+
+    clock : callable, default=time.perf_counter
+        Monotonic clock, in seconds.
+
+    Attributes
+    ----------
+    lag_ : float
+        How late (in seconds) the last batch was released, relative to the
+        deadline of its first record.
+
+    max_lag_ : float
+        Largest lag so far.
+    """
+
+    def __init__(self, speed=1, max_batch=1024, resolution=1e-3, clock=perf_counter):
+        if speed is not None and speed <= 0:
+            raise ValueError("speed must be positive")
+        self.speed = speed
+        self.max_batch = max_batch
+        self.resolution = resolution
+        self.clock = clock
+        self.lag_ = 0.0
+        self.max_lag_ = 0.0
+
+    @property
+    def realtime(self):
+        return self.speed is not None and not math.isinf(self.speed)
+
+    def batches(self, records, key=None):
+        """
+        Yield lists of ``records`` as they fall due. Timestamps are read from their
+        ``time`` attribute, or with ``key`` if given.
+        """
+        if not self.realtime:
+            records = iter(records)
+            batch = list(islice(records, self.max_batch))
+            while batch:
+                yield batch
+                batch = list(islice(records, self.max_batch))
+            return
+
+        clock, speed, resolution = self.clock, self.speed, self.resolution
+        key = key or attrgetter("time")
+        origin = start = None
+        batch, due, cutoff = [], 0.0, 0.0
+        for rec in records:
+            t = key(rec)
+            if origin is None:
+                origin, start = t, clock()
+            deadline = start + (t - origin) / speed
+            if batch and deadline <= cutoff and len(batch) < self.max_batch:
+                batch.append(rec)
+                continue
+
+            if batch:
+                yield self._release(batch, due)
+            now = clock()
+            if deadline > now + resolution:
+                sleep(deadline - now)
+                now = clock()
+            # Everything due by now, or within the resolution, joins this batch.
+            batch, due, cutoff = [rec], deadline, now + resolution
+
+        if batch:
+            yield self._release(batch, due)
+
+    def _release(self, batch, due):
+        self.lag_ = max(self.clock() - due, 0.0)
+        self.max_lag_ = max(self.max_lag_, self.lag_)
+        return batch
 
 
 class PcapPlayer:
@@ -10,27 +451,159 @@ class PcapPlayer:
         self.filename = filename
         self.seen = 0
         self.t = 0
+        self.scheduler = None
+
+    def replay(self, *args, **kwargs):
+        """
+        Replay the capture, yielding kamene packets or, with ``raw=True``, the
+        undissected :class:`PcapRecord` objects. Takes the same arguments as
+        :meth:`replay_batches`.
+        """
+        for batch in self._replay(*args, **kwargs):
+            for self.seen, self.t, pkt in batch:
+                yield pkt
 
-    def replay(self, n_packets=None, offset=None, speed=1, callback=None, **kwargs):
-        t = None
-        n_packets = n_packets if n_packets is not None else -1
-        offset = offset or 0
+    def replay_batches(
+        self,
+        n_packets=None,
+        offset=None,
+        speed=1,
+        callback=None,
+        raw=False,
+        start_time=None,
+        end_time=None,
+        index=True,
+        max_batch=1024,
+        filter=None,
+        **kwargs,
+    ):
+        """
+        Replay the capture in micro-batches, yielding lists of the packets due at
+        the same time, as scheduled by a :class:`ReplayScheduler` (available as
+        :attr:`scheduler`, e.g. to monitor its lag).
 
-        with PcapReader(self.filename) as pcap:
-            for n, pkt in enumerate(pcap):
-                if n == n_packets:
-                    break
-                if n < offset:
-                    self.seen += 1
-                    continue
+        Parameters
+        ----------
+        n_packets : int, default=None
+            Maximum number of packets to yield.
 
-                if speed is not None and t is not None:
-                    sleep((pkt.time - t) / speed)
+        offset : int, default=None
+            Number of packets at the beginning to skip.
 
-                self.seen += 1
-                t = self.t = pkt.time
+        speed : float, default=1
+            Replay speed relative to the capture's timestamps. ``None`` or ``inf``
+            replays without waiting.
 
-                if callback is not None:
-                    callback(pkt, **kwargs)
+        callback : callable, default=None
+            Called with every packet (and ``kwargs``) before it is yielded.
 
-                yield pkt
+        raw : bool, default=False
+            Whether to yield :class:`PcapRecord` objects instead of kamene packets.
+
+        start_time, end_time : float, default=None
+            Only replay packets with timestamps in ``[start_time, end_time)``.
+
+        index : bool, default=True
+            Whether to seek to ``offset`` and ``start_time`` (and stop at
+            ``end_time``) with :meth:`PcapFile.locate`, building or reusing the
+            capture's sidecar index, rather than reading every frame before them.
+
+        max_batch : int, default=1024
+            Largest number of packets per batch.
+
+        filter : str or PacketFilter, default=None
+            Only replay the packets matching this BPF-style expression (see
+            :class:`PacketFilter`), tested on the raw frames before anything is
+            dissected. ``n_packets`` counts matching packets only.
+
+        **kwargs
+            Passed on to ``callback``.
+        """
+        batches = self._replay(
+            n_packets,
+            offset,
+            speed,
+            callback,
+            raw,
+            start_time,
+            end_time,
+            index,
+            max_batch,
+            filter,
+            **kwargs,
+        )
+        for batch in batches:
+            self.seen, self.t, _ = batch[-1]
+            yield [pkt for _, _, pkt in batch]
+
+    def _replay(
+        self,
+        n_packets=None,
+        offset=None,
+        speed=1,
+        callback=None,
+        raw=False,
+        start_time=None,
+        end_time=None,
+        index=True,
+        max_batch=1024,
+        filter=None,
+        **kwargs,
+    ):
+        self.scheduler = ReplayScheduler(speed, max_batch=max_batch)
+        if isinstance(filter, str):
+            filter = PacketFilter(filter)
+        selected = self._records(
+            n_packets, offset or 0, start_time, end_time, index, filter
+        )
+        try:
+            for batch in self.scheduler.batches(
+                selected, key=lambda item: item[1].time
+            ):
+                packets = []
+                for number, rec in batch:
+                    pkt = rec if raw else rec.to_packet()
+                    if callback is not None:
+                        callback(pkt, **kwargs)
+                    packets.append((number, rec.time, pkt))
+                yield packets
+        finally:
+            selected.close()
+
+    def _records(self, n_packets, offset, start_time, end_time, index, match=None):
+        """Yield ``(number, record)`` for the records to replay."""
+        with PcapFile(self.filename) as pcap:
+            location = _locate(pcap, offset, start_time, end_time, index)
+            yield from _select(
+                pcap, location, n_packets, offset, start_time, end_time, match
+            )
+
+
+def _locate(pcap, offset, start_time, end_time, index):
+    """Return where to start and stop reading, as ``(position, number, stop)``."""
+    if index and (offset or start_time is not None or end_time is not None):
+        return pcap.locate(offset, start_time, end_time)
+    return None, 0, None
+
+
+def _select(pcap, location, n_packets, offset, start_time, end_time, match=None):
+    """
+    Yield ``(number, record)`` for the records to replay from ``location``, that
+    ``match`` (a :class:`PacketFilter`), if given.
+    """
+    position, number, stop = location
+    emitted = 0
+    for rec in pcap.records(position, stop):
+        if emitted == n_packets:
+            break
+        number += 1
+        if number <= offset:
+            continue
+        if start_time is not None and rec.time < start_time:
+            continue
+        if end_time is not None and rec.time >= end_time:
+            continue
+        if match is not None and not match(rec):
+            continue
+        emitted += 1
+        yield number, rec
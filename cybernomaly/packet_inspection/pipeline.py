@@ -0,0 +1,381 @@
+import multiprocessing
+import os
+from itertools import chain, islice
+from multiprocessing import resource_tracker, shared_memory
+from time import sleep
+
+import numpy as np
+
+from cybernomaly.packet_inspection.filters import PacketFilter
+from cybernomaly.packet_inspection.flows import FlowAggregator
+from cybernomaly.packet_inspection.inspector import DeepPacketInspector
+from cybernomaly.packet_inspection.pcap import PcapFile, _select
+
+__all__ = ["EDGE_DTYPE", "EdgeRing", "DecodePipeline"]
+
+EDGE_DTYPE = np.dtype(
+    [
+        ("number", "<i8"),
+        ("t", "<f8"),
+        ("src", "<u8"),
+        ("dst", "<u8"),
+        ("count", "<f8"),
+    ]
+)
+
+# The head and tail counters are kept on separate cache lines, and the records
+# start after both.
+_HEAD, _TAIL, _STATE = 0, 8, 16
+_HEADER = 192
+_OPEN, _CLOSED, _FAILED = 0, 1, 2
+
+
+def _attach_ring(name, capacity):
+    ring = EdgeRing(capacity, name=name)
+    # The segment belongs to the process that created it, which unlinks it.
+    resource_tracker.unregister(ring._shm._name, "shared_memory")
+    return ring
+
+
+class EdgeRing:
+    """
+    Single-producer, single-consumer ring buffer of :data:`EDGE_DTYPE` records in
+    shared memory.
+
+    The producer copies records in and then advances the head counter, and the
+    consumer copies them out and then advances the tail counter, so neither side
+    ever locks, and records cross processes without being pickled. Either side
+    waits, by polling, while the ring is full or empty.
+
+    Parameters
+    ----------
+    capacity : int
+        Number of records the ring holds.
+
+    name : str, default=None
+        Name of an existing ring to attach to. By default, a new one is created.
+
+    poll : float, default=0.0005
+        Seconds to sleep between polls of a full ring.
+    """
+
+    def __init__(self, capacity, name=None, poll=0.0005):
+        self.capacity = capacity
+        self.poll = poll
+        size = _HEADER + capacity * EDGE_DTYPE.itemsize
+        self._shm = shared_memory.SharedMemory(name, create=name is None, size=size)
+        self._ctl = np.ndarray(_HEADER // 8, dtype=np.int64, buffer=self._shm.buf)
+        self._data = np.ndarray(
+            capacity, dtype=EDGE_DTYPE, buffer=self._shm.buf, offset=_HEADER
+        )
+        if name is None:
+            self._ctl[:] = 0
+
+    def __reduce__(self):
+        return _attach_ring, (self._shm.name, self.capacity)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def __len__(self):
+        return int(self._ctl[_HEAD] - self._ctl[_TAIL])
+
+    def write(self, records):
+        """Copy ``records`` into the ring, waiting for room as needed."""
+        ctl, data, capacity = self._ctl, self._data, self.capacity
+        done = 0
+        while done < len(records):
+            head = int(ctl[_HEAD])
+            free = capacity - (head - int(ctl[_TAIL]))
+            if not free:
+                sleep(self.poll)
+                continue
+            n = min(free, len(records) - done)
+            start = head % capacity
+            first = min(n, capacity - start)
+            data[start : start + first] = records[done : done + first]
+            data[: n - first] = records[done + first : done + n]
+            ctl[_HEAD] = head + n
+            done += n
+
+    def read(self):
+        """Return a copy of all the records in the ring, without waiting."""
+        ctl, data, capacity = self._ctl, self._data, self.capacity
+        tail = int(ctl[_TAIL])
+        n = int(ctl[_HEAD]) - tail
+        start = tail % capacity
+        first = min(n, capacity - start)
+        records = np.concatenate([data[start : start + first], data[: n - first]])
+        ctl[_TAIL] = tail + n
+        return records
+
+    def close(self, failed=False):
+        """Mark the end of the stream (by the producer)."""
+        self._ctl[_STATE] = _FAILED if failed else _CLOSED
+
+    @property
+    def state(self):
+        return int(self._ctl[_STATE])
+
+    def release(self):
+        """Free the shared memory (by the creator, once both sides are done)."""
+        self._ctl = self._data = None
+        self._shm.close()
+        self._shm.unlink()
+
+
+def _decode_worker(
+    ring,
+    filename,
+    blocks,
+    selection,
+    encoder,
+    weight,
+    batch_size,
+    expression,
+):
+    try:
+        inspector = DeepPacketInspector()
+        match = PacketFilter(expression) if expression is not None else None
+        with PcapFile(filename) as pcap:
+            # Only the worker's own blocks are read, each from its byte offset.
+            mine = chain.from_iterable(
+                _select(pcap, block, None, *selection, match) for block in blocks
+            )
+            while True:
+                batch = list(islice(mine, batch_size))
+                if not batch:
+                    break
+                numbers, records = zip(*batch)
+                reports = inspector.process_batch(records)
+                src, dst = zip(*(report.endpoints() for report in reports))
+
+                edges = np.empty(len(batch), dtype=EDGE_DTYPE)
+                edges["number"] = numbers
+                edges["t"] = [rec.time for rec in records]
+                edges["src"] = encoder.encode_batch(src)
+                edges["dst"] = encoder.encode_batch(dst)
+                if weight == "bytes":
+                    edges["count"] = [rec.wirelen for rec in records]
+                else:
+                    edges["count"] = 1
+                ring.write(edges)
+    except BaseException:
+        ring.close(failed=True)
+        raise
+    ring.close()
+
+
+class DecodePipeline:
+    """
+    Multi-process decoder of PCAP files, feeding a detector in the calling process.
+
+    The capture is cut into blocks of ``share`` consecutive packets at the byte
+    offsets of its checkpoint index (see :meth:`PcapFile.checkpoints`), which is
+    built or loaded once by the calling process. Blocks outside the selected
+    packets and time range are left out, and the rest are dealt round-robin to
+    ``n_jobs`` worker processes. Each worker maps the capture and reads, filters
+    and decodes only its own blocks, with :class:`DeepPacketInspector`. Rather than packets, the workers send compact
+    edge records (:data:`EDGE_DTYPE`: packet number, timestamp, source and
+    destination keys and count) through an :class:`EdgeRing` each, with the
+    endpoints already encoded by the detector's key encoder. The calling process
+    merges the rings back into capture order, the order in which a serial
+    :class:`PcapPlayer` replay would have scored the packets, so the scores are
+    the same.
+
+    Parameters
+    ----------
+    filename : str
+        PCAP or PCAPNG file to read.
+
+    detector : MIDAS_R
+        Detector to score the edges with, whose key encoder the workers use.
+
+    n_jobs : int, default=None
+        Number of worker processes. Defaults to the number of CPUs.
+
+    share : int, default=1000
+        Number of consecutive packets decoded by the same worker, which is the
+        interval of the checkpoint index.
+
+    batch_size : int, default=1024
+        Number of packets decoded, and records sent, at a time by each worker.
+
+    capacity : int, default=65536
+        Number of records in each ring. The calling process also holds at most
+        this many records per worker while merging.
+
+    weight : {"packets", "bytes"}, default="packets"
+        Whether the count of each record is one or the size of its packet.
+
+    filter : str or PacketFilter, default=None
+        Only decode the packets matching this BPF-style expression (see
+        :class:`PacketFilter`), tested by the workers on the raw frames.
+
+    Attributes
+    ----------
+    seen : int
+        Number of records merged so far.
+
+    t : float
+        Timestamp of the last record merged.
+    """
+
+    def __init__(
+        self,
+        filename,
+        detector,
+        n_jobs=None,
+        share=1000,
+        batch_size=1024,
+        capacity=65536,
+        weight="packets",
+        filter=None,
+    ):
+        if weight not in FlowAggregator.WEIGHTS:
+            raise ValueError(
+                f"Unsupported weight '{weight}'. "
+                f"Must be one of {FlowAggregator.WEIGHTS}"
+            )
+        self.filename = filename
+        self.detector = detector
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.share = share
+        self.batch_size = batch_size
+        self.capacity = capacity
+        self.weight = weight
+        if isinstance(filter, str):
+            filter = PacketFilter(filter)
+        self.filter = filter
+        self.poll = 0.0005
+        self.seen = 0
+        self.t = None
+
+    def batches(
+        self, n_packets=None, offset=None, start_time=None, end_time=None, index=True
+    ):
+        """
+        Decode the selected packets in the worker processes and yield their edge
+        records, in capture order, as arrays of whatever has been merged.
+
+        The selection arguments are those of :meth:`PcapPlayer.replay`. Packets are
+        not paced: the capture is read as fast as the workers decode it.
+        """
+        blocks = self._blocks(offset or 0, start_time, end_time, index)
+        selection = (offset or 0, start_time, end_time)
+
+        rings, procs = [], []
+        try:
+            for worker in range(self.n_jobs):
+                rings.append(EdgeRing(self.capacity, poll=self.poll))
+                proc = multiprocessing.Process(
+                    target=_decode_worker,
+                    args=(
+                        rings[-1],
+                        self.filename,
+                        blocks[worker :: self.n_jobs],
+                        selection,
+                        self.detector._encoder,
+                        self.weight,
+                        self.batch_size,
+                        # Compiled filters hold closures, so send the expression.
+                        self.filter.expression if self.filter is not None else None,
+                    ),
+                    daemon=True,
+                )
+                proc.start()
+                procs.append(proc)
+            remaining = n_packets
+            if remaining == 0:
+                return
+            for merged in self._merge(rings, procs):
+                if remaining is not None:
+                    # Workers cannot tell how many packets the others selected, so
+                    # the count is only enforced here.
+                    merged = merged[:remaining]
+                    remaining -= len(merged)
+                self.seen += len(merged)
+                self.t = merged["t"][-1]
+                yield merged
+                if remaining == 0:
+                    return
+            for proc in procs:
+                proc.join()
+        finally:
+            # Only needed when the consumer stops early or a worker failed.
+            for proc in procs:
+                if proc.is_alive():
+                    proc.terminate()
+                proc.join()
+            for ring in rings:
+                ring.release()
+
+    def _blocks(self, offset, start_time, end_time, index):
+        """
+        Return ``(byte offset, number of frames before it, stop offset)`` for every
+        block of ``share`` frames that may hold selected packets.
+        """
+        with PcapFile(self.filename) as pcap:
+            checkpoints, n_frames = pcap.checkpoints(self.share, sidecar=index)
+        numbers, offsets = checkpoints["number"], checkpoints["offset"]
+        ends = np.r_[numbers[1:], n_frames]
+        keep = ends > offset
+        if start_time is not None:
+            keep &= checkpoints["tmax"] >= start_time
+        if end_time is not None:
+            keep &= checkpoints["tmin"] < end_time
+        stops = np.r_[offsets[1:], -1]
+        return [
+            (int(offsets[i]), int(numbers[i]), None if stops[i] < 0 else int(stops[i]))
+            for i in np.flatnonzero(keep)
+        ]
+
+    def _merge(self, rings, procs):
+        # Every ring is in capture order, so all records up to the lowest of the
+        # last packet numbers received from the workers still running are final.
+        pending = [np.empty(0, dtype=EDGE_DTYPE) for _ in rings]
+        last = [0] * len(rings)
+        running = set(range(len(rings)))
+        while running:
+            received = False
+            for i in sorted(running):
+                if len(pending[i]) >= self.capacity:
+                    continue
+                # Everything written before the ring was closed is read below.
+                state = rings[i].state
+                records = rings[i].read()
+                if len(records):
+                    pending[i] = np.concatenate([pending[i], records])
+                    last[i] = records["number"][-1]
+                    received = True
+                if state == _CLOSED:
+                    running.discard(i)
+                elif state == _FAILED or (
+                    not procs[i].is_alive() and rings[i].state == _OPEN
+                ):
+                    raise RuntimeError(f"Decode worker {i} failed.")
+
+            frontier = min((last[i] for i in running), default=np.inf)
+            ready = []
+            for i, records in enumerate(pending):
+                n = np.searchsorted(records["number"], frontier, side="right")
+                if n:
+                    ready.append(records[:n])
+                    pending[i] = records[n:]
+            if ready:
+                merged = np.concatenate(ready)
+                yield merged[np.argsort(merged["number"], kind="stable")]
+            elif not received:
+                sleep(self.poll)
+
+    def score(self, t, src, dst, count=1):
+        """
+        Score edges given by their encoded keys, as in the records of
+        :meth:`batches` (or aggregates of them), with the detector.
+        """
+        detector = self.detector
+        src = np.asarray(src, dtype=np.uint64)
+        dst = np.asarray(dst, dtype=np.uint64)
+        edge = detector._encoder.encode_edge(src, dst)
+        return detector._update_detect_score_keys(edge, src, dst, count, t)
@@ -0,0 +1,20 @@
+from cybernomaly.packet_inspection.protos.base import _SKIP_STATE, Protocol
+from cybernomaly.packet_inspection.protos.ip import IP
+from cybernomaly.packet_inspection.protos.ipv6 import IPv6
+from cybernomaly.packet_inspection.protos.tcp import TCP
+from cybernomaly.packet_inspection.protos.udp import UDP
+
+# Protocol handlers by layer name, as used by DeepPacketInspector.
+PROTOCOLS = {proto.__name__: proto for proto in (IP, IPv6, TCP, UDP, _SKIP_STATE)}
+
+
+def register_protocol(proto, name=None):
+    """
+    Register a :class:`Protocol` subclass as the handler of the layers called
+    ``name`` (by default, the name of the class) in inspectors created from then
+    on. Can be used as a class decorator.
+    """
+    if not (isinstance(proto, type) and issubclass(proto, Protocol)):
+        raise TypeError(f"'{proto}' is not a Protocol subclass")
+    PROTOCOLS[name or proto.__name__] = proto
+    return proto
@@ -1,19 +1,59 @@
+import warnings
+from operator import attrgetter
+
+
 class Protocol:
+    """
+    Metadata extractor for one kind of layer. The values of the layer attributes
+    named in ``fields`` are reported; subclasses with other needs override
+    :meth:`extract`.
+
+    Subclasses that only override :meth:`get_meta`, returning a dict (the API
+    before ``fields`` and :meth:`extract`), still work: their dicts are reported
+    as they are, with the keys of each dict as its fields. They are slower, and
+    creating one gives a :class:`DeprecationWarning`.
+    """
+
+    fields = ()
+
+    # Whether get_meta is overridden without extract (see above).
+    _legacy = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._legacy = (
+            cls.get_meta is not Protocol.get_meta and cls.extract is Protocol.extract
+        )
+        if cls._legacy:
+            warnings.warn(
+                f"{cls.__name__} overrides get_meta but not extract. Declare the "
+                "layer attributes it reports in 'fields', or override extract.",
+                DeprecationWarning,
+                stacklevel=2,
+            )
+
     def __init__(self, inspector):
         self.inspector = inspector
+        getter = attrgetter(*self.fields) if self.fields else None
+        if len(self.fields) == 1:
+            self._getter = lambda payload: (getter(payload),)
+        else:
+            self._getter = getter
 
-    def process(self, payload):
-        if payload is None:
-            return
-        meta = self.get_meta(payload)
-        next_proto = payload.getlayer(1)
-        next_state = next_proto.name if next_proto is not None else None
-        self.inspector.set_state(next_state)
-        if meta is not None:
-            self.inspector.add_meta(payload.name, meta)
+    def extract(self, payload):
+        """
+        Return the values of ``fields`` for the layer ``payload``, or None to leave
+        the layer out of the report.
+        """
+        if self._getter is None:
+            return ()
+        return self._getter(payload)
 
     def get_meta(self, payload):
-        raise NotImplementedError("Abstract class")
+        values = self.extract(payload)
+        if values is None:
+            return None
+        return dict(zip(self.fields, values))
 
     @property
     def name(self):
@@ -21,8 +61,7 @@ class Protocol:
 
 
 class _SKIP_STATE(Protocol):
-    def get_meta(self, payload):
-        proto = payload.getlayer(0).name
-        if proto in ("Raw", "Padding"):
+    def extract(self, payload):
+        if payload.name in ("Raw", "Padding"):
             return None
-        return {}
+        return ()
@@ -0,0 +1,5 @@
+from cybernomaly.packet_inspection.protos.base import Protocol
+
+
+class IPv6(Protocol):
+    fields = ("src", "dst")
@@ -22,7 +22,6 @@ REQUIRED = [
     "matplotlib",
     "numpy",
     "pandas",
-    "pyprobables",
     "rich",
     "scipy",
 ]
@@ -0,0 +1,25 @@
+import numpy as np
+
+from cybernomaly.packet_inspection import DeepPacketInspector
+from cybernomaly.packet_inspection.fastpath import dissect_batch
+
+
+def test_dissect_batch_empty_frames():
+    headers = dissect_batch([b"", b""])
+    assert not headers["supported"].any()
+    assert headers["src"].shape == (2, 16)
+    np.testing.assert_array_equal(headers["sport"], 0)
+
+    headers = dissect_batch([])
+    assert len(headers["supported"]) == 0
+
+
+def test_dissect_batch_empty_buffer():
+    headers = dissect_batch(buffer=b"", offsets=[0, 0], caplens=[0, 0])
+    assert not headers["supported"].any()
+
+
+def test_process_batch_empty_frame():
+    inspector = DeepPacketInspector()
+    [report] = inspector.process_batch([b""])
+    assert report.summary() == DeepPacketInspector().process(b"").summary()
@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+from kamene.layers.inet import ICMP, IP, TCP, UDP
+from kamene.layers.inet6 import IPv6
+from kamene.layers.l2 import ARP, Dot1Q, Ether
+
+from cybernomaly.packet_inspection.fastpath import dissect_batch
+from cybernomaly.packet_inspection.filters import PacketFilter
+
+
+def ether():
+    return Ether(src="00:00:00:00:00:01", dst="00:00:00:00:00:02")
+
+
+def make_frames():
+    frames = {
+        "syn": IP(src="10.0.0.1", dst="192.168.1.5")
+        / TCP(sport=1234, dport=80, flags="S"),
+        "synack": IP(src="192.168.1.5", dst="10.0.0.1")
+        / TCP(sport=80, dport=1234, flags="SA"),
+        "dns": IP(src="10.1.2.3", dst="8.8.8.8") / UDP(sport=5353, dport=53),
+        "icmp": IP(src="172.16.0.1", dst="10.0.0.1") / ICMP(),
+        "tcp6": IPv6(src="2001:db8::1", dst="2001:db8:1::2")
+        / TCP(sport=443, dport=5000, flags="A"),
+        "arp": ARP(
+            hwsrc="00:00:00:00:00:01",
+            hwdst="00:00:00:00:00:02",
+            psrc="10.0.0.1",
+            pdst="10.0.0.2",
+        ),
+        "vlan": Dot1Q(vlan=7)
+        / IP(src="10.0.0.9", dst="10.0.0.10")
+        / UDP(sport=2000, dport=2001),
+        # A later fragment of a TCP datagram, which has no TCP header.
+        "fragment": IP(src="10.0.0.1", dst="10.0.0.2", frag=10, proto=6) / (b"x" * 20),
+    }
+    frames = {name: bytes(ether() / frame) for name, frame in frames.items()}
+    frames["short"] = frames["syn"][:20]
+    return frames
+
+
+FRAMES = make_frames()
+
+
+def matching(expression):
+    match = PacketFilter(expression)
+    return {name for name, frame in FRAMES.items() if match(frame)}
+
+
+def test_primitives():
+    assert matching("") == set(FRAMES)
+    assert matching("tcp") == {"syn", "synack", "tcp6", "fragment"}
+    assert matching("udp") == {"dns", "vlan"}
+    assert matching("icmp") == {"icmp"}
+    assert matching("ip6") == {"tcp6"}
+    assert matching("arp") == {"arp"}
+    assert matching("vlan") == {"vlan"}
+    assert matching("ip proto 17") == {"dns", "vlan"}
+    assert matching("ip6 proto tcp") == {"tcp6"}
+
+
+def test_net_primitives():
+    assert matching("net 10.0.0.0/8") == {
+        "syn",
+        "synack",
+        "dns",
+        "icmp",
+        "vlan",
+        "fragment",
+    }
+    assert matching("src net 10.0.0.0/24") == {"syn", "vlan", "fragment"}
+    assert matching("dst host 10.0.0.1") == {"synack", "icmp"}
+    assert matching("src and dst net 10.0.0.0/24") == {"vlan", "fragment"}
+    assert matching("src or dst host 192.168.1.5") == {"syn", "synack"}
+    assert matching("net 2001:db8::/32") == {"tcp6"}
+    assert matching("dst net 2001:db8::/48") == set()
+    # Non-strict: host bits of the network address are ignored.
+    assert matching("net 10.1.2.3/16") == {"dns"}
+
+
+def test_port_primitives():
+    assert matching("port 80") == {"syn", "synack"}
+    assert matching("dst port 53") == {"dns"}
+    assert matching("udp port 80") == set()
+    assert matching("tcp src port 443") == {"tcp6"}
+    assert matching("portrange 2000-2001") == {"vlan"}
+    assert matching("src portrange 1000-6000") == {"syn", "dns", "vlan"}
+    assert matching("src and dst portrange 1000-6000") == {"vlan"}
+
+
+def test_tcp_flags():
+    assert matching("tcp[tcpflags] & (tcp-syn|tcp-ack) == tcp-syn") == {"syn"}
+    assert matching("tcp[tcpflags] & tcp-syn != 0") == {"syn", "synack"}
+    assert matching("tcp[13] = 0x10") == {"tcp6"}
+
+
+def test_precedence():
+    # Negation binds tightest.
+    assert matching("not tcp and ip") == {"dns", "icmp", "vlan"}
+    assert matching("!tcp || arp") == matching("(not tcp) or arp")
+    assert "syn" not in matching("not tcp or udp")
+    # "and" and "or" have the same precedence and associate to the left, so this
+    # is (tcp or udp) and port 53, not tcp or (udp and port 53).
+    assert matching("tcp or udp and port 53") == {"dns"}
+    assert matching("tcp or (udp and port 53)") == {
+        "syn",
+        "synack",
+        "tcp6",
+        "fragment",
+        "dns",
+    }
+    assert matching("port 53 and udp or icmp") == {"dns", "icmp"}
+    assert matching("not (tcp or udp)") == {"icmp", "arp", "short"}
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "tcp and",
+        "(tcp",
+        "tcp )",
+        "host",
+        "port http",
+        "portrange 10",
+        "net 10.0.0.300/8",
+        "host 10.0.0.0/8",
+        "ip6 host 10.0.0.1",
+        "tcp host 10.0.0.1",
+        "ip port 80",
+        "tcp[tcpflags] & tcp-syn",
+        "tcp[tcpflags] == tcp-bogus",
+        "udp $ 53",
+        "frobnicate",
+    ],
+)
+def test_parse_errors(expression):
+    with pytest.raises(ValueError, match="Invalid filter"):
+        PacketFilter(expression)
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "",
+        "tcp",
+        "ip6 or arp",
+        "not vlan and udp",
+        "src net 10.0.0.0/24 or dst host 8.8.8.8",
+        "net 2001:db8::/32",
+        "src and dst net 10.0.0.0/24",
+        "tcp or udp and port 53",
+        "portrange 50-100 and not port 80",
+        "tcp[tcpflags] & (tcp-syn|tcp-ack) == tcp-syn",
+        "tcp[tcpflags] != 0",
+    ],
+)
+def test_batch_matches_scalar(expression):
+    match = PacketFilter(expression)
+    frames = list(FRAMES.values())
+    expected = [match(frame) for frame in frames]
+    np.testing.assert_array_equal(match.match_headers(dissect_batch(frames)), expected)
+    np.testing.assert_array_equal(match.match_batch(frames), expected)
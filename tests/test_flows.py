@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from cybernomaly.packet_inspection import FlowAggregator
+
+
+@pytest.mark.parametrize("weight", FlowAggregator.WEIGHTS)
+def test_add_batch_matches_add(weight):
+    rng = np.random.default_rng(0)
+    n = 2000
+    t = np.sort(rng.random(n) * 10)
+    t[500] = 0.0  # A late packet, counted in the current tick.
+    src = [f"10.0.0.{i}" for i in rng.integers(0, 5, n)]
+    dst = rng.integers(0, 5, n).tolist()
+    size = rng.integers(60, 1500, n).tolist()
+
+    single, batched = FlowAggregator(0.5, weight), FlowAggregator(0.5, weight)
+    expected = []
+    for args in zip(src, dst, t.tolist(), size):
+        expected.extend(single.add(*args))
+    expected.extend(single.flush())
+
+    flows = []
+    for i in range(0, n, 300):
+        s = slice(i, i + 300)
+        flows.extend(batched.add_batch(src[s], dst[s], t[s], size[s]))
+    flows.extend(batched.flush())
+
+    assert flows == expected
+    assert batched.n_packets == single.n_packets == n
+    assert batched.n_flows == single.n_flows == len(expected)
@@ -0,0 +1,55 @@
+import numpy as np
+
+from cybernomaly.anomaly_detection import MIDAS_R, CountMinSketch, HotKeyTier
+
+
+def test_summary_bounds():
+    rng = np.random.default_rng(0)
+    tier = HotKeyTier(4, candidates=16)
+    sketches = CountMinSketch(256, 4), CountMinSketch(256, 4)
+    true = {}
+    for _ in range(50):
+        keys = rng.zipf(1.5, 200).astype(np.uint64) % np.uint64(1000)
+        tier.record_batch(keys, np.ones(len(keys)))
+        tier.end_tick(*sketches)
+        for key in keys.tolist():
+            true[key] = true.get(key, 0) + 1
+
+    total = sum(true.values())
+    floor = tier._summary_floor
+    assert 0 < floor <= total / tier.candidates
+    for key, count in zip(tier._summary_keys.tolist(), tier._summary_counts):
+        assert true[key] <= count <= true[key] + floor
+    # Every key heavier than the floor is a candidate.
+    heavy = {key for key, count in true.items() if count > floor}
+    assert heavy <= set(tier._summary_keys.tolist())
+
+
+def test_hot_scores_match_sketch():
+    rng = np.random.default_rng(0)
+    n = 5000
+    src = rng.zipf(1.5, n) % 40
+    dst = rng.zipf(1.5, n) % 40
+    t = np.sort(rng.integers(0, 100, n))
+    # The sketches are wide enough to count the few keys exactly, so that a key
+    # counted in the hot tier gets the same counts as in the sketches.
+    plain = MIDAS_R(error_rate=0.001)
+    hot = MIDAS_R(error_rate=0.001, hot_keys=4)
+    expected = plain.update_detect_score_batch(src, dst, t=t)
+
+    scores, stayed = [], None
+    bounds = np.r_[0, np.flatnonzero(np.diff(t)) + 1, n]
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        scores.append(hot.update_detect_score_batch(src[a:b], dst[a:b], t=t[a:b]))
+        # The hot set is updated once the next tick starts.
+        if stayed is None and a > 0:
+            stayed = set(hot._edge_hot.keys.tolist())
+        elif stayed is not None:
+            stayed &= set(hot._edge_hot.keys.tolist())
+    scores = np.concatenate(scores)
+
+    edges = hot._format_keys_batch(src, dst)[0]
+    in_tier = np.isin(edges, list(stayed)) & (t >= t[bounds[1]])
+    assert in_tier.sum() > n // 10
+    np.testing.assert_allclose(scores[in_tier], expected[in_tier], rtol=1e-9)
+    np.testing.assert_allclose(scores, expected, rtol=1e-9)
@@ -0,0 +1,46 @@
+import subprocess
+import sys
+
+import pytest
+
+# Seconds. Warm imports take a fraction of this, but importing scikit-learn (or
+# another heavy dependency) at start-up again would go over.
+BUDGET = 1.0
+
+# Must stay out of start-up until the code paths that use them run.
+FORBIDDEN = {
+    "cybernomaly.__main__": ["kamene", "matplotlib", "pandas", "rich", "sklearn"],
+    "cybernomaly.packet_inspection": ["kamene", "pandas", "sklearn"],
+    "cybernomaly.anomaly_detection": ["kamene", "matplotlib", "pandas", "sklearn"],
+}
+
+_PROBE = """
+import sys
+from time import perf_counter
+start = perf_counter()
+import {module}
+print(perf_counter() - start)
+print(" ".join(sorted(sys.modules)))
+"""
+
+
+def measure(module):
+    out = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(module=module)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.splitlines()
+    return float(out[0]), set(out[1].split())
+
+
+@pytest.mark.parametrize("module", sorted(FORBIDDEN))
+def test_import_time(module):
+    # The best of a few runs, to leave out a cold disk cache.
+    runs = [measure(module) for _ in range(3)]
+    assert min(seconds for seconds, _ in runs) < BUDGET
+
+    loaded = runs[0][1]
+    for name in FORBIDDEN[module]:
+        assert name not in loaded
+        assert not any(m.startswith(f"{name}.") for m in loaded)
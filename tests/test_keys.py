@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from cybernomaly.anomaly_detection import MIDAS_R, get_key_encoder
+
+
+@pytest.mark.parametrize("name", ["hashable", "int", "ipv4"])
+def test_numpy_scalars_encode_like_batches(name):
+    encoder = get_key_encoder(name)
+    if name == "hashable":
+        keys = [np.array(["a", "b", "a"]), np.array([1, 2, 1]), np.array([1.5, 2.0])]
+    elif name == "int":
+        keys = [np.array([1, 2, 1], dtype=np.int64), np.array([3, 4], dtype=np.uint32)]
+    else:
+        keys = [np.array(["10.0.0.1", "10.0.0.2:80", "x"]), np.array([1, 2])]
+
+    for batch in keys:
+        expected = encoder.encode_batch(batch)
+        assert [encoder.encode(key) for key in batch] == expected.tolist()
+        assert [encoder.encode(key.item()) for key in batch] == expected.tolist()
+
+
+def test_numpy_tuples_encode_like_python_tuples():
+    encoder = get_key_encoder("hashable")
+    assert encoder.encode((np.str_("a"), np.int64(1))) == encoder.encode(("a", 1))
+
+
+def test_streaming_numpy_inputs_match_batch():
+    rng = np.random.default_rng(0)
+    src = rng.integers(0, 20, 500).astype(str)
+    dst = rng.integers(0, 20, 500).astype(str)
+    t = np.sort(rng.integers(0, 20, 500))
+
+    expected = MIDAS_R().update_detect_score_batch(src, dst, t=t)
+    model = MIDAS_R()
+    scores = [model.update_detect_score(s, d, t=ts) for s, d, ts in zip(src, dst, t)]
+    np.testing.assert_allclose(scores, expected, atol=1e-4)
@@ -0,0 +1,44 @@
+import asyncio
+import socket
+
+import pytest
+
+from cybernomaly.packet_inspection import LiveCapture, UDPSource
+
+N_FRAMES = 256
+
+
+def make_frame(i):
+    ether = b"\x00\x00\x00\x00\x00\x02\x00\x00\x00\x00\x00\x01\x08\x00"
+    return ether + bytes([i % 256]) * 50
+
+
+async def capture_burst(policy):
+    source = UDPSource()
+    source.bind().setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+        # The whole burst is waiting in the kernel before the capture starts.
+        for i in range(N_FRAMES):
+            sender.sendto(make_frame(i), ("127.0.0.1", source.port))
+
+    capture = LiveCapture(source, maxsize=16, policy=policy)
+    batches = capture.batches(max_batch=8)
+    received = []
+    try:
+        async for batch in batches:
+            received.extend(batch)
+            if len(received) + capture.dropped >= N_FRAMES:
+                break
+    finally:
+        await batches.aclose()
+    return capture, received
+
+
+@pytest.mark.parametrize("policy", LiveCapture.POLICIES)
+def test_consumer_keeps_up_with_burst(policy):
+    capture, received = asyncio.run(asyncio.wait_for(capture_burst(policy), 10))
+    assert capture.dropped == 0
+    assert capture.processed == len(received) == N_FRAMES
+    assert [bytes(rec.data) for rec in received] == [
+        make_frame(i) for i in range(N_FRAMES)
+    ]
@@ -0,0 +1,35 @@
+from kamene.layers.inet import IP, TCP, UDP
+from kamene.layers.l2 import Ether
+from kamene.utils import wrpcap
+
+from cybernomaly.packet_inspection import DeepPacketInspector, MultiPcapPlayer
+
+
+def write_capture(filename, start, n):
+    packets = []
+    for i in range(n):
+        ether = Ether(src="00:00:00:00:00:01", dst="00:00:00:00:00:02")
+        ip = IP(src=f"10.0.0.{i % 7 + 1}", dst=f"10.0.1.{start % 5 + 1}")
+        packet = ether / ip / (TCP(dport=80) if i % 2 else UDP(dport=53))
+        packet.time = start + i * 0.5
+        packets.append(packet)
+    wrpcap(filename, packets)
+
+
+def test_replay_merges_and_inspects_in_reading_threads(tmp_path):
+    write_capture(str(tmp_path / "a.pcap"), 1000, 300)
+    write_capture(str(tmp_path / "b.pcap"), 1001, 300)
+    pattern = str(tmp_path / "*.pcap")
+
+    plain = list(MultiPcapPlayer(pattern).replay(speed=None, raw=True))
+    times = [rec.time for rec in plain]
+    assert len(plain) == 600 and times == sorted(times)
+
+    inspector = DeepPacketInspector()
+    player = MultiPcapPlayer(pattern, chunksize=32, inspector=inspector)
+    records = list(player.replay(speed=None, raw=True, filter="tcp"))
+    assert len(records) == 300
+    for rec in records:
+        assert rec.report is not None and inspector.process(rec) is rec.report
+        expected = DeepPacketInspector().process(bytes(rec.data))
+        assert rec.report.summary() == expected.summary()
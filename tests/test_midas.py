@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from cybernomaly.anomaly_detection import MIDAS_R, midas
+
+
+def make_edges(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    src = rng.zipf(1.5, n) % 200
+    dst = rng.zipf(1.5, n) % 200
+    # Gaps of several ticks between some edges, to decay more than once at a time.
+    t = np.sort(rng.choice(np.r_[0:40, 60:70, 100], n)).astype(np.float64)
+    count = rng.integers(1, 4, n).astype(np.float64)
+    return src, dst, t, count
+
+
+def stream(model, src, dst, count=None, t=None):
+    return np.array(
+        [
+            model.update_detect_score(
+                a, b, 1 if count is None else count[i], None if t is None else t[i]
+            )
+            for i, (a, b) in enumerate(zip(src.tolist(), dst.tolist()))
+        ]
+    )
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {},
+        {"decay": 0},
+        {"decay": 1},
+        {"decay": 0.3, "ticksize": 2},
+        {"agg": min},
+        {"agg": lambda *scores: sum(scores), "precision": None},
+        {"agg": lambda *scores: scores[0] - scores[1] + scores[2]},
+        {"mode": "log"},
+        {"key_encoder": "int", "conservative": True},
+        {"decay": 0.3, "conservative": True, "precision": None},
+        {"decay": 0.7, "hot_keys": 8, "precision": None},
+    ],
+)
+def test_batch_matches_streaming(params):
+    src, dst, t, count = make_edges()
+    expected = stream(MIDAS_R(**params), src, dst, count, t)
+    scores = MIDAS_R(**params).update_detect_score_batch(src, dst, count, t)
+    np.testing.assert_array_equal(scores, expected)
+
+    # Split into batches that end mid-tick.
+    model = MIDAS_R(**params)
+    scores = np.concatenate(
+        [
+            model.update_detect_score_batch(s, d, c, t_)
+            for s, d, c, t_ in zip(
+                *(np.array_split(a, 7) for a in (src, dst, count, t))
+            )
+        ]
+    )
+    np.testing.assert_array_equal(scores, expected)
+
+
+def test_batch_matches_streaming_without_t(monkeypatch):
+    src, dst, _, _ = make_edges(500)
+    monkeypatch.setattr(midas, "time", lambda: 1234.0)
+    expected = stream(MIDAS_R(), src, dst)
+    np.testing.assert_array_equal(
+        MIDAS_R().update_detect_score_batch(src, dst), expected
+    )
+
+
+def test_batch_matches_streaming_dataframe():
+    pd = pytest.importorskip("pandas")
+    src, dst, t, count = make_edges(500)
+    frame = pd.DataFrame({"t": t, "src": src, "dst": dst, "count": count})
+    expected = stream(MIDAS_R(), src, dst, count, t)
+    np.testing.assert_array_equal(MIDAS_R().update_detect_score_batch(frame), expected)
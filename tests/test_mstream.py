@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+import cybernomaly.anomaly_detection as anomaly_detection
+from cybernomaly.anomaly_detection import MStream
+
+
+def test_detect_requires_thresh():
+    X = np.random.default_rng(0).random((20, 3))
+    model = MStream().fit(X)
+    with pytest.raises(ValueError, match="thresh"):
+        model.detect(X)
+    with pytest.raises(ValueError, match="thresh"):
+        model.update_detect(X)
+    # Scores do not need a threshold.
+    assert len(model.update_detect_score(X)) == len(X)
+
+
+def test_detect_with_thresh():
+    X = np.random.default_rng(0).random((20, 3))
+    model = MStream(thresh=0.0).fit(X)
+    model.update(X)
+    np.testing.assert_array_equal(model.detect(X), model.detect_score(X) > 0.0)
+
+
+def test_star_imports_do_not_leak():
+    for name in ("np", "erfc", "erfcinv", "check_array", "FLOAT_DTYPES", "time"):
+        assert not hasattr(anomaly_detection, name)
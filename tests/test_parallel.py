@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from cybernomaly.anomaly_detection import MIDAS_R, ShardedMIDAS_R
+
+
+def make_edges(n=20_000, seed=0):
+    rng = np.random.default_rng(seed)
+    src = rng.integers(0, 2000, n)
+    dst = rng.integers(0, 2000, n)
+    # A few large ticks, which are sharded, followed by a run of small ones.
+    t = np.sort(np.r_[rng.integers(0, 3, n - 300), rng.integers(3, 40, 300)])
+    return src, dst, t
+
+
+@pytest.mark.parametrize(
+    "params, rtol", [({}, 0), ({"decay": 0}, 0), ({"compact": True}, 1e-6)]
+)
+def test_sharded_matches_serial(params, rtol):
+    src, dst, t = make_edges()
+    serial, model = MIDAS_R(**params), MIDAS_R(**params)
+    expected = serial.update_detect_score_batch(src, dst, t=t)
+
+    half = len(src) // 2
+    with ShardedMIDAS_R(model, n_jobs=3, min_shard_size=1000) as sharded:
+        scores = np.r_[
+            sharded.update_detect_score_batch(src[:half], dst[:half], t=t[:half]),
+            sharded.update_detect_score_batch(src[half:], dst[half:], t=t[half:]),
+        ]
+    # float32 counters round the summed counts of a shard differently.
+    np.testing.assert_allclose(scores, expected, rtol=rtol)
+
+    # Closing the driver leaves the model where a serial run would have.
+    for name in MIDAS_R._SKETCHES:
+        a, b = getattr(serial, name), getattr(model, name)
+        np.testing.assert_allclose(a.counts(), b.counts(), rtol=rtol)
+        assert a.total == pytest.approx(b.total, rel=rtol)
+    src, dst, t = make_edges(1000, seed=1)
+    t = t + 100
+    np.testing.assert_allclose(
+        model.update_detect_score_batch(src, dst, t=t),
+        serial.update_detect_score_batch(src, dst, t=t),
+        rtol=rtol,
+    )
+
+
+@pytest.mark.parametrize("params", [{"conservative": True}, {"hot_keys": 8}])
+def test_unsupported_models(params):
+    with pytest.raises(ValueError, match="does not support"):
+        ShardedMIDAS_R(MIDAS_R(**params))
@@ -0,0 +1,30 @@
+import pytest
+
+from cybernomaly.anomaly_detection import MIDAS_R, MStream
+
+
+def test_get_set_params():
+    model = MIDAS_R(decay=0.3, hot_keys=4)
+    params = model.get_params()
+    assert params["decay"] == 0.3 and params["hot_keys"] == 4
+    assert MIDAS_R(**params).get_params() == params
+
+    assert model.set_params(decay=0.7) is model
+    assert model.decay == 0.7
+    with pytest.raises(ValueError, match="Invalid parameter"):
+        model.set_params(nonexistent=1)
+    assert repr(model) == "MIDAS_R(decay=0.7, hot_keys=4)"
+
+
+def test_nested_params_and_clone():
+    decomposition = pytest.importorskip("sklearn.decomposition")
+    from sklearn.base import clone
+
+    model = MStream(dimensionality_reduction=decomposition.IncrementalPCA(2))
+    assert model.get_params()["dimensionality_reduction__n_components"] == 2
+    assert "dimensionality_reduction__n_components" not in model.get_params(deep=False)
+
+    model.set_params(dimensionality_reduction__n_components=3)
+    copy = clone(model)
+    assert copy.dimensionality_reduction is not model.dimensionality_reduction
+    assert copy.dimensionality_reduction.n_components == 3
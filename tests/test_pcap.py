@@ -0,0 +1,300 @@
+import math
+import os
+import struct
+from collections import namedtuple
+
+import numpy as np
+import pytest
+from kamene.layers.inet import IP, TCP, UDP
+from kamene.layers.l2 import Ether
+from kamene.utils import rdpcap, wrpcap
+
+from cybernomaly.packet_inspection import pcap as pcap_module
+from cybernomaly.packet_inspection.pcap import (
+    PcapFile,
+    PcapPlayer,
+    ReplayScheduler,
+    _select,
+)
+
+
+def make_packets(n, start=1000.0, step=0.25):
+    packets = []
+    for i in range(n):
+        ether = Ether(src="00:00:00:00:00:01", dst="00:00:00:00:00:02")
+        ip = IP(src=f"10.0.0.{i % 7 + 1}", dst="10.0.1.1")
+        packet = ether / ip / (TCP(dport=80) if i % 2 else UDP(dport=53 + i))
+        packet.time = start + i * step
+        packets.append(packet)
+    return packets
+
+
+def block(block_type, body):
+    body += b"\0" * (-len(body) % 4)
+    length = len(body) + 12
+    return struct.pack("<II", block_type, length) + body + struct.pack("<I", length)
+
+
+def option(code, value):
+    return struct.pack("<HH", code, len(value)) + value + b"\0" * (-len(value) % 4)
+
+
+def write_pcapng(filename, packets):
+    """
+    Write a pcapng capture with a microsecond and a nanosecond interface, the
+    packets alternating between them.
+    """
+    data = block(0x0A0D0D0A, struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1))
+    data += block(1, struct.pack("<HHI", 1, 0, 65535))
+    data += block(1, struct.pack("<HHI", 1, 0, 65535) + option(9, b"\x09"))
+    for i, packet in enumerate(packets):
+        frame = bytes(packet)
+        iface = i % 2
+        ts = round(packet.time * (1e9 if iface else 1e6))
+        header = struct.pack(
+            "<IIIII", iface, ts >> 32, ts & 0xFFFFFFFF, len(frame), len(frame)
+        )
+        data += block(6, header + frame)
+    with open(filename, "wb") as fh:
+        fh.write(data)
+
+
+@pytest.mark.parametrize("fmt", ["pcap", "pcapng"])
+def test_records_match_kamene(tmp_path, fmt):
+    filename = str(tmp_path / f"capture.{fmt}")
+    packets = make_packets(20)
+    if fmt == "pcap":
+        wrpcap(filename, packets)
+    else:
+        write_pcapng(filename, packets)
+
+    expected = rdpcap(filename)
+    with PcapFile(filename) as pcap:
+        assert pcap.format == fmt and pcap.linktype == 1
+        records = list(pcap)
+        assert len(records) == len(expected)
+        for rec, pkt in zip(records, expected):
+            assert bytes(rec.data) == bytes(pkt)
+            assert rec.caplen == rec.wirelen == len(pkt)
+            assert rec.time == pytest.approx(float(pkt.time), abs=1e-6)
+            assert rec.to_packet().summary() == pkt.summary()
+
+        index = pcap.index()
+        np.testing.assert_array_equal(index["caplen"], [r.caplen for r in records])
+        np.testing.assert_array_equal(index["time"], [r.time for r in records])
+        buffer = pcap._view
+        for (_, offset, caplen), rec in zip(index, records):
+            assert bytes(buffer[offset : offset + caplen]) == bytes(rec.data)
+
+
+def test_truncated_capture(tmp_path):
+    filename = str(tmp_path / "capture.pcap")
+    wrpcap(filename, make_packets(5))
+    with open(filename, "r+b") as fh:
+        fh.truncate(fh.seek(0, 2) - 10)
+    with PcapFile(filename) as pcap:
+        # The partial last record is left out.
+        assert len(list(pcap)) == 4
+
+
+def test_not_a_capture(tmp_path):
+    filename = tmp_path / "capture.pcap"
+    filename.write_bytes(b"not a capture")
+    with pytest.raises(ValueError, match="not a pcap"):
+        PcapFile(str(filename))
+    filename.write_bytes(b"")
+    with pytest.raises(ValueError, match="empty"):
+        PcapFile(str(filename))
+
+
+def linear(filename, skip=0, start_time=None, end_time=None):
+    """Numbers and timestamps of the frames to replay, read one by one."""
+    with PcapFile(filename) as pcap:
+        return [
+            (number, rec.time)
+            for number, rec in enumerate(pcap, 1)
+            if number > skip
+            and (start_time is None or rec.time >= start_time)
+            and (end_time is None or rec.time < end_time)
+        ]
+
+
+@pytest.mark.parametrize("fmt", ["pcap", "pcapng"])
+@pytest.mark.parametrize(
+    "skip, start_time, end_time",
+    [
+        (0, None, None),
+        (37, None, None),
+        (200, None, None),
+        (0, 1020.0, None),
+        (0, None, 1030.0),
+        (50, 1010.0, 1040.0),
+        (0, 1060.0, 1070.0),
+        (0, 2000.0, None),
+        (0, None, 900.0),
+    ],
+)
+def test_locate_matches_linear_scan(tmp_path, fmt, skip, start_time, end_time):
+    filename = str(tmp_path / f"capture.{fmt}")
+    packets = make_packets(200)
+    # Timestamps are slightly out of order, as in captures merged from several
+    # interfaces.
+    jitter = np.random.default_rng(0).uniform(-2, 2, len(packets))
+    for packet, shift in zip(packets, jitter):
+        packet.time += shift
+    if fmt == "pcap":
+        wrpcap(filename, packets)
+    else:
+        write_pcapng(filename, packets)
+    expected = linear(filename, skip, start_time, end_time)
+
+    with PcapFile(filename) as pcap:
+        location = pcap.locate(skip, start_time, end_time, every=16)
+        selected = _select(pcap, location, None, skip, start_time, end_time)
+        assert [(number, rec.time) for number, rec in selected] == expected
+
+    for index in (True, False):
+        player = PcapPlayer(filename)
+        replayed = player.replay(
+            offset=skip,
+            start_time=start_time,
+            end_time=end_time,
+            speed=None,
+            raw=True,
+            index=index,
+        )
+        assert [rec.time for rec in replayed] == [time for _, time in expected]
+
+
+def test_index_invalidated_when_capture_changes(tmp_path):
+    filename = str(tmp_path / "capture.pcap")
+    wrpcap(filename, make_packets(40))
+    with PcapFile(filename) as pcap:
+        checkpoints, n_frames = pcap.checkpoints(every=16)
+    assert n_frames == 40 and len(checkpoints) == 3
+    assert os.path.exists(f"{filename}.idx")
+
+    # The sidecar is reused while the capture is unchanged.
+    with PcapFile(filename) as pcap:
+        pcap._build_checkpoints = None
+        saved, _ = pcap.checkpoints(every=16)
+    np.testing.assert_array_equal(saved, checkpoints)
+
+    # Rewrite the capture with longer frames, so that a stale index would seek to
+    # the middle of a record.
+    packets = [packet / (b"x" * 10) for packet in make_packets(70, start=5000.0)]
+    wrpcap(filename, packets)
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    with PcapFile(filename) as pcap:
+        checkpoints, n_frames = pcap.checkpoints(every=16)
+        assert n_frames == 70 and len(checkpoints) == 5
+        assert checkpoints["tmin"][0] == 5000.0
+        location = pcap.locate(20, every=16)
+        selected = _select(pcap, location, None, 20, None, None)
+        assert [(number, rec.time) for number, rec in selected] == linear(filename, 20)
+
+    # A different spacing or a corrupt sidecar gives a fresh index.
+    with PcapFile(filename) as pcap:
+        assert len(pcap.checkpoints(every=8)[0]) == 9
+    with open(f"{filename}.idx", "wb") as fh:
+        fh.write(b"corrupt")
+    with PcapFile(filename) as pcap:
+        assert pcap.checkpoints(every=8)[1] == 70
+
+
+Record = namedtuple("Record", "time")
+
+
+class FakeClock:
+    """Clock that only moves when slept on (or advanced by the test)."""
+
+    def __init__(self, now=100.0, overshoot=0.0):
+        self.now = now
+        self.overshoot = overshoot
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds + self.overshoot
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(pcap_module, "sleep", clock.sleep)
+    return clock
+
+
+def releases(scheduler, records, clock, work=0.0):
+    """Release time and records of every batch, with a consumer taking ``work``."""
+    out = []
+    for batch in scheduler.batches(records):
+        out.append((clock.now, [rec.time for rec in batch]))
+        clock.now += work
+    return out
+
+
+@pytest.mark.parametrize("speed", [1, 2, 0.5])
+def test_scheduler_paces_to_timestamps(clock, speed):
+    times = [50.0, 50.1, 50.1005, 50.3, 51.0, 51.0]
+    scheduler = ReplayScheduler(speed=speed, resolution=1e-3, clock=clock)
+    out = releases(scheduler, [Record(t) for t in times], clock)
+
+    start = 100.0
+    assert [batch for _, batch in out] == [[50.0], [50.1, 50.1005], [50.3], [51.0] * 2]
+    for released, batch in out:
+        assert released == pytest.approx(start + (batch[0] - 50.0) / speed)
+    assert sum(clock.slept) == pytest.approx(1.0 / speed)
+    assert scheduler.max_lag_ == pytest.approx(0.0, abs=1e-9)
+
+
+def test_scheduler_does_not_drift(clock):
+    # Sleeps overshoot by 1 ms each, which deadlines absorb instead of adding up.
+    clock.overshoot = 1e-3
+    scheduler = ReplayScheduler(speed=1, resolution=1e-4, clock=clock)
+    out = releases(scheduler, [Record(i * 0.01) for i in range(100)], clock)
+    assert len(out) == 100
+    assert out[-1][0] == pytest.approx(100.0 + 0.99 + 1e-3)
+    assert scheduler.max_lag_ == pytest.approx(1e-3)
+
+
+def test_scheduler_late_consumer_catches_up(clock):
+    times = [i * 0.1 for i in range(40)]
+    scheduler = ReplayScheduler(speed=1, resolution=1e-3, clock=clock)
+    out = releases(scheduler, [Record(t) for t in times], clock, work=0.25)
+
+    assert [t for _, batch in out for t in batch] == times
+    assert max(len(batch) for _, batch in out) > 1
+    # Every batch goes out as soon as the consumer is back, and is never further
+    # behind than the consumer's own delay.
+    for released, batch in out:
+        assert released - (100.0 + batch[0]) <= 0.25 + 1e-9
+    assert scheduler.max_lag_ <= 0.25 + 1e-9
+    # Once behind, nothing sleeps.
+    assert sum(clock.slept) < 0.2
+
+
+def test_scheduler_max_batch(clock):
+    records = [Record(1.0)] * 10 + [Record(2.0)]
+    scheduler = ReplayScheduler(speed=1, max_batch=4, clock=clock)
+    out = releases(scheduler, records, clock)
+    assert [len(batch) for _, batch in out] == [4, 4, 2, 1]
+
+
+@pytest.mark.parametrize("speed", [None, math.inf])
+def test_scheduler_as_fast_as_possible(speed):
+    def clock():
+        raise AssertionError("the clock should not be read")
+
+    scheduler = ReplayScheduler(speed=speed, max_batch=4, clock=clock)
+    batches = list(scheduler.batches(Record(t) for t in range(10)))
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+
+
+def test_scheduler_rejects_bad_speed():
+    with pytest.raises(ValueError, match="speed"):
+        ReplayScheduler(speed=0)
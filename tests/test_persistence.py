@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from cybernomaly.anomaly_detection import MIDAS_R, Monitor
+
+
+def make_edges(n=6000, seed=0):
+    rng = np.random.default_rng(seed)
+    src = rng.zipf(1.5, n) % 300
+    dst = rng.zipf(1.5, n) % 300
+    t = np.sort(rng.integers(0, 60, n))
+    return src, dst, t
+
+
+def resume(model, src, dst, t):
+    """Continue a stream with a few single edges, then the rest in one batch."""
+    single = [
+        model.update_detect_score(a, b, t=c)
+        for a, b, c in zip(src[:50], dst[:50], t[:50])
+    ]
+    batch = model.update_detect_score_batch(src[50:], dst[50:], t=t[50:])
+    return np.r_[single, batch]
+
+
+@pytest.mark.parametrize("mmap_mode", [None, "c", "r+"])
+@pytest.mark.parametrize(
+    "params",
+    [{}, {"decay": 0.8, "compact": True}, {"conservative": True}, {"hot_keys": 8}],
+)
+def test_save_load_resumes_stream(tmp_path, mmap_mode, params):
+    src, dst, t = make_edges()
+    # Stop in the middle of a tick.
+    half = len(src) // 2
+    assert t[half - 1] == t[half]
+
+    model = MIDAS_R(**params)
+    model.update_detect_score_batch(src[:half], dst[:half], t=t[:half])
+    model.save(tmp_path)
+    loaded = Monitor.load(tmp_path, mmap_mode=mmap_mode)
+    assert type(loaded) is MIDAS_R
+    assert loaded.get_params() == model.get_params()
+
+    # The model that was saved carries on as if nothing happened.
+    expected = resume(model, src[half:], dst[half:], t[half:])
+    np.testing.assert_array_equal(
+        resume(loaded, src[half:], dst[half:], t[half:]), expected
+    )
+
+    if mmap_mode != "r+":
+        # The snapshot is left as it was saved.
+        again = MIDAS_R.load(tmp_path, mmap_mode=mmap_mode)
+        np.testing.assert_array_equal(
+            resume(again, src[half:], dst[half:], t[half:]), expected
+        )
+    if not params:
+        # Without compact counters, they also match a single uninterrupted batch.
+        full = MIDAS_R().update_detect_score_batch(src, dst, t=t)
+        np.testing.assert_array_equal(expected, full[half:])
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from kamene.layers.inet import IP, TCP, UDP
+from kamene.layers.l2 import Ether
+from kamene.utils import wrpcap
+
+from cybernomaly.anomaly_detection import MIDAS_R
+from cybernomaly.packet_inspection import (
+    DecodePipeline,
+    DeepPacketInspector,
+    PacketFilter,
+    PcapPlayer,
+)
+
+
+@pytest.fixture(scope="module")
+def capture(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    packets = []
+    for i in range(2000):
+        ether = Ether(src="00:00:00:00:00:01", dst="00:00:00:00:00:02")
+        ip = IP(
+            src=f"10.0.0.{rng.integers(1, 20)}", dst=f"10.0.1.{rng.integers(1, 20)}"
+        )
+        packet = ether / ip / (TCP(dport=80) if i % 3 else UDP(dport=53))
+        packet.time = 1000 + i * 0.01
+        packets.append(packet)
+    filename = str(tmp_path_factory.mktemp("pcap") / "capture.pcap")
+    wrpcap(filename, packets)
+    return filename
+
+
+def serial(filename, n_packets, offset, start_time, end_time, expression):
+    encoder, inspector = MIDAS_R()._encoder, DeepPacketInspector()
+    match = PacketFilter(expression) if expression is not None else None
+    records = PcapPlayer(filename)._records(
+        n_packets, offset, start_time, end_time, True, match
+    )
+    edges = []
+    for number, rec in records:
+        src, dst = inspector.process(rec).endpoints()
+        [src, dst] = encoder.encode_batch([src, dst]).tolist()
+        edges.append((number, rec.time, src, dst))
+    return edges
+
+
+@pytest.mark.parametrize(
+    "n_packets, offset, start_time, end_time, expression",
+    [
+        (None, 0, None, None, None),
+        (345, 0, None, None, None),
+        (700, 450, None, None, None),
+        (None, 0, 1004.5, 1012.0, None),
+        (None, 0, None, None, "udp"),
+    ],
+)
+def test_batches_match_serial_replay(
+    capture, n_packets, offset, start_time, end_time, expression
+):
+    pipeline = DecodePipeline(
+        capture, MIDAS_R(), n_jobs=3, share=100, filter=expression
+    )
+    batches = pipeline.batches(n_packets, offset, start_time, end_time)
+    edges = [
+        tuple(edge)
+        for batch in batches
+        for edge in batch[["number", "t", "src", "dst"]].tolist()
+    ]
+    assert edges == serial(capture, n_packets, offset, start_time, end_time, expression)
+    assert pipeline.seen == len(edges)
@@ -0,0 +1,36 @@
+import pytest
+from kamene.layers.inet import IP, TCP
+from kamene.layers.l2 import Ether
+
+from cybernomaly.packet_inspection import DeepPacketInspector, protos
+from cybernomaly.packet_inspection.protos import Protocol
+
+
+def make_frame():
+    ether = Ether(src="00:00:00:00:00:01", dst="00:00:00:00:00:02")
+    return bytes(ether / IP(src="10.0.0.1", dst="10.0.0.2") / TCP(sport=1234, dport=80))
+
+
+def test_get_meta_only_protocol(monkeypatch):
+    with pytest.warns(DeprecationWarning, match="get_meta"):
+
+        class LegacyTCP(Protocol):
+            def get_meta(self, payload):
+                return {"ports": (payload.sport, payload.dport)}
+
+    monkeypatch.setitem(protos.PROTOCOLS, "TCP", LegacyTCP)
+    frame = make_frame()
+    for report in (
+        DeepPacketInspector().process(frame),
+        DeepPacketInspector().process_batch([frame])[0],
+    ):
+        assert report.meta["TCP"] == {"ports": (1234, 80)}
+        assert report.meta["IP"] == {"src": "10.0.0.1", "dst": "10.0.0.2"}
+
+
+def test_fields_protocol_does_not_warn(recwarn):
+    class Ports(Protocol):
+        fields = ("sport",)
+
+    assert not Ports._legacy
+    assert not [w for w in recwarn if w.category is DeprecationWarning]
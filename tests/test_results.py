@@ -0,0 +1,23 @@
+import numpy as np
+
+from cybernomaly.anomaly_detection import MIDAS_R, ResultSink
+
+
+def test_tick_max_uses_detector_ticks():
+    t = np.array([0.4, 0.6, 1.5, 2.5, 2.6])
+    score = np.array([1.0, 2.0, 3.0, 4.0, 5.0])
+    sink = ResultSink(ticksize=1)
+    sink.add(t, ["a"] * 5, ["b"] * 5, score)
+
+    snapped = MIDAS_R._snap_time(t, 1)
+    expected = {tick: score[snapped == tick].max() for tick in np.unique(snapped)}
+    assert sink.tick_max().to_dict() == expected
+
+
+def test_tick_max_is_sparse():
+    sink = ResultSink(ticksize=1)
+    sink.add([0, 1e15], ["a", "a"], ["b", "b"], [1.0, 2.0])
+    sink.add([1e15, 0], ["a", "a"], ["b", "b"], [0.5, 3.0])
+    tick_max = sink.tick_max()
+    assert tick_max.index.tolist() == [0, 10**15]
+    assert tick_max.tolist() == [3.0, 2.0]
@@ -0,0 +1,114 @@
+import asyncio
+
+import numpy as np
+
+from cybernomaly.anomaly_detection import MIDAS_R, RECORD_DTYPE, ScoringServer
+
+
+def make_edges(n=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    src = rng.integers(0, 50, n).astype(np.uint64)
+    dst = rng.integers(0, 50, n).astype(np.uint64)
+    t = np.sort(rng.integers(0, 30, n)).astype(np.float64)
+    count = rng.integers(1, 4, n).astype(np.float64)
+    return src, dst, t, count
+
+
+async def read_lines(reader, n):
+    return np.array([float(await reader.readline()) for _ in range(n)])
+
+
+def test_binary_scores_match_batch():
+    src, dst, t, count = make_edges()
+    expected = MIDAS_R().update_detect_score_batch(src, dst, count=count, t=t)
+
+    async def run():
+        async with ScoringServer(MIDAS_R(), port=0, framing="binary") as server:
+            reader, writer = await asyncio.open_connection(*server.address)
+            records = np.empty(len(src), dtype=RECORD_DTYPE)
+            records["src"], records["dst"] = src, dst
+            records["t"], records["count"] = t, count
+            # Send every batch before reading any score back.
+            for batch in np.array_split(records, 7):
+                writer.write(batch.tobytes())
+            await writer.drain()
+            data = await reader.readexactly(8 * len(src))
+            writer.close()
+            return np.frombuffer(data, dtype="<f8")
+
+    np.testing.assert_array_equal(asyncio.run(run()), expected)
+
+
+def test_line_scores_match_batch():
+    src, dst, t, count = make_edges(seed=1)
+    src = np.array([f"10.0.0.{s}" for s in src], dtype=object)
+    dst = np.array([f"10.0.1.{d}" for d in dst], dtype=object)
+    expected = MIDAS_R().update_detect_score_batch(src, dst, count=count, t=t)
+
+    async def run():
+        async with ScoringServer(MIDAS_R(), port=0, framing="line") as server:
+            reader, writer = await asyncio.open_connection(*server.address)
+            lines = [
+                f"{s} {d} {ts!r} {c!r}\n"
+                for s, d, ts, c in zip(src, dst, t.tolist(), count.tolist())
+            ]
+            for batch in np.array_split(np.array(lines), 5):
+                writer.write("".join(batch).encode())
+            await writer.drain()
+            scores = await read_lines(reader, len(lines))
+            writer.close()
+            return scores
+
+    np.testing.assert_array_equal(asyncio.run(run()), expected)
+
+
+def test_overlong_line_is_discarded():
+    async def run():
+        server = ScoringServer(MIDAS_R(), port=0, framing="line", max_line=64)
+        async with server:
+            reader, writer = await asyncio.open_connection(*server.address)
+            writer.write(b"a b 1 1\n" + b"x" * 10000 + b"\na b 1 1\n")
+            scores = await read_lines(reader, 3)
+            writer.close()
+            return scores
+
+    scores = asyncio.run(run())
+    assert np.isnan(scores[1]) and not np.isnan(scores).all()
+
+
+def test_malformed_lines_score_nan():
+    lines = [b"a b 1 1", b"\xff\xfe b 1 1", b"a", b"a b x", b"a b 1 1 1", b"a b 2"]
+
+    async def run():
+        server = ScoringServer(MIDAS_R(), port=0, framing="line")
+        async with server:
+            reader, writer = await asyncio.open_connection(*server.address)
+            writer.write(b"\n".join(lines) + b"\n")
+            scores = await read_lines(reader, len(lines))
+            writer.close()
+            return scores
+
+    scores = asyncio.run(run())
+    np.testing.assert_array_equal(np.isnan(scores), [0, 1, 1, 1, 1, 0])
+
+
+def test_close_with_connected_clients():
+    async def run():
+        server = ScoringServer(MIDAS_R(), port=0, framing="line")
+        await server.start()
+        idle = await asyncio.open_connection(*server.address)
+        reader, writer = await asyncio.open_connection(*server.address)
+        writer.write(b"a b 1 1\nc d 1 1\n")
+        await writer.drain()
+        while server.records < 2:
+            await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(server.close(), 10)
+        assert server.connections == 0
+        # Scores already computed are still delivered, then the server hangs up.
+        scores = await read_lines(reader, 2)
+        assert await asyncio.wait_for(reader.read(), 10) == b""
+        assert await asyncio.wait_for(idle[0].read(), 10) == b""
+        return scores
+
+    assert len(asyncio.run(run())) == 2
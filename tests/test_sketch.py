@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from cybernomaly.anomaly_detection import MIDAS_R, CountMinSketch
+
+
+def make_keys(n=20_000, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.zipf(1.3, n).astype(np.uint64) % np.uint64(5000)
+
+
+def test_conservative_never_overestimates_more():
+    keys = make_keys()
+    plain = CountMinSketch(64, 4)
+    conservative = CountMinSketch(64, 4, conservative=True)
+    plain.add(keys)
+    conservative.add(keys)
+
+    unique, true = np.unique(keys, return_counts=True)
+    plain_counts = plain.query(unique)
+    conservative_counts = conservative.query(unique)
+    assert (conservative_counts >= true).all()
+    assert (conservative_counts <= plain_counts).all()
+    assert (conservative_counts - true).sum() < (plain_counts - true).sum()
+    assert conservative.total == plain.total == len(keys)
+
+
+def test_conservative_batch_matches_one_at_a_time():
+    keys = make_keys(2000)
+    counts = np.random.default_rng(1).integers(1, 5, len(keys))
+    batch = CountMinSketch(32, 3, conservative=True)
+    batch.add(keys, counts)
+    single = CountMinSketch(32, 3, conservative=True)
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        single.add(key, count)
+    np.testing.assert_array_equal(batch.table, single.table)
+
+
+def test_compact_scores_match_default():
+    rng = np.random.default_rng(0)
+    n = 20_000
+    src, dst = rng.zipf(1.5, n) % 500, rng.zipf(1.5, n) % 500
+    t = np.sort(rng.integers(0, 50, n))
+    default, compact = MIDAS_R(), MIDAS_R(compact=True)
+    expected = default.update_detect_score_batch(src, dst, t=t)
+    scores = compact.update_detect_score_batch(src, dst, t=t)
+
+    for name in MIDAS_R._SKETCHES:
+        a, b = getattr(default, name), getattr(compact, name)
+        assert b.nbytes * 2 == a.nbytes
+        np.testing.assert_allclose(b.counts(), a.counts(), rtol=1e-6)
+    # Total counts are integers, and stored exactly.
+    np.testing.assert_array_equal(compact._edge_tot.table, default._edge_tot.table)
+    # The chi-squared score subtracts two nearly equal terms, which amplifies the
+    # float32 rounding of the current counts.
+    np.testing.assert_allclose(scores, expected, rtol=1e-4)
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_memory_budget(compact):
+    # 7 rows for the default false_pos_prob, 3 pairs of 16 (or 8 compact) bytes
+    # per counter, and 1000 counters per row.
+    budget = 7 * 3 * 16 * 1000
+    model = MIDAS_R(memory_budget=budget, compact=compact)
+    width = 2000 if compact else 1000
+    for name in MIDAS_R._SKETCHES:
+        cms = getattr(model, name)
+        assert (cms.depth, cms.width) == (7, width)
+    assert model.nbytes == budget
+
+    smaller = MIDAS_R(memory_budget=budget - 1, compact=compact)
+    assert smaller._edge_tot.width == width - 1
+    assert smaller.nbytes <= budget
+
+
+def test_memory_budget_too_small():
+    with pytest.raises(ValueError, match="cannot hold"):
+        MIDAS_R(memory_budget=100)
+    with pytest.raises(ValueError, match="cannot hold"):
+        CountMinSketch.from_memory(8 * 7 - 1, confidence=0.99)
+    assert CountMinSketch.from_memory(8 * 7, confidence=0.99).width == 1